@@ -16,6 +16,11 @@
 
 char thingsboardServer[] = "[YOUR THINGSBOARD SERVER HERE]";
 
+// Set bridge to 1 to publish to a broker on the local network instead, for bridge.py on a Raspberry Pi
+//  to forward to Thingsboard.  Messages go to esp/[TOKEN]/telemetry and esp/[TOKEN]/attributes
+int bridge = 0;
+char bridgeServer[] = "[YOUR LOCAL BROKER HERE]";
+
 // Define operation settions
 int unit_f = 1;          // Set this to 1 to convert temp reading to f
 char temp_label[] = "\"temp\"";
@@ -51,7 +56,14 @@ void setup()
   dht.begin();
   delay(10);
   InitWiFi();
-  client.setServer( thingsboardServer, 1883 );
+  if (bridge == 1)
+    {
+      client.setServer( bridgeServer, 1883 );
+    }
+  else
+    {
+      client.setServer( thingsboardServer, 1883 );
+    }
   lastSend = 0;
   Serial.print("Polling period ");
   Serial.print(poll_time);
@@ -167,7 +179,7 @@ void getAndSendTemperatureAndHumidityData()
         Serial.print(attr.length());
         Serial.print(") and will not be transmitted.  Check JSON output and shorten as necessary\n\n");
       } else {
-        client.publish( "v1/devices/me/attributes", attributes );
+        client.publish( topic("attributes").c_str(), attributes );
       }
   if (message.length() > 90 )
       {
@@ -175,10 +187,20 @@ void getAndSendTemperatureAndHumidityData()
         Serial.print(message.length());
         Serial.print(") and will not be transmitted.  Check JSON output and shorten as necessary\n\n");
       } else {
-          client.publish( "v1/devices/me/telemetry", telemetry );
+          client.publish( topic("telemetry").c_str(), telemetry );
       }
 }
 
+String topic(const char* kind)
+{
+  // Thingsboard knows the device by the token it connected with, the bridge by the token in the topic
+  if (bridge == 1)
+    {
+      return String("esp/") + TOKEN + "/" + kind;
+    }
+  return String("v1/devices/me/") + kind;
+}
+
 void InitWiFi()
 {
   Serial.println("Connecting to AP ...");
@@ -206,8 +228,11 @@ void reconnect() {
       Serial.println("Connected to AP");
     }
     Serial.print("Connecting to Thingsboard node ...");
-    // Attempt to connect (clientId, username, password)
-    if ( client.connect("ESP8266 Device", TOKEN, NULL) ) {
+    // Attempt to connect (clientId, username, password).  Boards sharing the local broker need
+    //  their own client ids, or they would disconnect each other
+    String clientId = "ESP8266-" + String(ESP.getChipId(), HEX);
+    if ( (bridge == 1 && client.connect(clientId.c_str())) ||
+         (bridge != 1 && client.connect("ESP8266 Device", TOKEN, NULL)) ) {
       Serial.println( "[DONE]" );
     } else {
       Serial.print( "[FAILED] [ rc = " );
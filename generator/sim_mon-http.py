@@ -3,10 +3,23 @@
 
 import json
 import sys
+import os
+import re
 import random
 import time
+import heapq
+import argparse
+import threading
+import socketserver
+import http.server
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor
 import requests
 import config as cfg         # Bring in shared configuration file
+try:
+    import paho.mqtt.client as mqtt  # Only needed for the MQTT transport of the benchmark
+except ImportError:
+    mqtt = None
 
 '''
 ####################################################################
@@ -45,9 +58,38 @@ DESCRIPTION
         telemetry data only to the specified cache directory in a format that can be used
         to import the data at a later time, preserving the event time stamp.
 
+    Replay mode streams recorded '.cache' files (from this script or from monitor.py) back
+        to the server, for load testing with real traffic.  Files are grouped into devices by
+        the authkey in their name, and records from all devices are sent in timestamp order,
+        keeping their relative timing at the requested speed:
+
+            sim_mon-http.py replay cache/ archive/site2/ --speed 10 --now
+
+        --speed     1 (default) for real time, N for N times faster, 'max' for no delays
+        --now       rewrite each record timestamp to the time it is sent
+        --workers   number of concurrent HTTP requests (default 8)
+
+    Benchmark mode drives the same synthetic device population through each transport, batch size
+        and concurrency level in turn, and prints a comparison report:
+
+            sim_mon-http.py bench --transports http http-batch mqtt --batch 1 10 100 --workers 1 4 16
+
+        http        one telemetry POST per record
+        http-batch  one POST per device of up to --batch records, as a JSON array
+        mqtt        one message of up to --batch records from any devices, through the Thingsboard
+                    gateway API over one connection per worker (QoS 1)
+
+        By default each transport is run against a stand-in server or broker started locally, in its
+        own process, that accepts everything - so the figures are the cost on the sending side.  Use
+        --server and --broker to run against a real Thingsboard server instead.  For each run the
+        report shows messages (records) per second, request bytes on the wire per record, CPU time of
+        this process per record and the p50/p99 latency of a request (POST to response, or PUBLISH to
+        PUBACK).  --out also writes the report as CSV.
+
 REQUIRES
     The following requirements must be met
         python-requests        Used to generate HTTP Post to Thingsboard server
+        paho-mqtt              Only for the 'mqtt' transport of the benchmark
         Thingsboard Server     As configured in config.py, it is the destination
                                to which information is sent.  You can get a demo
                                account at http://demo.thingsboard.io
@@ -101,6 +143,412 @@ def writeevt(_record,_type,_sev,_authkey):
         print('Error writing events to cache')
         return None
 
+def find_cache_files(_paths):
+    #############################################################################
+    # Function: find_cache_files                                                #
+    # Purpose: Walks the given files and directories for recorded cache files   #
+    #          and groups them by the device authkey in the file name           #
+    #          (<authkey>_<date>.cache or <authkey>-<date>.cache)               #
+    # @param        _paths            list of files and/or directories          #
+    #                                                                           #
+    #       @return dict of authkey -> sorted list of cache files               #
+    #############################################################################
+    devices = {}
+    found = []
+    for path in _paths:
+        if os.path.isdir(path):
+            for root, dirs, files in os.walk(path):
+                found.extend(os.path.join(root, name) for name in files)
+        else:
+            found.append(path)
+    for path in found:
+        match = re.match(r'^(.+)[_-]\d{4}-\d{2}-\d{2}\.cache$', os.path.basename(path))
+        if match:
+            devices.setdefault(match.group(1), []).append(path)
+    for authkey in devices:
+        devices[authkey].sort()
+    return devices
+
+def read_records(_authkey,_files):
+    #############################################################################
+    # Function: read_records                                                    #
+    # Purpose: Streams the records of one device's cache files in order, one    #
+    #          line at a time, so archives of any size can be replayed          #
+    # @param        _authkey          device the files belong to                #
+    # @param        _files            cache files of the device, oldest first   #
+    #                                                                           #
+    #       @return generator of (ts in ms, authkey, values)                    #
+    #############################################################################
+    for path in _files:
+        with open(path) as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                try:
+                    record = json.loads(line)
+                    yield (float(record['ts']), _authkey, record['values'])
+                except (ValueError, KeyError):
+                    print('Skipping unreadable record in ' + path)
+
+def replay(_paths,_speed,_now,_workers):
+    #############################################################################
+    # Function: replay                                                          #
+    # Purpose: Sends recorded cache files from many devices back to the server  #
+    #          in timestamp order, keeping the original spacing of the records  #
+    #          divided by _speed (or no spacing at all when _speed is None)     #
+    # @param        _paths            files and/or directories to replay        #
+    # @param        _speed            playback speed multiplier, None for max   #
+    # @param        _now              if True, timestamps are rewritten to now  #
+    # @param        _workers          number of concurrent HTTP requests        #
+    #                                                                           #
+    #       @return none                                                        #
+    #############################################################################
+    devices = find_cache_files(_paths)
+    if not devices:
+        print('No cache files found in ' + ', '.join(_paths))
+        return
+    print('Replaying ' + str(sum(len(f) for f in devices.values())) + ' files from ' + str(len(devices)) + ' devices')
+    writeevt('Replay started for ' + str(len(devices)) + ' devices','log','START','')
+
+    counts = {'sent': 0, 'ok': 0, 'failed': 0}
+    counts_lock = threading.Lock()
+    inflight = threading.BoundedSemaphore(_workers * 4)
+    local = threading.local()
+
+    def send(_ts,_authkey,_values):
+        result = 'failed'
+        try:
+            if not hasattr(local, 'session'):
+                local.session = requests.Session()
+            url = cfg.conn['method'] + '://' + cfg.conn['server'] + '/api/v1/' + _authkey + '/telemetry'
+            r = local.session.post(url, data=json.dumps({'ts': int(_ts), 'values': _values}), headers=cfg.http_headers, timeout=10)
+            result = 'ok' if r.status_code == 200 else 'failed'
+        except requests.RequestException:
+            pass
+        except Exception as e:
+            print('Unexpected error sending a record for ' + _authkey + ': ' + str(e))
+        finally:
+            # always free the slot, or the reader blocks for good in inflight.acquire()
+            with counts_lock:
+                counts[result] = counts[result] + 1
+            inflight.release()
+
+    streams = [read_records(authkey, files) for authkey, files in devices.items()]
+    start = time.time()
+    first_ts = None
+    last_report = start
+    with ThreadPoolExecutor(max_workers=_workers) as pool:
+        for ts, authkey, values in heapq.merge(*streams, key=lambda r: r[0]):
+            if first_ts is None:
+                first_ts = ts
+            if _speed is not None:
+                delay = start + (ts - first_ts) / 1000.0 / _speed - time.time()
+                if delay > 0:
+                    time.sleep(delay)
+            if _now:
+                ts = time.time() * 1000
+            inflight.acquire()
+            pool.submit(send, ts, authkey, values)
+            counts['sent'] = counts['sent'] + 1
+            if time.time() - last_report >= 5:
+                last_report = time.time()
+                print('Sent ' + str(counts['sent']) + ' records (' + str(int(counts['sent'] / (last_report - start))) + '/s), ' + str(counts['failed']) + ' failed')
+
+    elapsed = time.time() - start
+    print('Replay complete: ' + str(counts['sent']) + ' records in ' + str(round(elapsed, 1)) + ' seconds, ' + str(counts['ok']) + ' ok, ' + str(counts['failed']) + ' failed')
+    writeevt('Replay completed, ' + str(counts['ok']) + ' of ' + str(counts['sent']) + ' records accepted','log','INFO','')
+
+def bench_telemetry(_sensor):
+    #############################################################################
+    # Function: bench_telemetry                                                 #
+    # Purpose: Synthetic telemetry of one record, as generated by main()        #
+    # @param        _sensor           sensor from config.py used as template    #
+    #                                                                           #
+    #       @return telemetry dict                                              #
+    #############################################################################
+    return {
+        'Temp': random.randrange(_sensor['temp_low'], _sensor['temp_high'], 1),
+        'CPU Temp': random.randrange(100,120,1),
+        'RAM Used': random.randrange(60,80,1),
+        'Disk Used': random.randrange(60,80,1),
+        'CPU Used': random.randrange(25,28,1)
+        }
+
+def bench_jobs(_transport,_batch,_devices,_records):
+    #############################################################################
+    # Function: bench_jobs                                                      #
+    # Purpose: Splits the records of a synthetic device population into the     #
+    #          requests (or messages) a transport sends                         #
+    # @param        _transport        'http', 'http-batch' or 'mqtt'            #
+    # @param        _batch            records per request                       #
+    # @param        _devices          number of devices                         #
+    # @param        _records          total number of records                   #
+    #                                                                           #
+    #       @return list of lists of (authkey, ts, telemetry)                   #
+    #############################################################################
+    random.seed(1)                   # the same population for every run
+    now = int(time.time() * 1000)
+    records = []
+    for i in range(_records):
+        device = i % _devices
+        records.append(('bench-' + str(device).zfill(4), now + (i // _devices) * 1000,
+                        bench_telemetry(cfg.sensors[device % len(cfg.sensors)])))
+    if _transport == 'http':
+        return [[record] for record in records]
+    if _transport == 'mqtt':
+        return [records[i:i + _batch] for i in range(0, len(records), _batch)]
+    per_device = {}
+    for record in records:
+        per_device.setdefault(record[0], []).append(record)
+    jobs = []
+    for authkey, device_records in sorted(per_device.items()):
+        jobs.extend(device_records[i:i + _batch] for i in range(0, len(device_records), _batch))
+    return jobs
+
+def mqtt_size(_topic,_payload):
+    #############################################################################
+    # Function: mqtt_size                                                       #
+    # Purpose: Size on the wire of a QoS 1 MQTT PUBLISH packet                  #
+    #############################################################################
+    remaining = 2 + len(_topic) + 2 + len(_payload)
+    size = 1 + remaining
+    while True:
+        size = size + 1
+        remaining = remaining // 128
+        if remaining == 0:
+            return size
+
+class StandInHTTP(http.server.BaseHTTPRequestHandler):
+    #############################################################################
+    # Class: StandInHTTP                                                        #
+    # Purpose: Stand-in Thingsboard HTTP API - accepts every POST with a 200,   #
+    #          keeping connections open like the real server                    #
+    #############################################################################
+    protocol_version = 'HTTP/1.1'
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        self.send_response(200)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        pass
+
+class StandInMQTT(socketserver.BaseRequestHandler):
+    #############################################################################
+    # Class: StandInMQTT                                                        #
+    # Purpose: Stand-in MQTT 3.1.1 broker - accepts every connection and        #
+    #          acknowledges every QoS 1 PUBLISH, without delivering anything    #
+    #############################################################################
+    def read(self, _count):
+        data = b''
+        while len(data) < _count:
+            chunk = self.request.recv(_count - len(data))
+            if not chunk:
+                raise EOFError()
+            data = data + chunk
+        return data
+
+    def handle(self):
+        try:
+            while True:
+                kind = self.read(1)[0]
+                length = 0
+                shift = 0
+                while True:
+                    byte = self.read(1)[0]
+                    length = length + ((byte & 127) << shift)
+                    shift = shift + 7
+                    if byte < 128:
+                        break
+                body = self.read(length)
+                if kind >> 4 == 1:                      # CONNECT
+                    self.request.sendall(b'\x20\x02\x00\x00')
+                elif kind >> 4 == 3 and (kind >> 1) & 3:  # PUBLISH, QoS 1 or 2
+                    topic = (body[0] << 8) + body[1]
+                    self.request.sendall(b'\x40\x02' + body[2 + topic:4 + topic])
+                elif kind >> 4 == 12:                   # PINGREQ
+                    self.request.sendall(b'\xd0\x00')
+                elif kind >> 4 == 14:                   # DISCONNECT
+                    return
+        except (EOFError, OSError):
+            return
+
+def stand_in(_kind,_ports):
+    #############################################################################
+    # Function: stand_in                                                        #
+    # Purpose: Runs a stand-in server (own process, so its CPU time is not      #
+    #          counted against the transport being measured)                    #
+    # @param        _kind             'http' or 'mqtt'                          #
+    # @param        _ports            queue the listening port is reported on   #
+    #                                                                           #
+    #       @return none (runs until terminated)                                #
+    #############################################################################
+    if _kind == 'http':
+        server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), StandInHTTP)
+    else:
+        socketserver.ThreadingTCPServer.allow_reuse_address = True
+        server = socketserver.ThreadingTCPServer(('127.0.0.1', 0), StandInMQTT)
+    server.daemon_threads = True
+    _ports.put(server.server_address[1])
+    server.serve_forever()
+
+def bench_run(_transport,_batch,_workers,_jobs,_server,_broker):
+    #############################################################################
+    # Function: bench_run                                                       #
+    # Purpose: Sends the jobs of one configuration and measures it              #
+    # @param        _transport        'http', 'http-batch' or 'mqtt'            #
+    # @param        _batch            records per request                       #
+    # @param        _workers          concurrent requests (MQTT connections)    #
+    # @param        _jobs             requests to send, from bench_jobs()       #
+    # @param        _server           host:port of the HTTP server              #
+    # @param        _broker           (host, port) of the MQTT broker           #
+    #                                                                           #
+    #       @return dict of the results                                         #
+    #############################################################################
+    local = threading.local()
+    clients = []
+    clients_lock = threading.Lock()
+
+    def send_http(_job):
+        if not hasattr(local, 'session'):
+            local.session = requests.Session()
+        if _transport == 'http':
+            ts, values = _job[0][1], _job[0][2]
+            body = json.dumps({'ts': ts, 'values': values})
+        else:
+            body = json.dumps([{'ts': ts, 'values': values} for authkey, ts, values in _job])
+        url = 'http://' + _server + '/api/v1/' + _job[0][0] + '/telemetry'
+        start = time.perf_counter()
+        try:
+            r = local.session.post(url, data=body, headers=cfg.http_headers, timeout=30)
+            ok = r.status_code == 200
+            request = r.request
+            size = len(request.method + ' ' + request.path_url + ' HTTP/1.1\r\nHost: ' + _server + '\r\n\r\n') + \
+                sum(len(k) + len(v) + 4 for k, v in request.headers.items()) + len(body)
+        except requests.RequestException:
+            ok = False
+            size = len(body)
+        return (time.perf_counter() - start, size, ok)
+
+    def send_mqtt(_job):
+        if not hasattr(local, 'client'):
+            try:
+                local.client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2)
+            except AttributeError:
+                local.client = mqtt.Client()               # paho-mqtt 1.x
+            local.client.username_pw_set(cfg.conn.get('gateway_token', 'bench'))
+            local.client.max_inflight_messages_set(1)
+            local.client.connect(_broker[0], _broker[1])
+            local.client.loop_start()
+            with clients_lock:
+                clients.append(local.client)
+        tele = {}
+        for authkey, ts, values in _job:
+            tele.setdefault(authkey, []).append({'ts': ts, 'values': values})
+        payload = json.dumps(tele)
+        start = time.perf_counter()
+        info = local.client.publish('v1/gateway/telemetry', payload, qos=1)
+        info.wait_for_publish(30)
+        return (time.perf_counter() - start, mqtt_size('v1/gateway/telemetry', payload.encode('utf-8')), info.is_published())
+
+    send = send_mqtt if _transport == 'mqtt' else send_http
+    cpu = time.process_time()
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=_workers) as pool:
+        results = list(pool.map(send, _jobs))
+    elapsed = time.perf_counter() - start
+    cpu = time.process_time() - cpu
+    for client in clients:
+        client.loop_stop()
+        client.disconnect()
+
+    records = sum(len(job) for job in _jobs)
+    latencies = sorted(result[0] for result in results)
+    def percentile(p):
+        return latencies[int(round(p * (len(latencies) - 1)))] * 1000
+    return {
+        'transport': _transport,
+        'batch': _batch,
+        'workers': _workers,
+        'records': records,
+        'requests': len(_jobs),
+        'failed': sum(1 for result in results if not result[2]),
+        'msgs_s': records / elapsed,
+        'bytes': sum(result[1] for result in results),
+        'cpu_us': cpu / records * 1e6,
+        'p50_ms': percentile(0.5),
+        'p99_ms': percentile(0.99)
+        }
+
+def bench(_transports,_batches,_workers,_devices,_records,_server,_broker,_out):
+    #############################################################################
+    # Function: bench                                                           #
+    # Purpose: Runs every transport / batch size / concurrency combination and  #
+    #          prints the comparison report                                     #
+    # @param        _transports       transports to compare                     #
+    # @param        _batches          batch sizes to compare                    #
+    # @param        _workers          concurrency levels to compare             #
+    # @param        _devices          number of synthetic devices               #
+    # @param        _records          records sent per run                      #
+    # @param        _server           HTTP server host:port, None for stand-in  #
+    # @param        _broker           MQTT broker host:port, None for stand-in  #
+    # @param        _out              CSV file for the report, or None          #
+    #                                                                           #
+    #       @return none                                                        #
+    #############################################################################
+    if 'mqtt' in _transports and mqtt is None:
+        print('The mqtt transport needs the paho-mqtt library - pip install paho-mqtt, skipping it')
+        _transports = [t for t in _transports if t != 'mqtt']
+
+    stand_ins = []
+    labels = {'http': str(_server), 'mqtt': str(_broker)}
+    ports = multiprocessing.Queue()
+    for kind, given in (('http', _server), ('mqtt', _broker)):
+        if given is None and any(t.startswith(kind) for t in _transports):
+            process = multiprocessing.Process(target=stand_in, args=(kind, ports), daemon=True)
+            process.start()
+            stand_ins.append(process)
+            address = '127.0.0.1:' + str(ports.get(timeout=10))
+            labels[kind] = address + ' (stand-in)'
+            if kind == 'http':
+                _server = address
+            else:
+                _broker = address
+    broker = None
+    if _broker is not None:
+        host, sep, port = _broker.partition(':')
+        broker = (host, int(port or 1883))
+
+    columns = ['transport', 'batch', 'workers', 'records', 'requests', 'failed', 'msgs_s', 'bytes', 'cpu_us', 'p50_ms', 'p99_ms']
+    print('Devices: ' + str(_devices) + ', records per run: ' + str(_records) +
+          ', HTTP: ' + labels['http'] + ', MQTT: ' + labels['mqtt'])
+    print('transport   batch workers     msgs/s  bytes/msg  cpu us/msg    p50 ms    p99 ms  failed')
+    report = []
+    try:
+        for transport in _transports:
+            for batch in ([1] if transport == 'http' else _batches):
+                for workers in _workers:
+                    jobs = bench_jobs(transport, batch, _devices, _records)
+                    result = bench_run(transport, batch, workers, jobs, _server, broker)
+                    report.append(result)
+                    print(transport.ljust(10) + str(batch).rjust(6) + str(workers).rjust(8) +
+                          ('%11.0f' % result['msgs_s']) + ('%11.1f' % (float(result['bytes']) / result['records'])) +
+                          ('%12.1f' % result['cpu_us']) + ('%10.2f' % result['p50_ms']) + ('%10.2f' % result['p99_ms']) +
+                          str(result['failed']).rjust(8))
+    finally:
+        for process in stand_ins:
+            process.terminate()
+
+    if _out:
+        with open(_out, 'w') as f:
+            f.write(','.join(columns) + '\n')
+            for result in report:
+                f.write(','.join(str(round(result[c], 3)) if isinstance(result[c], float) else str(result[c]) for c in columns) + '\n')
+        print('Report written to ' + _out)
+    writeevt('Benchmark completed, ' + str(len(report)) + ' configurations','log','INFO','')
+
 def main():
     writeevt('Started processing at ' + time.strftime("%Y-%m-%d %H:%M:%S"),'log','START','')
     while True:
@@ -152,7 +600,28 @@ def main():
         time.sleep(me['wait'])
     
 if __name__ == '__main__':
-    main()
+    if len(sys.argv) > 1 and sys.argv[1] == 'replay':
+        parser = argparse.ArgumentParser(prog='sim_mon-http.py replay', description='Replay recorded cache files to the server')
+        parser.add_argument('paths', nargs='+', help='cache files or directories to replay')
+        parser.add_argument('--speed', default='1', help="playback speed multiplier, or 'max'")
+        parser.add_argument('--now', action='store_true', help='rewrite record timestamps to the time they are sent')
+        parser.add_argument('--workers', type=int, default=8, help='concurrent HTTP requests')
+        args = parser.parse_args(sys.argv[2:])
+        replay(args.paths, None if args.speed == 'max' else float(args.speed), args.now, args.workers)
+    elif len(sys.argv) > 1 and sys.argv[1] == 'bench':
+        parser = argparse.ArgumentParser(prog='sim_mon-http.py bench', description='Compare transports, batch sizes and concurrency levels')
+        parser.add_argument('--transports', nargs='+', choices=['http', 'http-batch', 'mqtt'], default=['http', 'http-batch', 'mqtt'])
+        parser.add_argument('--batch', nargs='+', type=int, default=[1, 10, 100], help='records per request')
+        parser.add_argument('--workers', nargs='+', type=int, default=[1, 4, 16], help='concurrent requests')
+        parser.add_argument('--devices', type=int, default=100, help='synthetic devices')
+        parser.add_argument('--records', type=int, default=2000, help='records sent per run')
+        parser.add_argument('--server', help='HTTP server host:port, default a local stand-in')
+        parser.add_argument('--broker', help='MQTT broker host:port, default a local stand-in')
+        parser.add_argument('--out', help='also write the report to this CSV file')
+        args = parser.parse_args(sys.argv[2:])
+        bench(args.transports, args.batch, args.workers, args.devices, args.records, args.server, args.broker, args.out)
+    else:
+        main()
 
 
 
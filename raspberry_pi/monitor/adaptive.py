@@ -0,0 +1,70 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import threading
+import config as cfg                # Bring in shared configuration file
+
+'''
+========================================================================================================
+SYNOPSIS
+    'adaptive.py' picks the poll interval of sensors with the 'adaptive' setting from how fast their
+        readings are changing, used by 'monitor.py' to schedule them.
+
+DESCRIPTION
+    For every poll, the rate of change of the sensor's key (per minute) since the previous poll is
+        folded into a running estimate.  A rate above the estimate replaces it straight away, so the
+        start of a defrost cycle or a door opening is picked up on the next poll, while a lower rate
+        only pulls the estimate down by cfg.adaptive['alpha'] per poll, so a sensor settles back to
+        its long interval gradually.  The interval is then
+
+            poll_min + (poll_max - poll_min) / (1 + rate / poll_change)
+
+        which is poll_max for a steady reading, halfway between the two when the reading changes by
+        'poll_change' per minute, and approaches poll_min for faster changes.  Only two numbers are
+        kept per sensor, so the cost is the same however long the sensor has been running.
+
+AUTHOR
+    Bob Perciaccante - Bob@perciaccante.net
+
+========================================================================================================
+'''
+
+estimates = {}                # sensor id -> [last value, time of last value in ms, rate estimate per minute]
+lock = threading.Lock()       # protects estimates
+
+def update(_item, _message, _ts):
+    #############################################################################
+    # Function: update                                                          #
+    # Purpose:  Folds a new reading into the sensor's rate of change estimate   #
+    #           and works out the interval until it should be polled again.     #
+    #           Errors and stale readings leave the estimate as it was          #
+    # @param    _item      sensor definition from config.py                     #
+    # @param    _message   telemetry gathered for the sensor                    #
+    # @param    _ts        time the reading was taken, in ms                    #
+    #                                                                           #
+    # @return   seconds until the next poll                                     #
+    #############################################################################
+    set = _item['settings']
+    label = _item['tele']['label']
+    key = set.get('poll_key', set.get('alarm_key', 'temp' + label))
+    value = _message.get(key)
+
+    with lock:
+        estimate = estimates.get(_item['id'])
+        if isinstance(value, bool) or not isinstance(value, (int, float)) or _message.get('stale' + label) == 1:
+            pass
+        elif estimate is None:
+            estimate = estimates[_item['id']] = [value, _ts, 0.0]
+        elif _ts > estimate[1]:
+            rate = abs(value - estimate[0]) / ((_ts - estimate[1]) / 60000.0)
+            if rate > estimate[2]:
+                estimate[2] = rate
+            else:
+                estimate[2] = estimate[2] + cfg.adaptive['alpha'] * (rate - estimate[2])
+            estimate[0] = value
+            estimate[1] = _ts
+        rate = estimate[2] if estimate is not None else 0.0
+
+    low = set.get('poll_min', cfg.adaptive['poll_min'])
+    high = set.get('poll_max', cfg.adaptive['poll_max'])
+    change = set.get('poll_change', cfg.adaptive['poll_change'])
+    return int(round(low + (high - low) / (1 + rate / float(change))))
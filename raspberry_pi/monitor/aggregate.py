@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import threading
+import config as cfg                # Bring in shared configuration file
+
+'''
+========================================================================================================
+SYNOPSIS
+    'aggregate.py' keeps windowed statistics for sensors that are sampled more often than they are
+        published, used by 'monitor.py' for sensors with a 'sample' setting.
+
+DESCRIPTION
+    Every numeric telemetry key of a sensor has a ring of cfg.aggregation['buckets'] buckets, each
+        covering window / buckets seconds and holding the min, max, sum, count and last value of the
+        samples that fell into it.  A sample lands in the bucket for its time, reusing the slot of a
+        bucket that has aged out of the window, so memory per key is fixed no matter how long the
+        window is or how fast the sensor is sampled.  When the sensor is published, summary() combines
+        the buckets still inside the window into:
+
+            [key]           last value
+            [key]_min       lowest value in the window
+            [key]_max       highest value in the window
+            [key]_avg       mean of the values in the window
+            [key]_count     number of samples in the window
+
+AUTHOR
+    Bob Perciaccante - Bob@perciaccante.net
+
+========================================================================================================
+'''
+
+windows = {}                  # sensor id -> key -> ring of buckets [number, min, max, sum, count, last]
+lock = threading.Lock()       # protects windows
+
+def add(_id, _values, _ts, _window):
+    #############################################################################
+    # Function: add                                                             #
+    # Purpose:  Adds one sample of every numeric value to the sensor's windows  #
+    # @param    _id        sensor id                                            #
+    # @param    _values    telemetry dict of the sample                         #
+    # @param    _ts        time of the sample, in ms                            #
+    # @param    _window    window length in seconds                             #
+    #                                                                           #
+    # @return   none                                                            #
+    #############################################################################
+    size = cfg.aggregation['buckets']
+    number = int(_ts / 1000.0 // (float(_window) / size))
+    with lock:
+        sensor = windows.setdefault(_id, {})
+        for key, value in _values.items():
+            if isinstance(value, bool) or not isinstance(value, (int, float)):
+                continue
+            ring = sensor.get(key)
+            if ring is None or len(ring) != size:
+                ring = sensor[key] = [None] * size
+            slot = number % size
+            bucket = ring[slot]
+            if bucket is None or bucket[0] != number:
+                ring[slot] = [number, value, value, value, 1, value]
+            else:
+                bucket[1] = min(bucket[1], value)
+                bucket[2] = max(bucket[2], value)
+                bucket[3] = bucket[3] + value
+                bucket[4] = bucket[4] + 1
+                bucket[5] = value
+
+def summary(_id, _ts, _window):
+    #############################################################################
+    # Function: summary                                                         #
+    # Purpose:  Combines the buckets of each key that are inside the window     #
+    #           ending at _ts into last/min/max/avg/count telemetry             #
+    # @param    _id        sensor id                                            #
+    # @param    _ts        end of the window, in ms                             #
+    # @param    _window    window length in seconds                             #
+    #                                                                           #
+    # @return   telemetry dict of the window statistics                         #
+    #############################################################################
+    size = cfg.aggregation['buckets']
+    number = int(_ts / 1000.0 // (float(_window) / size))
+    stats = {}
+    with lock:
+        for key, ring in windows.get(_id, {}).items():
+            live = [b for b in ring if b is not None and number - size < b[0] <= number]
+            if not live:
+                continue
+            count = sum(b[4] for b in live)
+            stats[key] = max(live, key=lambda b: b[0])[5]
+            stats[key + '_min'] = min(b[1] for b in live)
+            stats[key + '_max'] = max(b[2] for b in live)
+            stats[key + '_avg'] = round(sum(b[3] for b in live) / float(count), 2)
+            stats[key + '_count'] = count
+    return stats
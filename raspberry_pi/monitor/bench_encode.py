@@ -0,0 +1,121 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import sys
+import json                  # Used for data manipulation
+import time
+import random
+import argparse
+import encode                # Encoding used by the publisher
+
+'''
+========================================================================================================
+SYNOPSIS
+    'bench_encode.py' compares the cost of encoding readings for publishing, the way 1.5 did it against
+        'encode.py', on the machine it is run on (a Raspberry Pi is where it matters).
+
+DESCRIPTION
+    Builds --devices devices of synthetic readings shaped like the monitor's (a few temperatures and
+        their window statistics, alarm flags and system values), then for batches of --batch readings
+        per device times:
+
+        old     json.dumps() of the whole batch for the request body, and json.dumps() of every reading
+                again for the cache lines, float millisecond timestamps
+        new     encode.record() once per reading, joined into both the request body and the cache lines
+
+    For each, the readings per second, microseconds per reading and bytes per reading are printed.
+
+        bench_encode.py --devices 20 --batch 10 --seconds 3
+
+AUTHOR
+    Bob Perciaccante - Bob@perciaccante.net
+
+========================================================================================================
+'''
+
+
+def readings(devices, batch):
+    #############################################################################
+    # Function: readings                                                        #
+    # Purpose:  Synthetic batches, one per device, of (ts in ms, telemetry)     #
+    #############################################################################
+    now = time.time() * 1000
+    batches = []
+    for d in range(devices):
+        label = 'T' + str(d)
+        records = []
+        for i in range(batch):
+            temp = round(random.uniform(-20, 40), 2)
+            records.append((now + i * 1000.0, {
+                'temp' + label: temp,
+                'temp' + label + '_min': temp - 0.5,
+                'temp' + label + '_max': temp + 0.5,
+                'temp' + label + '_avg': temp,
+                'temp' + label + '_count': 30,
+                'alarm' + label: 0,
+                'humidity' + label: random.randint(20, 80),
+                'cpu_percent': random.uniform(0, 100),
+                'stale' + label: False,
+                }))
+        batches.append(records)
+    return batches
+
+
+def old(batch):
+    body = json.dumps([{'ts': ts, 'values': message} for ts, message in batch])
+    cache = '\n'.join('{"ts":' + str(ts) + ', "values":' + json.dumps(message) + '}' for ts, message in batch)
+    return body, cache
+
+
+def new(batch):
+    lines = [encode.record(ts, message) for ts, message in batch]
+    return encode.array(lines), '\n'.join(lines)
+
+
+def run(name, func, batches, seconds):
+    #############################################################################
+    # Function: run                                                             #
+    # Purpose:  Times one encoding for about 'seconds' seconds and prints the   #
+    #           results                                                         #
+    #############################################################################
+    count = 0
+    size = 0
+    start = time.perf_counter()
+    cpu = time.process_time()
+    while time.perf_counter() - start < seconds:
+        for batch in batches:
+            body, cache = func(batch)
+            count = count + len(batch)
+            size = size + len(body)
+    elapsed = time.perf_counter() - start
+    cpu = time.process_time() - cpu
+    print(name.ljust(6) + str(int(count / elapsed)).rjust(10) + ' readings/s' +
+          ('%8.2f' % (cpu / count * 1e6)) + ' us cpu/reading' +
+          ('%7d' % (size / count)) + ' bytes/reading')
+    return count / elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare reading encodings for publishing')
+    parser.add_argument('--devices', type=int, default=20)
+    parser.add_argument('--batch', type=int, default=10, help='readings per device per request')
+    parser.add_argument('--seconds', type=float, default=3)
+    args = parser.parse_args()
+
+    batches = readings(args.devices, args.batch)
+    for batch in batches:
+        body, cache = new(batch)
+        # both must decode to the same readings (timestamps differ only by int/float)
+        if json.loads(body) != [{'ts': int(ts), 'values': message} for ts, message in batch] or \
+                [json.loads(line) for line in cache.split('\n')] != json.loads(body):
+            print('Encodings differ for ' + str(batch[0][1]))
+            return 1
+
+    print('Encoder: ' + ('orjson' if encode.orjson is not None else 'key layouts'))
+    before = run('old', old, batches, args.seconds)
+    after = run('new', new, batches, args.seconds)
+    print('Speedup: ' + ('%.2f' % (after / before)) + 'x')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,177 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import os
+import json                  # Used for data manipulation
+import time                  # Usef for timestamps, etc
+import threading
+import logging
+import config as cfg         # Bring in config.py configuration file
+import common as com         # Bring in common.py shared functions
+import encode                # Integer millisecond timestamps
+import gateway               # Device names for the MQTT gateway transport
+try:
+    import paho.mqtt.client as mqtt # Used for the local broker connection
+except ImportError:
+    mqtt = None
+
+'''
+========================================================================================================
+SYNOPSIS
+    'bridge.py' collects the readings of the ESP8266 DHT boards from a broker on the local network and
+        forwards them to the Thingsboard server through the monitor's publisher queue and cache.
+
+DESCRIPTION
+    With 'bridge' set to 1 in 'esp8266-dht11-22-mqtt.ino', each board publishes to the local broker on
+        esp/<authkey>/telemetry and esp/<authkey>/attributes instead of keeping its own connection to
+        the server.  The bridge subscribes to bridge['topic'] and, for every telemetry message:
+
+        - converts numbers sent as strings to numbers and drops values that are not numbers
+        - timestamps the reading when it arrives
+        - queues it, with the latest attributes of the board, for the publisher threads
+
+    The publisher threads send the readings in batches exactly as for local sensors.  With conn['method']
+        set to 'gateway', the readings of every board go out over a single MQTT connection to the
+        server, the boards showing up as gateway devices named by their 'name' attribute.  Readings that
+        cannot be sent are cached (bridge['cache_on_err']) and replayed every bridge['replay'] seconds,
+        so nothing is lost while the server is unreachable.  The cache directories are searched for
+        them, so boards not heard from since the bridge started are replayed too (cache files of the
+        sensors in 'config.py' are left to the monitor).
+
+        bridge.py
+
+REQUIRES
+    The following requirements must be met
+        paho-mqtt               pip install paho-mqtt
+        MQTT Broker             On the local network, e.g. mosquitto, as set in bridge['broker']
+        Thingsboard Device      Each board's authkey must be a device on the server (HTTP), or
+                                conn['gateway_token'] a gateway device (gateway method)
+
+AUTHOR
+    Bob Perciaccante - Bob@perciaccante.net
+
+========================================================================================================
+'''
+
+boards = {}                   # authkey -> {'attr': latest attributes, 'seen': time of the last message}
+lock = threading.Lock()       # protects boards
+
+
+def on_connect(client, userdata, flags, rc):
+    #############################################################################
+    # Function: on_connect                                                      #
+    # Purpose:  paho callback, subscribes to the board topics on every          #
+    #           (re)connection                                                  #
+    #############################################################################
+    if rc == 0:
+        logging.info('Connected to local broker ' + cfg.bridge['broker'] + ':' + str(cfg.bridge['port']) + ', subscribing to ' + cfg.bridge['topic'])
+        client.subscribe(cfg.bridge['topic'], qos=1)
+    else:
+        logging.warning('Local broker refused connection, return code ' + str(rc))
+
+
+def on_message(client, userdata, msg):
+    #############################################################################
+    # Function: on_message                                                      #
+    # Purpose:  paho callback, handles one message from a board                 #
+    #############################################################################
+    try:
+        authkey, kind = msg.topic.split('/')[-2:]
+        payload = json.loads(msg.payload.decode('utf-8'))
+        if not isinstance(payload, dict):
+            raise ValueError('not a JSON object')
+    except ValueError as e:
+        com.count('bridge_bad')
+        logging.warning('Ignoring message on ' + msg.topic + ': ' + str(e))
+        return
+
+    with lock:
+        board = boards.setdefault(authkey, {'attr': {}, 'seen': 0})
+        board['seen'] = time.time()
+        if kind == 'attributes':
+            board['attr'].update(payload)
+            if 'name' in payload:
+                gateway.names[authkey] = str(payload['name'])
+            return
+        attr = dict(board['attr'])
+
+    if kind != 'telemetry':
+        com.count('bridge_bad')
+        return
+    message = normalise(payload)
+    if not message:
+        com.count('bridge_bad')
+        return
+    com.count('bridge_readings')
+    com.enqueue({'ts': encode.now_ms(),
+                 'authkey': authkey,
+                 'attr': attr,
+                 'tele': message,
+                 'cache_on_err': cfg.bridge['cache_on_err'],
+                 'localonly': 0}, 1)
+
+
+def normalise(_payload):
+    #############################################################################
+    # Function: normalise                                                       #
+    # Purpose:  Turns numbers sent as strings into numbers, and drops values    #
+    #           that are not numbers (the boards send NaN as 'nan')             #
+    # @param    _payload   telemetry from a board                               #
+    #                                                                           #
+    # @return   telemetry dict                                                  #
+    #############################################################################
+    message = {}
+    for key, value in _payload.items():
+        if isinstance(value, str):
+            try:
+                value = float(value)
+            except ValueError:
+                continue
+        if isinstance(value, bool) or not isinstance(value, (int, float)) or value != value:
+            continue
+        message[key] = value
+    return message
+
+
+def main():
+    cfg.logfile = cfg.logs['logdir'] + 'bridge_' + cfg.logs['logfile']
+    com.setup_logging()
+    if os.path.exists(cfg.logs['logdir']) != True or os.path.exists(cfg.logs['cachedir']) != True:
+        logging.warning('unable to write to logfile')
+        return
+    if mqtt is None:
+        logging.error('The bridge needs the paho-mqtt library - pip install paho-mqtt')
+        return
+
+    try:
+        client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION1)
+    except AttributeError:
+        client = mqtt.Client()           # paho-mqtt 1.x
+    client.on_connect = on_connect
+    client.on_message = on_message
+    client.reconnect_delay_set(1, 60)
+    client.connect_async(cfg.bridge['broker'], cfg.bridge['port'])
+    client.loop_start()
+    com.start_publishers()
+
+    # Replay what was cached while the server was unreachable, oldest first
+    try:
+        while True:
+            time.sleep(cfg.bridge['replay'])
+            com.chk_cache()
+            com.trim_cache()
+            with lock:
+                seen = dict((authkey, board['seen']) for authkey, board in boards.items())
+            # every board with a cache, including those not heard from since the bridge started.
+            # The monitor's own sensors are left to it, as it replays them per their clearcache setting
+            local = set(item['authkey'] for item in cfg.sensors)
+            for authkey in sorted(set(seen) | (com.cached_devices() - local)):
+                com.clear_cache(authkey)
+            quiet = [authkey for authkey, when in seen.items() if time.time() - when > cfg.bridge['quiet']]
+            logging.info('Boards heard from: ' + str(len(seen) - len(quiet)) + ', quiet for over ' + str(cfg.bridge['quiet']) + ' seconds: ' + str(len(quiet)) + ', counters: ' + str(com.stats))
+    finally:
+        client.loop_stop()
+        com.spill_outbox()
+
+
+if __name__ == '__main__':
+    main()
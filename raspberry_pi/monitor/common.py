@@ -9,10 +9,27 @@ import platform                     # Used for local system information gatherin
 import datetime
 import netifaces as ni              # Used for local system information gathering
 import config as cfg                # Bring in shared configuration file
+import gateway                      # Thingsboard MQTT gateway transport
+import encode                       # Encodes readings once for the server and the cache
 import humanize                     # Convert data to more easily read formatts
 import sys
 import time
 import logging
+import logging.handlers             # Used for background log writing and rotation
+import queue
+import random                       # Used for circuit breaker backoff jitter
+import atexit
+import threading
+import heapq                        # Used for the publish queue
+import gzip                         # Used to compress request bodies
+import zlib
+import itertools
+from concurrent.futures import ThreadPoolExecutor
+from array import array             # Used for columns of values converted in bulk
+try:
+    import numpy                    # Optional, speeds up convert_column()
+except ImportError:
+    numpy = None
 
 '''
 ========================================================================================================
@@ -45,8 +62,132 @@ me = {
     'cpu_wait': 2             # how long to wait after read_sys_stats is called and CPU usage is measured
     }
 
+stats = {}                    # running counters (cache fast-fails, breaker trips, etc), see count()
+breakers = {}                 # circuit breaker state per destination name, see breaker_allow()
+sessions = {}                 # requests session (connection pool) per destination name, see http_post()
+readers = {}                  # read_sensor() worker currently running per (type, device, label)
+last_read = {}                # last good reading per (type, device, label), returned when a read hangs
+alarms = {}                   # threshold state ('normal', 'low', 'high') per sensor id, see check_thresholds()
+owm_cycle = {}                # OpenWeatherMaps responses per location for the current poll, see fetch_owm()
+lock = threading.Lock()       # protects stats, breakers, readers, last_read, owm_cycle, fanout_pending and replaying
+log_listener = None           # background thread writing log records to file, see setup_logging()
+log_seen = {}                 # (file, line, message) -> [time last logged, times suppressed since], see log_ratelimit()
+log_lock = threading.Lock()   # protects log_seen
+cache_lock = threading.Lock() # serializes cache file writes with trim_cache() rewrites
+outboxes = {}                 # destination name -> heap of (priority, seq, reading) waiting for its publisher threads
+outbox_seq = itertools.count()
+outbox_cv = threading.Condition() # protects outboxes, notified when a reading is queued
+fanout = None                 # thread pool publishing to several destinations at once, see publish_batch()
+fanout_pending = {}           # destination name -> readings handed to the fanout pool and not yet published
+replaying = set()             # (destination name, authkey) whose cache is being replayed, see clear_cache()
+stale_tmp = 600               # seconds after which an unchanged downsample copy is taken as left by a crash
+dest_list = None              # destinations readings are published to, see load_destinations()
+attr_sent = {}                # (destination name, authkey) -> [hash of attributes last accepted, time], see attributes_due()
+replayed = {}                 # cache file path -> [records already accepted by the server, inode, size, first record crc], see replay_cursor()
+
+def count(_key, _n=1):
+    #############################################################################
+    # Function: count                                                           #
+    # Purpose:  Adds _n to the named counter in the shared stats dictionary     #
+    # @param    _key       name of the counter                                  #
+    # @param    _n         amount to add                                        #
+    #                                                                           #
+    # @return   none                                                            #
+    #############################################################################
+    with lock:
+        stats[_key] = stats.get(_key, 0) + _n
+
+def setup_logging(_format="%(asctime)s - [%(levelname)s] [%(threadName)s] (%(module)s:%(lineno)d) %(message)s"):
+    #############################################################################
+    # Function: setup_logging                                                   #
+    # Purpose:  Sends log records through a queue to a background thread that   #
+    #           writes them to cfg.logfile, so logging never waits on the SD    #
+    #           card.  The file is rotated at midnight or by size as set in     #
+    #           cfg.logs['rotate'], and repeats of the same warning are         #
+    #           rate-limited by log_ratelimit().  With settings['debug'] other  #
+    #           than 0 or 1, logs go to the console instead                     #
+    # @param    _format    log record format                                    #
+    #                                                                           #
+    # @return   none                                                            #
+    #############################################################################
+    global log_listener
+    stop_logging()
+    for handler in logging.root.handlers[:]:
+        logging.root.removeHandler(handler)
+
+    if cfg.settings['debug'] == 0:
+        logging.root.setLevel(logging.INFO)
+    else:
+        logging.root.setLevel(logging.DEBUG)
+
+    if cfg.settings['debug'] not in (0, 1):
+        writer = logging.StreamHandler()
+    elif cfg.logs['rotate'] == 'size':
+        writer = logging.handlers.RotatingFileHandler(cfg.logfile, maxBytes=int(cfg.logs['rotate_mb'] * 2**20),
+                                                      backupCount=cfg.logs['backups'], delay=True)
+    else:
+        writer = logging.handlers.TimedRotatingFileHandler(cfg.logfile, when='midnight',
+                                                           backupCount=cfg.logs['backups'], delay=True)
+    writer.setFormatter(logging.Formatter(_format))
+
+    records = queue.Queue(-1)
+    handler = logging.handlers.QueueHandler(records)
+    handler.addFilter(log_ratelimit)
+    logging.root.addHandler(handler)
+    log_listener = logging.handlers.QueueListener(records, writer)
+    log_listener.start()
+
+def stop_logging():
+    #############################################################################
+    # Function: stop_logging                                                    #
+    # Purpose:  Writes out the log records still queued and stops the writer    #
+    #           thread, safe to call more than once                             #
+    # @param    none                                                            #
+    #                                                                           #
+    # @return   none                                                            #
+    #############################################################################
+    global log_listener
+    listener = log_listener
+    log_listener = None
+    if listener is not None:
+        listener.stop()
+        for handler in listener.handlers:
+            handler.close()
+
+atexit.register(stop_logging)
+
+def log_ratelimit(_record):
+    #############################################################################
+    # Function: log_ratelimit                                                   #
+    # Purpose:  Log filter - the same warning or error (same line of code and   #
+    #           same text) is logged at most once per cfg.logs['ratelimit']     #
+    #           seconds.  The next one logged says how many were suppressed in  #
+    #           between.  Records logged with extra={'ratelimit': False}, such  #
+    #           as threshold alarms, are never suppressed                       #
+    # @param    _record    log record                                           #
+    #                                                                           #
+    # @return   True if the record should be logged                             #
+    #############################################################################
+    if _record.levelno < logging.WARNING or cfg.logs['ratelimit'] <= 0 or not getattr(_record, 'ratelimit', True):
+        return True
+    key = (_record.pathname, _record.lineno, _record.getMessage())
+    now = time.time()
+    with log_lock:
+        if len(log_seen) > 1000:
+            # messages with changing text (counts, times) would otherwise pile up here
+            for old in [k for k, v in log_seen.items() if now - v[0] >= cfg.logs['ratelimit']]:
+                del log_seen[old]
+        seen = log_seen.get(key)
+        if seen is not None and now - seen[0] < cfg.logs['ratelimit']:
+            seen[1] = seen[1] + 1
+            return False
+        log_seen[key] = [now, 0]
+    if seen is not None and seen[1] > 0:
+        _record.msg = str(_record.msg) + ' (' + str(seen[1]) + ' similar messages suppressed)'
+    return True
+
 def c2f(t):
-    t = int(t)
+    t = float(t)
     ######################################################################################################
     # Function: c2f                                                                                      #
     # Purpose:  Convert degrees C to F                                                                   #
@@ -58,7 +199,7 @@ def c2f(t):
     return (t*9/5.0)+32
 
 def c2k(t):
-    t = int(t)
+    t = float(t)
     ######################################################################################################
     # Function: c2k                                                                                      #
     # Purpose:  Convert degrees C to K                                                                   #
@@ -70,7 +211,7 @@ def c2k(t):
     return t+273.15
 
 def f2c(t):
-    t = int(t)
+    t = float(t)
     ######################################################################################################
     # Function: f2c                                                                                      #
     # Purpose:  Convert degrees F to C                                                                   #
@@ -82,7 +223,7 @@ def f2c(t):
     return (t-32)*5.0/9
 
 def f2k(t):
-    t = int(t)
+    t = float(t)
     ######################################################################################################
     # Function: f2k                                                                                      #
     # Purpose:  Convert degrees F to K                                                                   #
@@ -94,7 +235,7 @@ def f2k(t):
     return (t+459.67)*5.0/9
 
 def k2c(t):
-    t = int(t)
+    t = float(t)
     ######################################################################################################
     # Function: k2c                                                                                      #
     # Purpose:  Convert degrees K to C                                                                   #
@@ -106,7 +247,7 @@ def k2c(t):
     return t-273.15
 
 def k2f(t):
-    t = int(t)
+    t = float(t)
     ######################################################################################################
     # Function: k2f                                                                                      #
     # Purpose:  Convert degrees K to F                                                                   #
@@ -117,6 +258,32 @@ def k2f(t):
     ######################################################################################################
     return (t*9/5.0)-459.67
 
+# scale and offset of each conversion above, new = old * scale + offset, used by convert_column()
+conversions = {
+    'c2f': (9/5.0, 32),
+    'c2k': (1.0, 273.15),
+    'f2c': (5/9.0, -32*5/9.0),
+    'f2k': (5/9.0, 459.67*5/9.0),
+    'k2c': (1.0, -273.15),
+    'k2f': (9/5.0, -459.67)
+    }
+
+def convert_column(_values, _conversion):
+    #############################################################################
+    # Function: convert_column                                                  #
+    # Purpose:  Converts a whole column of temperatures at once, with numpy if  #
+    #           it is installed.  Missing values (NaN) stay missing             #
+    # @param    _values    array('d') of temperatures                           #
+    # @param    _conversion name of the conversion - 'c2f', 'f2c', 'k2f', etc   #
+    #                                                                           #
+    # @return   array('d') of converted temperatures                            #
+    #############################################################################
+    scale, offset = conversions[_conversion]
+    if numpy is not None:
+        column = numpy.frombuffer(_values, dtype=numpy.float64) * scale + offset
+        return array('d', column.tobytes())
+    return array('d', [value * scale + offset for value in _values])
+
 def chk_cache():
     #############################################################################
     # Function: chk_cache                                                       #
@@ -131,10 +298,13 @@ def chk_cache():
     lines = 0
     chk_err = 1
     try:
-        for file in os.listdir(cfg.logs['cachedir']):
-            with open(cfg.logs['cachedir']+file) as f:
-                lines = lines + sum(1 for _ in f)
-            cache_ct = cache_ct + 1
+        for dest in destinations():
+            for file in os.listdir(dest['cachedir']):
+                if not file.endswith('.cache') or not os.path.isfile(dest['cachedir']+file):
+                    continue
+                with open(dest['cachedir']+file) as f:
+                    lines = lines + sum(1 for _ in f)
+                cache_ct = cache_ct + 1
             chk_err = 0
     except:
         print('Unable to read from '+cfg.logs['cachedir']+' in chk_cache: - '+ str(sys.exc_info()[0]))
@@ -147,65 +317,281 @@ def chk_cache():
     return (cache_ct, lines, chk_err)
 
 
+def cached_devices():
+    ##############################################################################
+    # Function: cached_devices                                                   #
+    # Purpose:  Lists the devices with cache files waiting in the cache          #
+    #           directory of any destination, by the authkey in the file name    #
+    # @param    none                                                             #
+    #                                                                            #
+    # @return   set of authkeys                                                  #
+    ##############################################################################
+    found = set()
+    for dest in destinations():
+        try:
+            for file in os.listdir(dest['cachedir']):
+                if file.endswith('.cache') and '_' in file:
+                    found.add(file.split('_')[0])
+        except OSError as e:
+            logging.warning('Unable to read from ' + dest['cachedir'] + ': ' + str(e))
+    return found
+
 def clear_cache(_authkey):
     ##############################################################################
     # Function: clear_cache                                                      #
+    # Purpose:  Replays the cache files of a device to every destination, each   #
+    #           from its own cache directory: the primary destination here, the  #
+    #           others in the background, so a destination that is down or slow  #
+    #           does not hold up the caller.  A replay still running from an     #
+    #           earlier call is left to finish rather than started again         #
+    # @param    authkey     device whose cache files are replayed                #
+    #                                                                            #
+    # @return   none                                                             #
+    ##############################################################################
+    found = destinations()
+    for dest in found[1:]:
+        if replay_start(dest, _authkey):
+            publish_pool().submit(replay_run, dest, _authkey)
+    if replay_start(found[0], _authkey):
+        replay_run(found[0], _authkey)
+
+def replay_start(_dest, _authkey):
+    ##############################################################################
+    # Function: replay_start                                                     #
+    # Purpose:  Claims the replay of a device's cache to a destination           #
+    # @param    _dest       destination, see destinations()                      #
+    # @param    _authkey    device whose cache files are replayed                #
+    #                                                                            #
+    # @return   True if no replay of it was running, and one may start           #
+    ##############################################################################
+    with lock:
+        if (_dest['name'], _authkey) in replaying:
+            return False
+        replaying.add((_dest['name'], _authkey))
+        return True
+
+def replay_run(_dest, _authkey):
+    ##############################################################################
+    # Function: replay_run                                                       #
+    # Purpose:  clear_cache_dest() for a replay claimed by replay_start()        #
+    ##############################################################################
+    try:
+        clear_cache_dest(_authkey, _dest)
+    finally:
+        with lock:
+            replaying.discard((_dest['name'], _authkey))
+
+def replay_cursor(_path, _cursor=None):
+    #############################################################################
+    # Function: replay_cursor                                                   #
+    # Purpose:  Returns how many records of a cache file the server has already #
+    #           accepted.  The cursor is only trusted while the file has the    #
+    #           inode and first record it was taken on and has not shrunk, so   #
+    #           a file deleted and created again, or rewritten, is replayed     #
+    #           from the start                                                  #
+    # @param    _path      cache file                                           #
+    # @param    _cursor    [records, inode, size, crc32 of the first record] to #
+    #                      check instead of the one held in replayed, as        #
+    #                      restored from a checkpoint                           #
+    #                                                                           #
+    # @return   records to skip, 0 if the cursor is missing or stale            #
+    #############################################################################
+    cursor = _cursor if _cursor is not None else replayed.get(_path)
+    if not cursor:
+        return 0
+    try:
+        st = os.stat(_path)
+        if st.st_ino == cursor[1] and st.st_size >= cursor[2] and replay_head(_path) == cursor[3]:
+            return int(cursor[0])
+    except (OSError, TypeError, ValueError, IndexError):
+        pass
+    replayed.pop(_path, None)
+    return 0
+
+def replay_advance(_path, _n):
+    #############################################################################
+    # Function: replay_advance                                                  #
+    # Purpose:  Moves the cursor of a cache file on by the records the server   #
+    #           has just accepted, noting what replay_cursor() checks it by     #
+    # @param    _path      cache file                                           #
+    # @param    _n         records accepted                                     #
+    #                                                                           #
+    # @return   none                                                            #
+    #############################################################################
+    try:
+        st = os.stat(_path)
+        head = replay_head(_path)
+    except OSError:
+        replayed.pop(_path, None)
+        return
+    replayed[_path] = [replay_cursor(_path) + _n, st.st_ino, st.st_size, head]
+
+def replay_head(_path):
+    #############################################################################
+    # Function: replay_head                                                     #
+    # Purpose:  Checksum of the first record of a cache file, which tells a     #
+    #           file created again on a reused inode from the one a cursor was  #
+    #           taken on, as each record starts with its timestamp              #
+    # @param    _path      cache file                                           #
+    #                                                                           #
+    # @return   crc32 of the first line                                         #
+    #############################################################################
+    with open(_path, 'rb') as f:
+        return zlib.crc32(f.readline())
+
+def clear_cache_dest(_authkey, _dest):
+    ##############################################################################
+    # Function: clear_cache_dest                                                 #
     # Purpose:  Looks for files in the cache directory, and if it finds them, it #
     #           tries to send them to the server.  It counts the lines in the    #
-    #           file, and passes them to the server one by one.  It counts the   #
-    #           number of HTTP:200 responses, and if the line count is the same, #
+    #           file, and passes them to the server in batches of replay_batch   #
+    #           records.  It counts the records in batches answered with         #
+    #           HTTP:200, and if the line count is the same,                     #
     #           then it will delete the file.  Telemetry will be sent to the     #
     #           appropriate device based on the cache file name                  #
     #                                                                            #
     # @param    authkey     Used to define which cache files are cleared so that #
     #                       that specific caching can be defined per sensor or   #
     #                       device without affecting others on the same system   #
+    # @param    _dest       destination, see destinations()                      #
     #                                                                            #
     # @return   none                                                             #
     ##############################################################################
-    logging.debug('Starting Clear Cache process for device ' + _authkey)
+    logging.debug('Starting Clear Cache process for device ' + _authkey + ' to destination ' + _dest['name'])
     ct_files = 0                  # used to count files in cache directory
     ct_lines = 0                  # used to count records in cache files
     ct_200 = 0                    # counts successful posting of cache records
     try:
-        for file in os.listdir(cfg.logs['cachedir']):
+        for file in os.listdir(_dest['cachedir']):
             authkey = (file.split('_'))
-            if _authkey == authkey[0]:
-                _tele = cfg.conn['method'] + '://' + cfg.conn['server'] +'/api/v1/'+_authkey +'/telemetry'
-                
-                with open(cfg.logs['cachedir']+file) as f:
+            # only whole cache files, never a copy left by a downsample_cache() that did not finish
+            if _authkey == authkey[0] and file.endswith('.cache'):
+                # the gateway method has no replay API of its own, its cache goes back over HTTP
+                _tele = (_dest['method'] if _dest['method'] != 'gateway' else 'http') + '://' + _dest['server'] +'/api/v1/'+_authkey +'/telemetry'
+
+                # records accepted on an earlier pass (or before a restart) are not sent again
+                path = _dest['cachedir'] + file
+                skip = replay_cursor(path)
+                done = True               # False once a batch is refused, the cursor stops there
+                with open(path) as f:
                     logging.debug('Starting Clear Cache process for device ' + _authkey)
+                    err = 0
+                    batch = []
                     for line in f:
+                        if not line.strip():
+                            continue
                         ct_lines = ct_lines + 1
-                        try:
-                            if cfg.conn['proxy'] == 1:
-                                r_cache = requests.post(_tele, data=line, headers=cfg.http_headers, proxies=cfg.proxies)   
-                            else:
-                                r_cache = requests.post(_tele, data=line, headers=cfg.http_headers)
-                            if r_cache.status_code == 200:
-                                ct_200 = ct_200 + 1
-                            err = 0
-                            
-                        except Exception as e:
-                            logging.error(e)
-                            logging.warn('Unexpected error in clear_cache: - '+ str(sys.exc_info()[0]))
-                            logging.warn('Unable to connect to server to clear cache.  No action taken')
-                            err = 1
+                        if skip > 0:
+                            skip = skip - 1
+                            ct_200 = ct_200 + 1
+                            continue
+                        batch.append(line.strip())
+                        if len(batch) >= cfg.logs['replay_batch']:
+                            sent, err = post_cache_batch(_tele, batch, _dest)
+                            ct_200 = ct_200 + sent
+                            done = done and sent == len(batch)
+                            if done:
+                                replay_advance(path, sent)
+                            batch = []
+                            if err == 1:
+                                # no point timing out once per remaining batch, try again next poll
+                                break
+                    if batch and err == 0:
+                        sent, err = post_cache_batch(_tele, batch, _dest)
+                        ct_200 = ct_200 + sent
+                        if done and sent == len(batch):
+                            replay_advance(path, sent)
                         
                 if err == 0:
                     ct_files = ct_files + 1
                     if ct_lines == ct_200:
-                        os.remove(cfg.logs['cachedir']+file)
-                        logging.info('Cache successfully cleared or device ' + authkey[0] +'. '+ str(ct_200) + ' records submitted')
+                        os.remove(path)
+                        replayed.pop(path, None)
+                        logging.info('Cache successfully cleared or device ' + authkey[0] +' to ' + _dest['name'] + '. '+ str(ct_200) + ' records submitted')
                     else:
                         print("Unexpected error in clear_cache:", sys.exc_info()[0])
                         logging.warn('Unexpected error in clear_cache: - '+ sys.exc_info()[0])
     except:
-        print('Unable to read from '+cfg.logs['cachedir']+' in clear_cache: - '+ str(sys.exc_info()[0]))
-        logging.warn('Unable to read from '+cfg.logs['cachedir']+' in clear_cache: - '+ str(sys.exc_info()[0]))
+        print('Unable to read from '+_dest['cachedir']+' in clear_cache: - '+ str(sys.exc_info()[0]))
+        logging.warn('Unable to read from '+_dest['cachedir']+' in clear_cache: - '+ str(sys.exc_info()[0]))
         return None
     return
 
+def post_cache_batch(_tele, _lines, _dest):
+    ##############################################################################
+    # Function: post_cache_batch                                                 #
+    # Purpose:  Sends a batch of cached records as one JSON array to a device's  #
+    #           telemetry URL                                                    #
+    # @param    _tele       telemetry URL of the device                          #
+    # @param    _lines      cached records, one JSON object each                 #
+    # @param    _dest       destination, see destinations()                      #
+    #                                                                            #
+    # @return   (records accepted, 1 if the server could not be reached,         #
+    #           answered with a 5xx error or its circuit is open, else 0)        #
+    ##############################################################################
+    # only asked once there is a batch to send, so every probe it lets through
+    # is followed by breaker_result()
+    if not breaker_allow(_dest['name']):
+        logging.debug('Circuit open for ' + _dest['name'] + ', leaving cache in place')
+        return (0, 1)
+    try:
+        r_cache = http_post(_tele, '[' + ','.join(_lines) + ']', _dest)
+        breaker_result(_dest['name'], r_cache.status_code < 500)
+    except Exception as e:
+        breaker_result(_dest['name'], False)
+        logging.error(e)
+        logging.warn('Unexpected error in clear_cache: - '+ str(sys.exc_info()[0]))
+        logging.warn('Unable to connect to server to clear cache.  No action taken')
+        return (0, 1)
+    if r_cache.status_code == 200:
+        return (len(_lines), 0)
+    if r_cache.status_code >= 500:
+        logging.warn('Server answered ' + str(r_cache.status_code) + ' while clearing cache, stopping until the next poll')
+        return (0, 1)
+    return (0, 0)
+
+def check_thresholds(_item, _message):
+    #############################################################################
+    # Function: check_thresholds                                                #
+    # Purpose:  Compares the reading against the sensor's temp_low/temp_high    #
+    #           attributes.  A sensor goes into 'low' or 'high' alarm as soon   #
+    #           as the value crosses a limit, and only returns to 'normal' once #
+    #           it is back inside by the 'hysteresis' setting, so a value       #
+    #           hovering around a limit does not flap.  Errors and stale        #
+    #           readings leave the state unchanged                              #
+    # @param    _item      sensor definition from config.py                     #
+    # @param    _message   telemetry gathered for the sensor                    #
+    #                                                                           #
+    # @return   (state, changed)  current alarm state, True if it just changed  #
+    #############################################################################
+    set = _item['settings']
+    label = _item['tele']['label']
+    key = set.get('alarm_key', 'temp' + label)
+    value = _message.get(key)
+    low = _item['attr'].get('temp_low')
+    high = _item['attr'].get('temp_high')
+    hysteresis = set.get('hysteresis', 1)
+    state = alarms.get(_item['id'], 'normal')
+
+    if not isinstance(value, (int, float)) or _message.get('stale' + label) == 1:
+        return (state, False)
+
+    new = state
+    if high is not None and value > high:
+        new = 'high'
+    elif low is not None and value < low:
+        new = 'low'
+    elif state == 'high' and (high is None or value <= high - hysteresis):
+        new = 'normal'                # back inside, or the limit was removed (by a reload, say)
+    elif state == 'low' and (low is None or value >= low + hysteresis):
+        new = 'normal'
+
+    alarms[_item['id']] = new
+    if new != state:
+        count('alarm_' + new)
+        logging.warning('Sensor ' + str(_item['id']) + ' "' + str(_item['attr'].get('name')) + '" ' + key + '=' + str(value) + ' is now ' + new + ' (was ' + state + ', limits ' + str(low) + '/' + str(high) + ')', extra={'ratelimit': False})
+    return (new, new != state)
+
 def read_ds18b20(_device,_label):
     #############################################################################
     # Function: read_ds18b20                                                    #
@@ -245,71 +631,245 @@ def read_ds18b20(_device,_label):
     
     return ds18b20
 
+def owm_query(_device):
+    #############################################################################
+    # Function: owm_query                                                       #
+    # Purpose:  Builds the location part of an OpenWeatherMaps request.  A      #
+    #           device of 'id:<city id>' is looked up by city ID (which also    #
+    #           allows group requests), anything else is treated as a ZIP code  #
+    # @param    _device    ZIP code or 'id:' city ID from the sensor config     #
+    #                                                                           #
+    # @return   query string to append to cfg.owm_url                           #
+    #############################################################################
+    if _device.startswith('id:'):
+        return '&id=' + _device[3:]
+    return '&zip=' + _device
+
+def fetch_owm_job(_job):
+    #############################################################################
+    # Function: fetch_owm_job                                                   #
+    # Purpose:  Runs a single request for fetch_owm(), either one group request #
+    #           for up to owm_group_max city IDs, or one ZIP code lookup        #
+    # @param    _job       ('group', [city ids]) or ('zip', device)             #
+    #                                                                           #
+    # @return   dict of device -> parsed OpenWeatherMaps response               #
+    #############################################################################
+    found = {}
+    try:
+        if _job[0] == 'group':
+            f = http_get(cfg.owm_group_url + '&id=' + ','.join(_job[1]))
+        else:
+            f = http_get(cfg.owm_url + owm_query(_job[1]))
+        if f.status_code != 200:
+            logging.warning('Connection to weather data failed, returned code: ' + str(f.status_code))
+            return found
+        parsed_json = json.loads(f.text)
+    except Exception as e:
+        logging.warning('Error in gathering weather information in fetch_owm: - ' + str(e))
+        return found
+
+    if _job[0] == 'group':
+        for item in parsed_json.get('list', []):
+            found['id:' + str(item['id'])] = item
+    else:
+        found[_job[1]] = parsed_json
+    return found
+
+def fetch_owm(_devices):
+    #############################################################################
+    # Function: fetch_owm                                                       #
+    # Purpose:  Fetches current conditions for every OpenWeatherMaps location   #
+    #           used in this poll in as few requests as possible: city IDs go   #
+    #           out in group requests, ZIP codes (which have no group API) are  #
+    #           requested concurrently, and duplicate locations only once.      #
+    #           read_owmapi() then answers from these results                   #
+    # @param    _devices   list of 'device' values of the active owm sensors    #
+    #                                                                           #
+    # @return   none                                                            #
+    #############################################################################
+    devices = sorted(set(_devices))
+    ids = [d[3:] for d in devices if d.startswith('id:')]
+    jobs = [('zip', d) for d in devices if not d.startswith('id:')]
+    for i in range(0, len(ids), cfg.owm_settings['owm_group_max']):
+        jobs.append(('group', ids[i:i + cfg.owm_settings['owm_group_max']]))
+
+    fresh = {}
+    if jobs:
+        with ThreadPoolExecutor(max_workers=cfg.owm_settings['owm_workers']) as pool:
+            for found in pool.map(fetch_owm_job, jobs):
+                fresh.update(found)
+        count('owm_requests', len(jobs))
+        logging.debug('Fetched weather for ' + str(len(fresh)) + ' of ' + str(len(devices)) + ' locations in ' + str(len(jobs)) + ' requests')
+    with lock:
+        owm_cycle.clear()
+        owm_cycle.update(fresh)
+
+def clear_owm():
+    #############################################################################
+    # Function: clear_owm                                                       #
+    # Purpose:  Forgets the results of fetch_owm() once the poll that fetched   #
+    #           them is over, so samples and adaptive reads taken between polls #
+    #           request current conditions rather than reusing old ones         #
+    # @param    none                                                            #
+    #                                                                           #
+    # @return   none                                                            #
+    #############################################################################
+    with lock:
+        owm_cycle.clear()
+
+def parse_owm(_parsed_json,_label):
+    #############################################################################
+    # Function: parse_owm                                                       #
+    # Purpose:  Converts an OpenWeatherMaps current conditions response into    #
+    #           telemetry and attributes                                        #
+    # @param    _parsed_json   decoded response for a single location           #
+    # @param    _label         appended to the temp value key                   #
+    #                                                                           #
+    # @return   conditions    current conditions as list of dictionaries        #
+    #############################################################################
+    parsed_json = _parsed_json
+    temp = int(((parsed_json['main']['temp'])*9/5.0)-459.67)
+    if int(parsed_json['wind']['speed']) >=3 and int(temp) <= 50:
+        T = temp
+        V = int(parsed_json['wind']['speed'])
+        windchill = int(35.74 + (0.6215*T) - 35.75*(V**0.16) + 0.4275*T*(V**0.16))
+    else:
+        windchill = temp
+    if windchill >= temp:
+        windshill = temp
+        
+    conditions = { 'tele': {
+                      'temp'+_label: int(temp),
+                      'humidity': int(parsed_json['main']['humidity']),
+                      'wind_speed': parsed_json['wind']['speed'],
+                      'wind_direction': parsed_json['wind'].get('deg', 'na'),
+                      'wind_chill': windchill,
+                      'visibility': parsed_json.get('visibility', 'na'),
+                      'pressure': int(parsed_json['main']['pressure'])
+                      },
+                   'attr': {
+                       'latitude': parsed_json['coord']['lat'],
+                       'longitude': parsed_json['coord']['lon']
+                       }
+                   }
+    return conditions
+
 def read_owmapi(_device,_label):
     #############################################################################
     # Function: read_owmapi                                                     #
     # Purpose:  Connects to OpenWeatherMaps service and downloads the current   #
     #           conditions for the ZIP code defined in _device.  Once obtained, #
-    #           it is parsed into more easily consumed data                     #
+    #           it is parsed into more easily consumed data.  If fetch_owm()    #
+    #           already got this location during the current poll, no request   #
+    #           is made                                                         #
     # @param    _device    Defines the location ZIP code to be polled for       #
     #                      current conditions.                                  #
     #                                                                           #
     # @return   conditions    current conditions as list of dictionaries        #
     #############################################################################
-     # Connect to OpenWeatherMaps and get information for the defined ZIP code
-     try:
-         if cfg.conn['proxy'] == 1:
-            f = requests.get(cfg.owm_url+'&zip='+_device, proxies=cfg.proxies)
-         else:
-            f = requests.get(cfg.owm_url+'&zip='+_device)
-         if f.status_code != 200:
-            logging.warn('Connection to weather data failed, returned code:'+f.status_code)
-            temp = 'na'
-            err = 1
-         else:
-            err = 0
-     except:
-        logging.warn('Error in gathering weather information in read_owmapi: - '+ str(sys.exc_info()[0]))
-        err = 1
-        conditions = { 'tele': {
-                           'temp'+_label: 'error'
-                           }
-                       }
-     
-     if err == 0:
-        parsed_json = json.loads(f.text)
+    with lock:
+        parsed_json = owm_cycle.get(_device)
 
-        temp = int(((parsed_json['main']['temp'])*9/5.0)-459.67)
-        if int(parsed_json['wind']['speed']) >=3 and int(temp) <= 50:
-            T = temp
-            V = int(parsed_json['wind']['speed'])
-            windchill = int(35.74 + (0.6215*T) - 35.75*(V**0.16) + 0.4275*T*(V**0.16))
-        else:
-            windchill = temp
-        if windchill >= temp:
-            windshill = temp
-            
-        conditions = { 'tele': {
-                          'temp'+_label: int(temp),
-                          'humidity': int(parsed_json['main']['humidity']),
-                          'wind_speed': parsed_json['wind']['speed'],
-                          'wind_direction': parsed_json['wind']['deg'],
-                          'wind_chill': windchill,
-                          'visibility': parsed_json['visibility'],
-                          'pressure': int(parsed_json['main']['pressure'])
-                          },
-                       'attr': {
-                           'latitude': parsed_json['coord']['lat'],
-                           'longitude': parsed_json['coord']['lon']
-                           }
-                       }
-     return conditions
+    # Connect to OpenWeatherMaps and get information for the defined ZIP code
+    if parsed_json is None:
+        try:
+            f = http_get(cfg.owm_url + owm_query(_device))
+            if f.status_code != 200:
+                logging.warn('Connection to weather data failed, returned code: ' + str(f.status_code))
+            else:
+                parsed_json = json.loads(f.text)
+        except:
+            logging.warn('Error in gathering weather information in read_owmapi: - '+ str(sys.exc_info()[0]))
+
+    if parsed_json is None:
+        return { 'tele': {
+                     'temp'+_label: 'error'
+                     }
+                 }
+    return parse_owm(parsed_json,_label)
 
 def read_sensor(_device,_type,_label):
     #############################################################################
     # Function: read_sensor                                                     #
+    # Purpose:  Runs read_source() for the device in its own worker thread and  #
+    #           waits at most cfg.read_timeouts[_type] seconds for it.  If the  #
+    #           source hangs, the last good reading is returned with 'stale'    #
+    #           set, and no new read is started for that device until the hung  #
+    #           one finishes, so one bad source cannot stall the polling loop   #
+    # @param    _device    Defines the device that is to be queried by the      #
+    #                      appropriate function                                 #
+    # @param    _type      Used to determine the appropriate function to process#
+    #                      the device in _device                                #
+    # @param    _label     value appended temp value key (temp_[_label]         #
+    #                                                                           #
+    # @return   conditions  current conditions as list of dict                  #
+    #############################################################################
+    key = (_type, _device, _label)
+    deadline = cfg.read_timeouts.get(_type, cfg.read_timeouts['default'])
+
+    with lock:
+        job = readers.get(key)
+        busy = job is not None and not job['done'].is_set()
+        if not busy:
+            job = {'done': threading.Event(), 'result': None, 'started': time.time()}
+            readers[key] = job
+    if busy:
+        logging.warning('Previous ' + _type + ' read of "' + _device + '" still running after ' + str(int(time.time() - job['started'])) + ' seconds, using last reading')
+        count('read_hung')
+        return read_stale(key, _label)
+
+    def worker():
+        try:
+            job['result'] = read_source(_device, _type, _label)
+        except Exception as e:
+            logging.error('Unexpected error reading ' + _type + ' device "' + _device + '": ' + str(e))
+        job['done'].set()
+
+    threading.Thread(target=worker, name='read-' + _type, daemon=True).start()
+    if not job['done'].wait(deadline):
+        logging.warning(_type + ' read of "' + _device + '" timed out after ' + str(deadline) + ' seconds, using last reading')
+        count('read_timeout')
+        count('read_timeout_' + _type)
+        return read_stale(key, _label)
+
+    conditions = job['result']
+    if conditions is None:
+        return read_stale(key, _label)
+    if 'error' not in conditions['tele'].values():
+        with lock:
+            last_read[key] = conditions
+    return conditions
+
+def read_stale(_key, _label):
+    #############################################################################
+    # Function: read_stale                                                      #
+    # Purpose:  Builds the reading returned when a source misses its deadline:  #
+    #           a copy of the last good reading, flagged as stale               #
+    # @param    _key       (type, device, label) of the source                  #
+    # @param    _label     value appended to the stale flag key                 #
+    #                                                                           #
+    # @return   conditions  last known conditions, or an error reading          #
+    #############################################################################
+    count('read_stale')
+    with lock:
+        last = last_read.get(_key)
+    if last is None:
+        return { 'tele': {
+                     'temp'+_label: 'error',
+                     'stale'+_label: 1
+                     }}
+    conditions = {'tele': dict(last['tele'])}
+    if 'attr' in last:
+        conditions['attr'] = dict(last['attr'])
+    conditions['tele']['stale'+_label] = 1
+    return conditions
+
+def read_source(_device,_type,_label):
+    #############################################################################
+    # Function: read_source                                                     #
     # Purpose:  Reads the type of sensor that is being requested, and calls the #
-    #           appropriate function for that device.                           #
+    #           appropriate function for that device.  Runs in a worker thread, #
+    #           use read_sensor() to get a reading under a deadline             #
     # @param    _device    Defines the device that is to be queried by the      #
     #                      appropriate function                                 #
     # @param    _type      Used to determine the appropriate function to process#
@@ -337,6 +897,46 @@ def read_sensor(_device,_type,_label):
                         }
     return conditions
 
+def read_cpu_temp():
+    #############################################################################
+    # Function: read_cpu_temp                                                   #
+    # Purpose:  Reads the CPU temperature reported by the Raspberry Pi firmware #
+    # @param    none                                                            #
+    #                                                                           #
+    # @return   cpu_temp   temperature in *F, or 'N/A' where not available      #
+    #############################################################################
+    if os.name != 'posix':
+        return 'N/A'
+    try:
+        process = Popen(['vcgencmd', 'measure_temp'], stdout=PIPE)
+        output, _error = process.communicate()
+        output = output.decode('utf-8', 'replace')          # temp=48.3'C
+        temp_c = float(output[output.index('=') + 1:output.rindex("'")])
+    except (OSError, ValueError) as e:
+        # not a Raspberry Pi, or vcgencmd is missing or has no access to the firmware
+        logging.debug('Unable to read the CPU temperature: ' + str(e))
+        return 'N/A'
+    temp_f = 9.0/5.0 * temp_c + 32
+    cpu_temp = round(temp_f,1)
+    return cpu_temp
+
+def read_sys_sample():
+    #############################################################################
+    # Function: read_sys_sample                                                 #
+    # Purpose:  Quick version of read_sys_stats for high rate sampling - no     #
+    #           attributes and no waiting, CPU use is measured since the        #
+    #           previous call                                                   #
+    # @param    none                                                            #
+    #                                                                           #
+    # @return   current system telemetry as dict                                #
+    #############################################################################
+    return {
+        'cpu_temp': read_cpu_temp(),
+        'cpu_used': psutil.cpu_percent(interval=None),
+        'ram_used': psutil.virtual_memory().percent,
+        'disk_used': psutil.disk_usage('/').percent
+        }
+
 def read_sys_stats():
     #############################################################################
     # Function: read_sys_stats                                                  #
@@ -357,14 +957,7 @@ def read_sys_stats():
     disk_free = disk.free / 2**30
     disk_percent_used = disk.percent
     
-    if os.name == 'posix':
-        process = Popen(['vcgencmd', 'measure_temp'], stdout=PIPE)
-        output, _error = process.communicate()
-        temp_c = float(output[output.index('=') + 1:output.rindex("'")])
-        temp_f = 9.0/5.0 * temp_c + 32
-        cpu_temp = round(temp_f,1)
-    else:
-        cpu_temp = 'N/A'
+    cpu_temp = read_cpu_temp()
     
     lastboot = datetime.datetime.fromtimestamp(psutil.boot_time()).strftime("%Y-%m-%d %H:%M:%S")
     c = time.time() - psutil.boot_time()
@@ -414,10 +1007,7 @@ def read_wund(_device,_label):
     #############################################################################
     logging.debug('Pulling weather information for zipcode: ' + _device)
     try:
-         if cfg.conn['proxy'] == 1:
-            f = requests.get(cfg.wund_url+_device+'.'+cfg.wund_settings['wund_format'], proxies=cfg.proxies)
-         else:
-            f = requests.get(cfg.wund_url+_device+'.'+cfg.wund_settings['wund_format'])
+         f = http_get(cfg.wund_url+_device+'.'+cfg.wund_settings['wund_format'])
          if f.status_code != 200:
             logging.warn('Connection to weather data failed, returned code:'+conditions.status_code)
             temp = 'na'
@@ -458,7 +1048,7 @@ def read_wund(_device,_label):
         
     return wund
 
-def write_cache(_record,_authkey):
+def write_cache(_record,_authkey,_dest=None):
     # write_cache(_cache,_authkey)
     #############################################################################
     # Function: writeevt                                                        #
@@ -469,19 +1059,23 @@ def write_cache(_record,_authkey):
     # @param        _sev              log severity (WARN, INFO, etc)            #
     # @param        _authkey          authkey when used for caching telemetry   #
     # @param        _name             name of the device in question, for log   #
+    # @param        _dest             destination whose cache is written,       #
+    #                                 default the first one                     #
     #                                                                           #
     #       @return none                                                        #
     #############################################################################
-
-    _outfile = cfg.logs['cachedir'] + _authkey +"_" + time.strftime("%Y-%m-%d") + '.cache'
+    if _dest is None:
+        _dest = destinations()[0]
+    _outfile = _dest['cachedir'] + _authkey +"_" + time.strftime("%Y-%m-%d") + '.cache'
     _entry = _record
     logging.debug('Writing cache record to '+_outfile)
 
     try: 
-        outfile=open((_outfile),"a")
-        outfile.write(_entry)
-        outfile.write("\n")
-        outfile.close()
+        with cache_lock:
+            outfile=open((_outfile),"a")
+            outfile.write(_entry)
+            outfile.write("\n")
+            outfile.close()
         log_err = 0
         logging.debug('Cache written successfully to  '+_outfile)
     except Exception as e:
@@ -491,8 +1085,294 @@ def write_cache(_record,_authkey):
         
     return log_err
 
+def trim_cache():
+    #############################################################################
+    # Function: trim_cache                                                      #
+    # Purpose:  Keeps the cache directory within the 'cache_max_mb' (total) and #
+    #           'cache_max_mb_key' (per authkey) budgets so an outage cannot    #
+    #           fill the SD card.  Over budget, the oldest file is reduced      #
+    #           first: with the 'downsample' policy its old records are thinned #
+    #           per the 'downsample' tiers, and once that frees nothing more    #
+    #           (or with the 'oldest' policy) the file is deleted.  Each        #
+    #           destination's cache directory has its own budget                #
+    # @param    none                                                            #
+    #                                                                           #
+    # @return   none                                                            #
+    #############################################################################
+    for dest in destinations():
+        trim_cache_dir(dest['cachedir'])
+
+def trim_cache_dir(cachedir):
+    #############################################################################
+    # Function: trim_cache_dir                                                  #
+    # Purpose:  trim_cache() for one cache directory, first removing copies     #
+    #           left by a downsample_cache() that was interrupted               #
+    # @param    cachedir   cache directory to keep within budget                #
+    #                                                                           #
+    # @return   none                                                            #
+    #############################################################################
+    try:
+        names = os.listdir(cachedir)
+    except OSError as e:
+        logging.warning('Unable to read from ' + cachedir + ' in trim_cache: ' + str(e))
+        return
+    # copies left by a downsample_cache() that was interrupted (one still being written is recent)
+    for name in names:
+        if name.endswith('.cache.tmp'):
+            try:
+                if time.time() - os.path.getmtime(cachedir + name) > stale_tmp:
+                    os.remove(cachedir + name)
+                    logging.warning('Removed unfinished downsample copy ' + name)
+            except OSError:
+                pass
+    files = [f for f in names if f.endswith('.cache') and os.path.isfile(cachedir + f)]
+    # oldest first - names end in the date, so sort on that rather than the authkey
+    files.sort(key=lambda f: (f.rsplit('_', 1)[-1], f))
+    sizes = dict((f, os.path.getsize(cachedir + f)) for f in files)
+    thinned = set()
+
+    def reduce(_file):
+        if cfg.logs['cache_policy'] == 'downsample' and _file not in thinned:
+            thinned.add(_file)
+            sizes[_file] = downsample_cache(cachedir + _file)
+            return
+        with cache_lock:
+            os.remove(cachedir + _file)
+            replayed.pop(cachedir + _file, None)
+        count('cache_evicted_files')
+        sizes.pop(_file)
+        files.remove(_file)
+        logging.warning('Cache over budget, deleted ' + _file)
+
+    key_budget = cfg.logs['cache_max_mb_key'] * 2**20
+    if key_budget > 0:
+        for authkey in set(f.split('_')[0] for f in files):
+            while True:
+                mine = [f for f in files if f.split('_')[0] == authkey]
+                if not mine or sum(sizes[f] for f in mine) <= key_budget:
+                    break
+                reduce(next((f for f in mine if f not in thinned), mine[0]))
+
+    budget = cfg.logs['cache_max_mb'] * 2**20
+    while budget > 0 and files and sum(sizes.values()) > budget:
+        reduce(next((f for f in files if f not in thinned), files[0]))
+
+def downsample_cache(_path):
+    #############################################################################
+    # Function: downsample_cache                                                #
+    # Purpose:  Thins out the old records of a cache file: for each [age, step] #
+    #           tier in cfg.logs['downsample'], records older than 'age'        #
+    #           seconds are kept only once per 'step' seconds for each set of   #
+    #           keys, so sensors sharing an authkey each keep their readings.   #
+    #           The thinned copy is written without holding cache_lock, which   #
+    #           is only taken to add records written meanwhile and swap files   #
+    # @param    _path      cache file to thin out                               #
+    #                                                                           #
+    # @return   new size of the file in bytes                                   #
+    #############################################################################
+    now = time.time() * 1000
+    tiers = sorted(cfg.logs['downsample'], reverse=True)       # oldest tier first
+    kept = 0
+    dropped = 0
+    last = {}
+    done = 0                                                  # bytes of the file thinned so far
+    with open(_path, 'rb') as f, open(_path + '.tmp', 'wb') as out:
+        for line in f:
+            if not line.endswith(b'\n'):
+                break                                         # still being written, copied below
+            done = done + len(line)
+            try:
+                record = json.loads(line.decode('utf-8'))
+                ts = float(record['ts'])
+                keys = tuple(sorted(record['values']))
+            except (ValueError, KeyError, TypeError, AttributeError):
+                continue                                      # unreadable records are not worth keeping
+            step = next((t[1] for t in tiers if now - ts > t[0] * 1000), 0)
+            if step > 0:
+                slot = int(ts // (step * 1000))
+                if last.get((step, keys)) == slot:
+                    dropped = dropped + 1
+                    continue
+                last[(step, keys)] = slot
+            out.write(line)
+            kept = kept + 1
+    with cache_lock:
+        # records appended by write_cache() while thinning are kept as they are
+        with open(_path, 'rb') as f, open(_path + '.tmp', 'ab') as out:
+            f.seek(done)
+            out.write(f.read())
+        os.replace(_path + '.tmp', _path)
+        replayed.pop(_path, None)                             # the line numbers no longer match
+    count('cache_downsampled_records', dropped)
+    logging.warning('Cache over budget, downsampled ' + _path + ': kept ' + str(kept) + ', dropped ' + str(dropped) + ' records')
+    return os.path.getsize(_path)
+
+def breaker_allow(_name):
+    #############################################################################
+    # Function: breaker_allow                                                   #
+    # Purpose:  Decides if a request to the server may be attempted.  Closed:   #
+    #           always.  Open: never, until the backoff expires, at which point #
+    #           the breaker goes half-open and lets exactly one probe through.  #
+    #           Every allowed request must be followed by breaker_result()      #
+    # @param    _name      destination the request is going to, by name, as two #
+    #                      destinations on one host may not be equally healthy  #
+    #                                                                           #
+    # @return   True if the request may go to the network                       #
+    #############################################################################
+    with lock:
+        brk = breakers.setdefault(_name, {'state': 'closed', 'failures': 0, 'backoff': 0, 'retry_at': 0})
+        if brk['state'] == 'closed':
+            return True
+        if brk['state'] == 'open' and time.time() >= brk['retry_at']:
+            brk['state'] = 'half-open'
+            logging.info('Circuit for ' + _name + ' is half-open, sending probe request')
+            return True
+    count('breaker_fastfail')
+    return False
+
+def breaker_result(_name, _ok):
+    #############################################################################
+    # Function: breaker_result                                                  #
+    # Purpose:  Records the outcome of a request allowed by breaker_allow().    #
+    #           Enough consecutive failures (or a failed probe) open the        #
+    #           breaker with exponential backoff and jitter; a success closes it#
+    # @param    _name      destination the request went to, by name             #
+    # @param    _ok        True if the server answered, False on timeout/error  #
+    #                                                                           #
+    # @return   none                                                            #
+    #############################################################################
+    with lock:
+        brk = breakers.setdefault(_name, {'state': 'closed', 'failures': 0, 'backoff': 0, 'retry_at': 0})
+        if _ok:
+            if brk['state'] != 'closed':
+                logging.info('Circuit for ' + _name + ' closed, server is responding again')
+            brk.update({'state': 'closed', 'failures': 0, 'backoff': 0})
+            return
+        if brk['state'] == 'open':
+            return                    # a request that started before the breaker tripped
+        brk['failures'] = brk['failures'] + 1
+        if brk['state'] == 'half-open' or brk['failures'] >= cfg.breaker['failures']:
+            if brk['backoff'] == 0:
+                brk['backoff'] = cfg.breaker['backoff']
+            else:
+                brk['backoff'] = min(brk['backoff'] * 2, cfg.breaker['backoff_max'])
+            wait = brk['backoff'] * (1 + random.uniform(-cfg.breaker['jitter'], cfg.breaker['jitter']))
+            brk['state'] = 'open'
+            brk['retry_at'] = time.time() + wait
+            stats['breaker_open'] = stats.get('breaker_open', 0) + 1
+    if brk['state'] == 'open':
+        logging.warning('Circuit for ' + _name + ' open after ' + str(brk['failures']) + ' failures, retrying in ' + str(round(wait, 1)) + ' seconds')
+
+def destinations():
+    #############################################################################
+    # Function: destinations                                                    #
+    # Purpose:  Lists the servers readings are published to, as built by        #
+    #           load_destinations() (on first use, and again when the           #
+    #           configuration is reloaded)                                      #
+    # @param    none                                                            #
+    #                                                                           #
+    # @return   list of destination dicts                                       #
+    #############################################################################
+    found = dest_list
+    if found is None:
+        found = load_destinations()
+    return found
+
+def load_destinations():
+    #############################################################################
+    # Function: load_destinations                                               #
+    # Purpose:  Builds the list of destinations from the configuration: conn    #
+    #           itself, named 'primary' and cached in cachedir, then every      #
+    #           entry of conn['destinations'] - its settings over those of      #
+    #           conn, cached in cachedir/<name>/ (created if missing)           #
+    # @param    none                                                            #
+    #                                                                           #
+    # @return   list of destination dicts                                       #
+    #############################################################################
+    global dest_list
+    primary = dict(cfg.conn, name='primary', cachedir=cfg.logs['cachedir'])
+    primary.pop('destinations', None)
+    found = [primary]
+    for extra in cfg.conn.get('destinations', []):
+        dest = dict(primary)
+        dest.update(extra)
+        dest['cachedir'] = cfg.logs['cachedir'] + extra['name'] + '/'
+        if not os.path.isdir(dest['cachedir']):
+            os.makedirs(dest['cachedir'])
+        found.append(dest)
+    dest_list = found
+    return found
+
+def http_post(_url, _data, _dest=None):
+    #############################################################################
+    # Function: http_post                                                       #
+    # Purpose:  Single place where records are POSTed to the server, so that    #
+    #           proxy settings and connect/read deadlines are always applied.   #
+    #           Each destination keeps its own pool of connections              #
+    # @param    _url       full URL to post to                                  #
+    # @param    _data      request body                                         #
+    # @param    _dest      destination posted to, default the first one         #
+    #                                                                           #
+    # @return   requests response object, raises on connection errors/timeouts  #
+    #############################################################################
+    if _dest is None:
+        _dest = destinations()[0]
+    with lock:
+        session = sessions.get(_dest['name'])
+        if session is None:
+            session = sessions[_dest['name']] = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(pool_maxsize=max(cfg.pipeline['workers'], 1))
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+    timeout = (_dest['timeout_connect'], _dest['timeout_read'])
+    _data, headers = compress(_data)
+    if _dest['proxy'] == 1:
+        proxies = {'http': _dest['proxy_http'], 'https': _dest['proxy_https']}
+        return session.post(_url, data=_data, headers=headers, proxies=proxies, timeout=timeout)
+    return session.post(_url, data=_data, headers=headers, timeout=timeout)
+
+def compress(_data):
+    #############################################################################
+    # Function: compress                                                        #
+    # Purpose:  Compresses a request body with gzip or deflate as set in        #
+    #           cfg.compression, when it is at least 'min_size' bytes, and      #
+    #           counts the bytes saved in stats                                 #
+    # @param    _data      request body                                         #
+    #                                                                           #
+    # @return   (body, headers)  body to send and the headers to send it with   #
+    #############################################################################
+    method = cfg.compression['method']
+    if method not in ('gzip', 'deflate') or _data is None:
+        return (_data, cfg.http_headers)
+    raw = _data.encode('utf-8') if isinstance(_data, str) else _data
+    if len(raw) < cfg.compression['min_size']:
+        return (_data, cfg.http_headers)
+    if method == 'gzip':
+        body = gzip.compress(raw, cfg.compression['level'])
+    else:
+        body = zlib.compress(raw, cfg.compression['level'])
+    count('bytes_raw', len(raw))
+    count('bytes_sent', len(body))
+    count('bytes_saved', len(raw) - len(body))
+    headers = dict(cfg.http_headers)
+    headers['Content-Encoding'] = method
+    return (body, headers)
+
+def http_get(_url):
+    #############################################################################
+    # Function: http_get                                                        #
+    # Purpose:  GET used by the weather API readers, with the proxy settings    #
+    #           and connect/read deadlines applied                              #
+    # @param    _url       full URL to request                                  #
+    #                                                                           #
+    # @return   requests response object, raises on connection errors/timeouts  #
+    #############################################################################
+    timeout = (cfg.conn['timeout_connect'], cfg.conn['timeout_read'])
+    if cfg.conn['proxy'] == 1:
+        return requests.get(_url, proxies=cfg.proxies, timeout=timeout)
+    return requests.get(_url, timeout=timeout)
 
-def publish(_attr, _message,_authkey,_cache_on_err,_localonly):
+def publish(_attr, _message,_authkey,_cache_on_err,_localonly,_ts=None):
     logging.debug('Starting publish function')
     ##############################################################################
     # Function: publish                                                          #
@@ -503,53 +1383,338 @@ def publish(_attr, _message,_authkey,_cache_on_err,_localonly):
     # @param    _message           client-side telemetry to be published         #
     # @param    _method            transportation method to the server           #
     # @param    _cache_on_err      if connection down, cache to disk             #
+    # @param    _ts                time the reading was taken in ms, default now #
     #                                                                            #
     #       @return status             indicator of status - temp                #
     ##############################################################################
+    if _ts is None:
+        _ts = encode.now_ms()
+    return publish_batch(_attr, [encode.record(_ts, _message)], _authkey, _cache_on_err, _localonly)
 
-    _cache = '{"ts":' + str(time.time() * 1000) + ', "values":' + json.dumps(_message) + '}'
-    logging.debug('method: ' + cfg.conn['method'])
-    logging.debug('message: ' + str(_message))
+def publish_batch(_attr, _lines,_authkey,_cache_on_err,_localonly,_dest=None):
+    ##############################################################################
+    # Function: publish_batch                                                    #
+    # Purpose:  Publishes several timestamped readings for one device in a       #
+    #           single telemetry request (plus one attribute request).  If       #
+    #           configured to do local only, or if it is unable to connect to the#
+    #           server, the readings are written to cache files.  Without a      #
+    #           destination, the readings go to the primary destination here     #
+    #           and to the others in the background, so a slow destination       #
+    #           never holds up the caller                                        #
+    # @param    _attr              client side attributes to be published        #
+    # @param    _lines             readings encoded by encode.record(), sent as  #
+    #                                  one JSON array and cached one per line    #
+    # @param    _authkey           device the readings belong to                 #
+    # @param    _cache_on_err      if connection down, cache to disk             #
+    # @param    _localonly         if 1, only write to the cache                 #
+    # @param    _dest              destination, default all of them              #
+    #                                                                            #
+    #       @return status             indicator of status - temp                #
+    ##############################################################################
+    if _dest is None:
+        found = destinations()
+        for dest in found[1:]:
+            if fanout_reserve(dest, len(_lines)):
+                publish_pool().submit(fanout_run, dest, len(_lines), _attr, _lines, _authkey, _cache_on_err, _localonly)
+            elif _cache_on_err == 1 or _localonly == 1:
+                write_cache('\n'.join(_lines), _authkey, dest)
+            else:
+                logging.warn('Record not written to cache due to configuration')
+        return publish_batch(_attr, _lines, _authkey, _cache_on_err, _localonly, found[0])
+
+    _cache = '\n'.join(_lines)
+    logging.debug('method: ' + _dest['method'] + ', destination: ' + _dest['name'])
+    logging.debug('message: ' + _cache)
     logging.debug('attributes' + str(_attr))
 
     if _localonly == 1:
         logging.debug('Local only configuration, writing cache to disk.')
-        pub_err = write_cache(_cache,_authkey)
+        pub_err = write_cache(_cache,_authkey,_dest)
     
-    elif cfg.conn['method'] == 'http':
-            logging.debug('Writing cache to server - ' + str(_message))
+    elif _dest['method'] == 'http' and not breaker_allow(_dest['name']):
+        logging.debug('Circuit open for ' + _dest['name'] + ', skipping network')
+        if _cache_on_err == 1:
+            write_cache(_cache,_authkey,_dest)
+        else:
+            logging.warn('Record not written to cache due to configuration')
+        pub_err = 1
+
+    elif _dest['method'] == 'http':
+            logging.debug('Writing cache to server - ' + str(len(_lines)) + ' readings')
             url = {
-                'attr': cfg.conn['method'] + '://' + cfg.conn['server'] +'/api/v1/'+ _authkey +'/attributes',
-                'tele': cfg.conn['method'] + '://' + cfg.conn['server'] +'/api/v1/'+ _authkey +'/telemetry',
+                'attr': _dest['method'] + '://' + _dest['server'] +'/api/v1/'+ _authkey +'/attributes',
+                'tele': _dest['method'] + '://' + _dest['server'] +'/api/v1/'+ _authkey +'/telemetry',
                 }
             try:
-                if cfg.conn['proxy'] == 1:
-                    r_attr = requests.post(url['attr'], data=json.dumps(_attr), headers=cfg.http_headers, proxies=cfg.proxies)
-                    r_tele = requests.post(url['tele'], data=json.dumps(_message), headers=cfg.http_headers, proxies=cfg.proxies)   
-                else:
-                    r_tele = requests.post(url['tele'], data=json.dumps(_message), headers=cfg.http_headers)
-                    r_attr = requests.post(url['attr'], data=json.dumps(_attr), headers=cfg.http_headers)
-                if r_attr.status_code != 200 or r_tele.status_code != 200:
-                    logging.warn('Unable to push data to server, returned codes: Attributes: '+ str(r_attr.status_code) +', Telemetry: ' + str(r_tele.status_code))
+                r_tele = http_post(url['tele'], encode.array(_lines), _dest)
+                digest = attributes_due(_dest, _authkey, _attr)
+                attr_code = 200
+                if digest is not None:
+                    attr_code = http_post(url['attr'], json.dumps(_attr), _dest).status_code
+                    if attr_code == 200:
+                        attributes_sent(_dest, _authkey, digest)
+                # 4xx answers (bad authkey, etc) still mean the server itself is healthy
+                breaker_result(_dest['name'], attr_code < 500 and r_tele.status_code < 500)
+                if attr_code != 200 or r_tele.status_code != 200:
+                    logging.warn('Unable to push data to ' + _dest['name'] + ', returned codes: Attributes: '+ str(attr_code) +', Telemetry: ' + str(r_tele.status_code))
                     if _cache_on_err == 1:
-                        write_cache(_cache,_authkey)
+                        write_cache(_cache,_authkey,_dest)
                     else:
                         logging.warn('Record not written to cache due to configuration')
                     pub_err = 1
                 else:
                     pub_err = 0
             except Exception as e:
-                logging.error('Unable to publish record to server due to error: - '+ str(sys.exc_info()[0]))
+                breaker_result(_dest['name'], False)
+                logging.error('Unable to publish record to ' + _dest['name'] + ' due to error: - '+ str(sys.exc_info()[0]))
                 logging.error(e)
                 if _cache_on_err == 1:
                     logging.warn('Writing record to cache doe to connection failure')
-                    write_cache(_cache,_authkey)
+                    write_cache(_cache,_authkey,_dest)
                 else:
                     logging.warn('Record not written to cache due to configuration')
                 pub_err = 0
+    elif _dest['method'] == 'gateway':
+        pub_err = publish_gateway([(_attr, _lines, _authkey, _cache_on_err, _localonly)], _dest)
+
     else:
-        logging.warn('Unable to publish record due to incorrect method configuration' + str(cfg.settings['method']))
+        logging.warn('Unable to publish record due to incorrect method configuration ' + str(_dest['method']))
+        if _cache_on_err == 1:
+                write_cache(_cache,_authkey,_dest)
+        pub_err = 1
+
+    return pub_err
+
+def attributes_due(_dest, _authkey, _attr):
+    ##############################################################################
+    # Function: attributes_due                                                   #
+    # Purpose:  Decides if a device's attributes need sending to a destination:  #
+    #           they have changed since the server last accepted them (leaving   #
+    #           out the cfg.warmstart['attr_ignore'] keys), or 'attr_refresh'    #
+    #           seconds have passed                                              #
+    # @param    _dest      destination, see destinations()                       #
+    # @param    _authkey   device the attributes belong to                       #
+    # @param    _attr      attributes to be published                            #
+    #                                                                            #
+    #       @return hash of the attributes if they are due, else None            #
+    ##############################################################################
+    ignore = cfg.warmstart['attr_ignore']
+    digest = zlib.crc32(json.dumps(dict((k, v) for k, v in _attr.items() if k not in ignore), sort_keys=True).encode('utf-8'))
+    sent = attr_sent.get((_dest['name'], _authkey))
+    if cfg.warmstart['attr_refresh'] > 0 and sent is not None and sent[0] == digest and \
+            time.time() - sent[1] < cfg.warmstart['attr_refresh']:
+        count('attr_skipped')
+        return None
+    return digest
+
+def attributes_sent(_dest, _authkey, _digest):
+    ##############################################################################
+    # Function: attributes_sent                                                  #
+    # Purpose:  Remembers that the server accepted a device's attributes         #
+    ##############################################################################
+    attr_sent[(_dest['name'], _authkey)] = [_digest, time.time()]
+
+def publish_pool():
+    ##############################################################################
+    # Function: publish_pool                                                     #
+    # Purpose:  Thread pool used to publish to, or replay the cache to, several  #
+    #           destinations at the same time                                    #
+    # @param    none                                                             #
+    #                                                                            #
+    #       @return ThreadPoolExecutor                                           #
+    ##############################################################################
+    global fanout
+    with lock:
+        if fanout is None:
+            fanout = ThreadPoolExecutor(max_workers=4 * len(destinations()), thread_name_prefix='fanout')
+        return fanout
+
+def fanout_reserve(_dest, _n):
+    ##############################################################################
+    # Function: fanout_reserve                                                   #
+    # Purpose:  Keeps the readings waiting in the fanout pool for a destination  #
+    #           within pipeline['queue_size'], so one that is backed up cannot   #
+    #           grow the pool's queue without limit.  Readings turned away go to #
+    #           that destination's cache instead                                 #
+    # @param    _dest       destination, see destinations()                      #
+    # @param    _n          readings to be published                             #
+    #                                                                            #
+    #       @return True if they may be handed to the pool                       #
+    ##############################################################################
+    with lock:
+        pending = fanout_pending.get(_dest['name'], 0)
+        if pending > 0 and pending + _n > cfg.pipeline['queue_size']:
+            stats['fanout_spilled'] = stats.get('fanout_spilled', 0) + _n
+            return False
+        fanout_pending[_dest['name']] = pending + _n
+        return True
+
+def fanout_run(_dest, _n, _attr, _lines, _authkey, _cache_on_err, _localonly):
+    ##############################################################################
+    # Function: fanout_run                                                       #
+    # Purpose:  publish_batch() to one destination for readings reserved by      #
+    #           fanout_reserve()                                                 #
+    ##############################################################################
+    try:
+        publish_batch(_attr, _lines, _authkey, _cache_on_err, _localonly, _dest)
+    finally:
+        with lock:
+            fanout_pending[_dest['name']] = fanout_pending.get(_dest['name'], 0) - _n
+
+def publish_gateway(_groups, _dest):
+    ##############################################################################
+    # Function: publish_gateway                                                  #
+    # Purpose:  Publishes the readings of several devices at once through the    #
+    #           MQTT gateway connection (see gateway.py).  Local only devices,   #
+    #           and all devices when the gateway is down, go to the cache        #
+    # @param    _groups    list of (attr, lines, authkey, cache_on_err,          #
+    #                      localonly), as passed to publish_batch()              #
+    # @param    _dest      destination, see destinations()                       #
+    #                                                                            #
+    #       @return status             indicator of status - temp                #
+    ##############################################################################
+    server = 'gateway:' + _dest['name']
+    send = []
+    for _attr, _lines, _authkey, _cache_on_err, _localonly in _groups:
+        if _localonly == 1:
+            write_cache('\n'.join(_lines), _authkey, _dest)
+        else:
+            send.append((_attr, _lines, _authkey, _cache_on_err))
+    if not send:
+        return 0
+
+    # devices whose attributes the server already has are sent without them
+    digests = [attributes_due(_dest, _authkey, _attr) for _attr, _lines, _authkey, _cache_on_err in send]
+    ok = False
+    if breaker_allow(server):
+        try:
+            ok = gateway.publish([(_attr if digest is not None else {}, _lines, _authkey)
+                                  for (_attr, _lines, _authkey, _cache_on_err), digest in zip(send, digests)], _dest)
+        except Exception as e:
+            logging.error('Unable to publish through gateway due to error: ' + str(e))
+        breaker_result(server, ok)
+    if ok:
+        for (_attr, _lines, _authkey, _cache_on_err), digest in zip(send, digests):
+            if digest is not None:
+                attributes_sent(_dest, _authkey, digest)
+        return 0
+
+    for _attr, _lines, _authkey, _cache_on_err in send:
         if _cache_on_err == 1:
-                write_cache(_cache,_authkey)
+            write_cache('\n'.join(_lines), _authkey, _dest)
+        else:
+            logging.warn('Record not written to cache due to configuration')
+    return 1
 
-    return pub_err
\ No newline at end of file
+def enqueue(_record, _priority):
+    ##############################################################################
+    # Function: enqueue                                                          #
+    # Purpose:  Hands a reading to the publisher threads of every destination.   #
+    #           Lower priority values are published first (0 for alarms, 1 for   #
+    #           routine readings).  If a destination's queue is full the reading #
+    #           spills to its disk cache instead, unless it is more urgent than  #
+    #           the least urgent queued reading, in which case that one is       #
+    #           spilled to make room.  The reading is encoded here, once, for    #
+    #           every destination's request body and cache                       #
+    # @param    _record    dict of ts, authkey, attr, tele, cache_on_err and     #
+    #                      localonly for one reading                             #
+    # @param    _priority  0 for alarms, 1 for routine readings                  #
+    #                                                                            #
+    #       @return none                                                         #
+    ##############################################################################
+    if 'line' not in _record:
+        _record['line'] = encode.record(_record['ts'], _record['tele'])
+    spills = []
+    with outbox_cv:
+        seq = next(outbox_seq)
+        for dest in destinations():
+            outbox = outboxes.setdefault(dest['name'], [])
+            spill = _record
+            if len(outbox) < cfg.pipeline['queue_size']:
+                spill = None
+            else:
+                worst = max(outbox)
+                if worst[0] > _priority:
+                    outbox.remove(worst)
+                    heapq.heapify(outbox)
+                    spill = worst[2]
+            if spill is not _record:
+                heapq.heappush(outbox, (_priority, seq, _record))
+            if spill is not None:
+                spills.append((spill, dest))
+        outbox_cv.notify_all()
+    for spill, dest in spills:
+        count('queue_spill')
+        write_cache(spill['line'], spill['authkey'], dest)
+
+def publisher(_name):
+    ##############################################################################
+    # Function: publisher                                                        #
+    # Purpose:  Publisher thread - takes up to batch_size readings off the queue #
+    #           of one destination at a time, most urgent first, and publishes   #
+    #           them with one request per device                                 #
+    # @param    _name      name of the destination                               #
+    #                                                                            #
+    #       @return none (runs forever)                                          #
+    ##############################################################################
+    while True:
+        with outbox_cv:
+            outbox = outboxes.setdefault(_name, [])
+            if not outbox:
+                outbox_cv.wait(1)
+            batch = []
+            while outbox and len(batch) < cfg.pipeline['batch_size']:
+                batch.append(heapq.heappop(outbox)[2])
+        dest = next((d for d in destinations() if d['name'] == _name), None)
+        if dest is None:
+            return                    # destination removed from the configuration
+
+        groups = {}
+        for record in batch:
+            key = (record['authkey'], record['cache_on_err'], record['localonly'])
+            group = groups.setdefault(key, {'attr': {}, 'lines': []})
+            group['attr'].update(record['attr'])
+            group['lines'].append(record['line'])
+        try:
+            if dest['method'] == 'gateway':
+                # every device in the batch goes out in the same gateway message
+                if groups:
+                    publish_gateway([(group['attr'], group['lines'], key[0], key[1], key[2]) for key, group in groups.items()], dest)
+            else:
+                for key, group in groups.items():
+                    publish_batch(group['attr'], group['lines'], key[0], key[1], key[2], dest)
+        except Exception as e:
+            logging.error('Unexpected error in publisher: ' + str(e))
+
+def start_publishers():
+    ##############################################################################
+    # Function: start_publishers                                                 #
+    # Purpose:  Starts the configured number of publisher threads for every      #
+    #           destination, so a slow destination only holds up its own queue   #
+    # @param    none                                                             #
+    #                                                                            #
+    #       @return none                                                         #
+    ##############################################################################
+    for dest in destinations():
+        for i in range(cfg.pipeline['workers']):
+            threading.Thread(target=publisher, args=(dest['name'],), name='publisher-' + dest['name'] + '-' + str(i), daemon=True).start()
+        logging.info('Started ' + str(cfg.pipeline['workers']) + ' publisher threads for ' + dest['name'] + ' (' + dest['server'] + '), queue size ' + str(cfg.pipeline['queue_size']))
+
+def spill_outbox():
+    ##############################################################################
+    # Function: spill_outbox                                                     #
+    # Purpose:  Writes every reading still waiting in the queues to the disk     #
+    #           cache of its destination, used when the monitor shuts down       #
+    # @param    none                                                             #
+    #                                                                            #
+    #       @return none                                                         #
+    ##############################################################################
+    found = dict((dest['name'], dest) for dest in destinations())
+    with outbox_cv:
+        pending = [(item[2], name) for name, outbox in outboxes.items() for item in outbox]
+        for outbox in outboxes.values():
+            del outbox[:]
+    for record, name in pending:
+        write_cache(record['line'], record['authkey'], found.get(name))
+    if pending:
+        logging.info('Wrote ' + str(len(pending)) + ' queued readings to cache on shutdown')
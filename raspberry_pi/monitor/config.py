@@ -47,26 +47,78 @@ This section defines how your host will connect to the Thingsboard server.
 
 In order to support the publication of telemetry and attributes via HTTP through a proxy, if necessary you can
     define the proxy needed below.  The actual hosts will be ignored if 'proxy' is set to 0
+
+With 'method' set to 'gateway', all the devices on this host are published through a single MQTT connection
+    using the Thingsboard gateway API, authenticated with 'gateway_token' instead of each sensor's authkey.
+    Devices are named by settings['gw_device'], or by their 'name' attribute.  See 'gateway.py' for details.
+
+To publish every reading to more than one server (a primary and a disaster recovery cluster, say), list the
+    other servers in 'destinations'.  Each entry needs a 'name' and a 'server', and may set any of the other
+    keys of conn (method, port, gateway_token, proxy, timeouts) - keys it leaves out are taken from conn.
+    Every destination has its own publisher threads, connection pool, circuit breaker and cache directory
+    (cachedir/<name>/, with the same cache budgets as cachedir), so a slow or unreachable server never holds
+    up the others.  With the pipeline disabled, readings for the other destinations are published in the
+    background, and once pipeline['queue_size'] of them are waiting for one destination the rest go to its
+    cache.
 ========================================================================================================
     
 '''
 conn = {
     'server': '[YOUR SERVER HERE]',              # IP or hostname of manager    
-    'port': 1883,                                 # MQTT server port number (MQTT transport not yet supported in this script)
-    'method': "http",                             # Method used to send data to TB server
+    'port': 1883,                                 # MQTT server port number, used by the 'gateway' method
+    'method': "http",                             # Method used to send data to TB server: 'http' or 'gateway'
+    'gateway_token': '[YOUR GATEWAY TOKEN HERE]', # Access token of the gateway device, for the 'gateway' method
     'proxy': 0,                                   # (0,1) If you need to go through a proxy, set to 1
     'proxy_http': '[HTTP://YOUR HTTP SERVER:PORT]',
-    'proxy_https': '[HTTPS://YOUR HTTP SERVER:PORT]'
+    'proxy_https': '[HTTPS://YOUR HTTP SERVER:PORT]',
+    'timeout_connect': 3.05,                      # Seconds to wait for the TCP connection to the server
+    'timeout_read': 10,                           # Seconds to wait for the server to answer once connected
+    'destinations': [                             # More servers to publish to, see above, e.g.
+        # {'name': 'dr', 'server': '[YOUR DR SERVER HERE]'},
+        ]
+    }
+
+# The circuit breaker tracks the health of the Thingsboard server.  After 'failures' consecutive connection
+#    errors or timeouts the breaker opens, and records go straight to the cache without touching the network.
+#    Once the backoff expires, a single probe request is let through (half-open): if it succeeds publishing
+#    resumes, if it fails the backoff is doubled (up to 'backoff_max') and the breaker opens again.
+breaker = {
+    'failures': 3,                                # Consecutive failures before the breaker opens
+    'backoff': 5,                                 # Seconds the breaker stays open after the first trip
+    'backoff_max': 300,                           # Upper limit for the exponential backoff, in seconds
+    'jitter': 0.2                                 # Random +/- fraction applied to each backoff period
     }
 
 settings = {
          'debug': 0
          }
 
+# Readings are timestamped when they are taken and handed to publisher threads through a bounded queue, so
+#    that a slow or unreachable server never delays sampling.  Alarms are published ahead of routine
+#    readings, and readings are sent in batches of up to 'batch_size' (one request per device per batch).
+#    If the queue fills up, routine readings spill to the cache directory.  Set 'enabled' to 0 to publish
+#    each reading directly from the polling loop instead.
+pipeline = {
+    'enabled': 1,
+    'queue_size': 1000,                           # Readings held in memory before spilling to cache
+    'workers': 2,                                 # Number of publisher threads
+    'batch_size': 50                              # Most readings taken off the queue at once
+    }
+
 # These values are used for HTTP POST operations, and supporting the use of proxies easily in functions in
 #    'common.py'
 
 http_headers = {'Content-Type': 'application/json'}
+
+# Request bodies of at least 'min_size' bytes (batched telemetry, cache replay) can be sent compressed with
+#    'gzip' or 'deflate' and a matching Content-Encoding header, which saves most of the bandwidth on metered
+#    links since the same keys repeat in every record.  The server, or a proxy in front of it, must accept
+#    compressed request bodies.  Bytes saved are counted in the monitor's stats counters.
+compression = {
+    'method': 'none',                             # 'gzip', 'deflate' or 'none'
+    'level': 6,                                   # 1 (fastest) to 9 (smallest)
+    'min_size': 1024                              # Smaller bodies are sent as they are
+    }
 proxies = {
      'http': conn['proxy_http'],
      'https': conn['proxy_https']
@@ -76,6 +128,13 @@ proxies = {
 Sensor Configuration:
 ---------------------
 
+The running monitor checks this file at the start of every poll and applies changes without restarting.
+    Sensors are matched by 'id': new ones are added, missing ones removed and changed ones retuned, while
+    the others keep running untouched.  The settings in the custom section below (and breaker, pipeline
+    batch/queue sizes and compression) are reloaded too; changes to conn, logs, supervisor, snapshot,
+    history, bridge and warmstart need a restart.  A file that fails to load or has an invalid sensor list is ignored
+    (with an error in the log) until it is fixed.
+
 The sensor definitions are broken up into four sections: notes, settings, attributes, and telemtry (sources).
 
 ** Note ** the 'id' value must be unique for each sensor definition.  As of version 1.5, the 'id' value allows
@@ -109,6 +168,35 @@ Settings (settings):
     | localonly    | 0 or 1 | If enabled, script will not try to publish, but will cache      |
     |              |        |    locally only.  Does not override clearcache                  |
     |--------------|--------|-----------------------------------------------------------------|
+    | alarm        | 0 or 1 | Optional. If enabled, every reading is checked against the      |
+    |              |        |    temp_low and temp_high attributes, and 'alarm[label]' is     |
+    |              |        |    published as 'normal', 'low' or 'high'                       |
+    |--------------|--------|-----------------------------------------------------------------|
+    | alarm_key    | key    | Optional. Telemetry key checked, default 'temp[label]'          |
+    |--------------|--------|-----------------------------------------------------------------|
+    | hysteresis   | number | Optional. How far back inside the limits the value must be      |
+    |              |        |    before the alarm clears, default 1                           |
+    |--------------|--------|-----------------------------------------------------------------|
+    | alarm_wait   | seconds| Optional. While in alarm, the sensor is also read and published |
+    |              |        |    every alarm_wait seconds until it recovers. 0 to disable     |
+    |--------------|--------|-----------------------------------------------------------------|
+    | sample       | seconds| Optional. Also read the sensor (and quick system stats) every   |
+    |              |        |    'sample' seconds between polls.  Each publish then includes  |
+    |              |        |    [key]_min, _max, _avg and _count over the last 'window'      |
+    |--------------|--------|-----------------------------------------------------------------|
+    | window       | seconds| Optional. Length of the statistics window, default 60           |
+    |--------------|--------|-----------------------------------------------------------------|
+    | adaptive     | 0 or 1 | Optional. If enabled, the sensor is polled on its own interval, |
+    |              |        |    shorter while its readings change quickly and longer while   |
+    |              |        |    they are steady.  The interval is published as               |
+    |              |        |    'interval[label]'.  See 'adaptive' below                     |
+    |--------------|--------|-----------------------------------------------------------------|
+    | poll_key     | key    | Optional. Telemetry key watched, default alarm_key/'temp[label]'|
+    |--------------|--------|-----------------------------------------------------------------|
+    | poll_min     | seconds| Optional. Shortest and longest adaptive poll interval, and the  |
+    | poll_max     | seconds|    change per minute that halves it - defaults from 'adaptive'  |
+    | poll_change  | number |    below                                                        |
+    |--------------|--------|-----------------------------------------------------------------|
     
 Attributes (attr):
     Attributes are free-form.  The values in the attr dictionary block are passed as-is as device
@@ -128,6 +216,8 @@ Telemetry (tele):
     |  device      |     ds18b20: /sys/bus/w1/devices/28*/w1_slave is an example              |
     |              |     weather: incude the ZIP code of the area you want to gather telemetry|
     |              |         information on                                                   |
+    |              |     owm: 'id:<city id>' may be used instead of a ZIP code, city IDs are  |
+    |              |         fetched together in group requests                               |
     |-----------------------------------------------------------------------------------------|
     |              | defines the label used to reflect that specific sensor, a temperature    |
     |              |    sensor would be sent as telemetry value 'temp[label]'.  This allows   |
@@ -149,7 +239,10 @@ sensors = [
             'sys_info':     1,
             'cache_on_err': 0,
             'clearcache':   0,
-            'localonly':    0
+            'localonly':    0,
+            'alarm':        1,
+            'hysteresis':   1,
+            'alarm_wait':   15
              },
          'attr': {
             'platform':      '[PLATFORM NAME]',
@@ -170,7 +263,7 @@ sensors = [
             'label':         '[LABEL]'
              }
      },
-    { 'id': 1,
+    { 'id': 2,
       'authkey': '[YOUR AUTHKEY HERE]',
          'notes': {
              'notes': '[YOUR DESCRIPTION HERE]',
@@ -180,7 +273,10 @@ sensors = [
             'sys_info':     1,
             'cache_on_err': 0,
             'clearcache':   0,
-            'localonly':    0
+            'localonly':    0,
+            'alarm':        1,
+            'hysteresis':   1,
+            'alarm_wait':   15
              },
          'attr': {
             'platform':      '[PLATFORM NAME]',
@@ -211,10 +307,24 @@ Logging configurations go here and both define logging destinations, as well as
 '''
 logs = {
         'cachedir': 'cache/',                                      # Location where cache files will be stored
+        'replay_batch': 100,                                       # Cached records sent per request when clearing cache
+        'cache_max_mb': 512,                                       # Budget for the whole cache directory, 0 for no limit
+        'cache_max_mb_key': 128,                                   # Budget for the cache files of each authkey, 0 for no limit
+        'cache_policy': 'downsample',                              # 'downsample' or 'oldest' - see below
+        'downsample': [[86400, 60], [604800, 600]],                # [age, step] - older than age seconds, keep 1 record per step
         'logdir': 'logs/',                                         # where log file will be kept
-        'logfile': time.strftime("%Y-%m-%d") + '_messages.log'     # log file name
+        'logfile': 'messages.log',                                 # log file name, rotated files get a date or number added
+        'rotate': 'time',                                          # 'time' to start a new log file at midnight, 'size' by size
+        'rotate_mb': 5,                                            # size at which the log rotates, with 'size'
+        'backups': 14,                                             # number of rotated log files kept
+        'ratelimit': 60                                            # seconds between repeats of the same warning (same text), 0 to log all; alarms always logged
     }
 logfile = logs['logdir'] + logs['logfile']
+
+# When the cache directory, or the files of one authkey, grow past their budget the oldest cache file is reduced
+#    first.  With the 'downsample' policy its records are thinned per the 'downsample' tiers (by default one record
+#    per minute once older than a day, one per 10 minutes once older than a week) before any file is deleted;
+#    with 'oldest' the oldest files are simply deleted until the cache is back within budget.
 cachefile = logs['cachedir']
 
 
@@ -225,6 +335,100 @@ Custom configuration settings can be added below this point for different sensor
 ========================================================================================================
 '''
 
+# Settings for 'supervisor.py', which runs the monitor as several worker processes each polling a shard of the
+#    sensors above.  Crashed workers are restarted after 'restart_wait' seconds, doubling on each crash up to
+#    'restart_wait_max'.
+supervisor = {
+    'workers': 0,                # Number of worker processes, 0 for one per CPU core
+    'shard_by': 'authkey',       # Split sensors by 'authkey' or by sensor 'type'
+    'report': 30,                # Seconds between worker stats reports (and logs/health.json updates)
+    'restart_wait': 5,
+    'restart_wait_max': 300
+    }
+
+# Sensors with a 'sample' setting keep their readings in a ring of 'buckets' time slots per telemetry key,
+#    each window / buckets seconds long, so memory stays the same whatever the window length or sample rate.
+aggregation = {
+    'buckets': 60
+    }
+
+# The latest reading of every sensor is kept in memory and served to other processes on this host (a display,
+#    a relay controller) over HTTP on 'host':'port' and, if 'socket' is set, on that Unix socket.  Clients can
+#    wait up to 'wait_max' seconds for the next change.  See 'snapshot.py' for the requests.  Under
+#    'supervisor.py' each worker serves its own shard on port + 1 + shard number and socket + '.shard<N>'.
+snapshot = {
+    'enabled': 1,
+    'host': '127.0.0.1',         # Keep on localhost, there is no authentication
+    'port': 8181,                # 0 to serve on the Unix socket only
+    'socket': '',                # e.g. '/run/monitor.sock', '' for none
+    'wait_max': 60               # Seconds
+    }
+
+# The numeric values of every published reading are kept for 'days' days in a local SQLite database, written by
+#    a background thread every 'flush' seconds.  Query it with 'history.py', or over HTTP from the snapshot
+#    service.  Under 'supervisor.py' each worker keeps its own 'shard<N>_' database.
+history = {
+    'enabled': 1,
+    'dbfile': 'history.db',
+    'days': 30,
+    'flush': 10,                 # Seconds
+    'queue_max': 50000           # Values waiting to be written, more are dropped (and logged)
+    }
+
+# Settings for 'bridge.py', which forwards the readings of the ESP8266 boards from a broker on the local network.
+#    Boards publish to esp/<authkey>/telemetry and esp/<authkey>/attributes.  Readings that cannot be sent are
+#    cached if 'cache_on_err' is set, and replayed every 'replay' seconds, including those of boards not heard
+#    from since the bridge started.  Boards not heard from in 'quiet' seconds are counted in the bridge log.
+bridge = {
+    'broker': 'localhost',
+    'port': 1883,
+    'topic': 'esp/+/+',
+    'cache_on_err': 1,
+    'replay': 60,                # Seconds
+    'quiet': 300                 # Seconds
+    }
+
+# Defaults for sensors with the 'adaptive' setting.  The rate of change of the watched key is tracked per poll:
+#    a faster rate is taken at once, a slower one only pulls the estimate down by 'alpha' per poll.  The poll
+#    interval runs from 'poll_max' for a steady reading down towards 'poll_min', and is halfway between the two
+#    when the reading changes by 'poll_change' per minute.
+adaptive = {
+    'poll_min': 10,              # Seconds
+    'poll_max': 300,             # Seconds
+    'poll_change': 0.5,          # Change per minute (degrees for temperatures) that halves the interval, above 0
+    'alpha': 0.3
+    }
+
+# Warm starts, so a whole site rebooting at once does not hit the server with every device at the same moment.
+#    Every 'checkpoint' seconds (and on shutdown) the monitor saves what it knows to 'file': alarm states, last
+#    good readings, adaptive estimates, the snapshot, which attributes each server already has, how far each
+#    cache file has been replayed and when each sensor was last polled.  At startup a file less than 'max_age'
+#    seconds old is restored, sensors polled recently keep their place in the poll cycle, and polling starts
+#    after a random wait of up to 'jitter' seconds.  Under 'supervisor.py' each worker keeps its own
+#    'shard<N>_' file.
+#    Attributes are only sent when they have changed since the server last accepted them, or 'attr_refresh'
+#    seconds have passed (0 to send them with every reading).  Changes to the 'attr_ignore' keys alone, such
+#    as the uptime, wait for the refresh.
+warmstart = {
+    'enabled': 1,
+    'file': 'warmstart.json',
+    'checkpoint': 60,            # Seconds
+    'max_age': 3600,             # Seconds
+    'jitter': 30,                # Seconds, 0 for none
+    'attr_refresh': 3600,        # Seconds
+    'attr_ignore': ['uptime']
+    }
+
+# Every call to read a sensor runs in its own worker thread and is given up on after the number of seconds
+#    below for its type ('default' for types not listed).  A source that misses its deadline reports its last
+#    good reading with 'stale[label]' set to 1, and is not read again until the hung read returns.
+read_timeouts = {
+    'ds18b20': 5,
+    'owm': 15,
+    'wund': 15,
+    'default': 10
+    }
+
 # Settings spefically for OpenWeatherMaps integration.  To use OpenWeatherMaps, you will need an API key
 #    specific to your installation.  You can get more information on API keys on their website at:
 #    https://openweathermap.org/api
@@ -234,8 +438,11 @@ owm_settings = {
     'owm_format': 'json',
     'owm_url': 'http://api.openweathermap.org/data/2.5/weather?us&APPID=',
     'temp_units': 'f',
+    'owm_group_max': 20,         # City IDs per group request (the OWM API allows up to 20)
+    'owm_workers': 4             # Concurrent requests when fetching locations that cannot be grouped (ZIP codes)
     }
 owm_url = owm_settings['owm_url']+owm_settings['owm_api']+'&mode='+owm_settings['owm_format']
+owm_group_url = owm_url.replace('/weather?', '/group?')
 
 # Settings spefically for WeatherUnderground integration.  To use WeatherUnderground, you will need an API key
 #    specific to your installation.  You can get more information on API keys on their website at:
@@ -0,0 +1,118 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import json                         # used for processing data
+import time
+import threading
+try:
+    import orjson                   # Optional, faster JSON encoder
+except ImportError:
+    orjson = None
+
+'''
+========================================================================================================
+SYNOPSIS
+    'encode.py' turns readings into the JSON records sent to the server and written to the cache, used
+        by 'common.py'.  Each reading is encoded once, and the same text is used for both.
+
+DESCRIPTION
+    A record is {"ts":<ms>,"values":{...}} with the time as an integer number of milliseconds.  Records
+        are joined into a JSON array for the HTTP telemetry API, written one per line to the cache, or
+        grouped by device for the gateway API, without being encoded again.
+
+    The keys of a sensor's telemetry are the same on every reading, so for each key layout (the keys in
+        order) the text around the values is built once and kept in 'layouts':
+
+            ('tempA', 'cpu')  ->  ['{"ts":', ',"values":{"tempA":', ',"cpu":', '}}']
+
+        A record is then just those pieces with the values in between.  Numbers, strings, booleans and
+        None are written directly; a reading with any other value, or a float that is not finite, is
+        encoded with json.dumps() instead.  If the orjson library is installed it is used for the whole
+        record instead of the layouts.
+
+AUTHOR
+    Bob Perciaccante - Bob@perciaccante.net
+
+========================================================================================================
+'''
+
+layouts = {}                        # tuple of keys -> pre-encoded text around the values
+lock = threading.Lock()             # protects layouts
+layouts_max = 1024                  # layouts kept before starting over, in case keys keep changing
+
+def now_ms():
+    #############################################################################
+    # Function: now_ms                                                          #
+    # Purpose:  Current time as an integer number of milliseconds               #
+    #############################################################################
+    return int(time.time() * 1000)
+
+def layout(_keys):
+    #############################################################################
+    # Function: layout                                                          #
+    # Purpose:  Finds, or builds, the pre-encoded pieces for a key layout       #
+    # @param    _keys      tuple of telemetry keys, in order                    #
+    #                                                                           #
+    # @return   list of len(_keys) + 2 strings                                  #
+    #############################################################################
+    pieces = layouts.get(_keys)
+    if pieces is None:
+        pieces = ['{"ts":', ',"values":{']
+        for i, key in enumerate(_keys):
+            pieces[-1] = pieces[-1] + (',' if i else '') + json.dumps(key) + ':'
+            pieces.append('')
+        pieces[-1] = '}}'
+        with lock:
+            if len(layouts) >= layouts_max:
+                layouts.clear()
+            layouts[_keys] = pieces
+    return pieces
+
+def value(_value):
+    #############################################################################
+    # Function: value                                                           #
+    # Purpose:  Encodes one telemetry value, None if it needs json.dumps()      #
+    #############################################################################
+    kind = type(_value)
+    if kind is str:
+        return json.dumps(_value)
+    if kind is float:
+        if _value - _value != 0:
+            return None                 # NaN and infinity
+        return repr(_value)
+    if kind is int:
+        return str(_value)
+    if kind is bool:
+        return 'true' if _value else 'false'
+    if _value is None:
+        return 'null'
+    return None
+
+def record(_ts, _message):
+    #############################################################################
+    # Function: record                                                          #
+    # Purpose:  Encodes one reading as a JSON record                            #
+    # @param    _ts        time the reading was taken, in ms                    #
+    # @param    _message   telemetry dict                                       #
+    #                                                                           #
+    # @return   record text, {"ts":...,"values":{...}}                          #
+    #############################################################################
+    ts = int(_ts)
+    if orjson is not None:
+        return orjson.dumps({'ts': ts, 'values': _message}).decode('utf-8')
+    pieces = layout(tuple(_message))
+    out = [pieces[0], str(ts)]
+    for i, item in enumerate(_message.values()):
+        text = value(item)
+        if text is None:
+            return json.dumps({'ts': ts, 'values': _message}, separators=(',', ':'))
+        out.append(pieces[i + 1])
+        out.append(text)
+    out.append(pieces[-1] if _message else ',"values":{}}')
+    return ''.join(out)
+
+def array(_lines):
+    #############################################################################
+    # Function: array                                                           #
+    # Purpose:  Joins encoded records into a JSON array for the telemetry API   #
+    #############################################################################
+    return '[' + ','.join(_lines) + ']'
@@ -0,0 +1,242 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import os
+import sys
+import json                  # Used for data manipulation
+import argparse
+from array import array      # Used for the typed columns
+import common as com         # Bring in common.py shared functions
+from import_cache import find_cache_files
+
+'''
+========================================================================================================
+SYNOPSIS
+    'export_cache.py' turns cache files into tables for analysis, one table per device, as CSV or as
+        binary column files.
+
+DESCRIPTION
+    The given files and directories are searched for cache files, grouped by the authkey in their name
+        as for 'import_cache.py'.  Each device's records are read one line at a time, oldest file first,
+        into typed columns: 'ts' (ms, 64 bit integers), one 64 bit float column per numeric key (NaN
+        where a record has no number, such as 'error' from a failed read) and a text column for any
+        key that never holds a number.  Every --chunk
+        rows the columns are written out and emptied, so memory use stays the same however large the
+        export is.
+
+    The columns of a device are found with a first pass over its files, unless they are given with
+        --keys.  Temperature columns can be converted in bulk on the way out, e.g. --convert tempA=f2c,
+        using the conversions in 'common.py' (numpy is used if it is installed).
+
+        export_cache.py cache/ --out export/                    export/<authkey>.csv
+        export_cache.py cache/ --out export/ --format bin       export/<authkey>/<column>.f64 ...
+
+    Binary columns are raw little-endian arrays, 'ts.i64' of int64 and '<key>.f64' of float64, with
+        string columns in '<key>.txt', one value per line.  'columns.json' in each device directory
+        lists the columns and the number of rows.  With numpy they load with:
+
+        numpy.fromfile('export/<authkey>/tempA.f64', dtype='<f8')
+
+AUTHOR
+    Bob Perciaccante - Bob@perciaccante.net
+
+========================================================================================================
+'''
+
+
+def read_records(files):
+    #############################################################################
+    # Function: read_records                                                    #
+    # Purpose:  Streams the records of one device's cache files in order        #
+    # @param    files      cache files of the device, oldest first              #
+    #                                                                           #
+    # @return   generator of (ts in ms, values)                                 #
+    #############################################################################
+    for path in files:
+        with open(path) as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                try:
+                    record = json.loads(line)
+                    yield (int(float(record['ts'])), record['values'])
+                except (ValueError, KeyError, TypeError):
+                    print('Skipping unreadable record in ' + path)
+
+
+def find_columns(files):
+    #############################################################################
+    # Function: find_columns                                                    #
+    # Purpose:  First pass over a device's files - finds every key and whether  #
+    #           it holds numbers.  A key with any number is a number column,    #
+    #           its other values (e.g. 'error' from a failed read) becoming NaN #
+    # @param    files      cache files of the device, oldest first              #
+    #                                                                           #
+    # @return   dict of key -> 'f64' or 'txt', in the order first seen          #
+    #############################################################################
+    columns = {}
+    for ts, values in read_records(files):
+        for key, value in values.items():
+            if isinstance(value, (int, float)) and not isinstance(value, bool):
+                columns[key] = 'f64'
+            else:
+                columns.setdefault(key, 'txt')
+    return columns
+
+
+class Writer(object):
+    #############################################################################
+    # Class:    Writer                                                          #
+    # Purpose:  Writes the chunks of one device's table as CSV or binary        #
+    #           column files                                                    #
+    #############################################################################
+    def __init__(self, _out, _authkey, _columns, _format):
+        self.columns = _columns
+        self.format = _format
+        self.rows = 0
+        if _format == 'csv':
+            self.path = os.path.join(_out, _authkey + '.csv')
+            self.file = open(self.path, 'w')
+            self.file.write(','.join(['ts'] + list(_columns)) + '\n')
+        else:
+            self.path = os.path.join(_out, _authkey)
+            if not os.path.exists(self.path):
+                os.makedirs(self.path)
+            self.files = {'ts': open(os.path.join(self.path, 'ts.i64'), 'wb')}
+            for key, kind in _columns.items():
+                self.files[key] = open(os.path.join(self.path, key + '.' + kind), 'wb' if kind == 'f64' else 'w')
+
+    def write(self, _chunk):
+        count = len(_chunk['ts'])
+        if self.format == 'csv':
+            lines = []
+            for row in range(count):
+                fields = [str(_chunk['ts'][row])]
+                for key, kind in self.columns.items():
+                    value = _chunk[key][row]
+                    if kind == 'f64':
+                        fields.append('' if value != value else repr(value))
+                    else:
+                        fields.append(csv_field(value))
+                lines.append(','.join(fields))
+            self.file.write('\n'.join(lines) + '\n' if lines else '')
+        else:
+            for key, column in _chunk.items():
+                if isinstance(column, array):
+                    if sys.byteorder != 'little':
+                        column.byteswap()
+                    column.tofile(self.files[key])
+                else:
+                    self.files[key].write(''.join(value.replace('\n', ' ') + '\n' for value in column))
+        self.rows = self.rows + count
+
+    def close(self):
+        if self.format == 'csv':
+            self.file.close()
+            return
+        for f in self.files.values():
+            f.close()
+        with open(os.path.join(self.path, 'columns.json'), 'w') as f:
+            json.dump({'rows': self.rows, 'columns': dict([('ts', 'i64')] + list(self.columns.items()))}, f, indent=1)
+
+
+def csv_field(value):
+    #############################################################################
+    # Function: csv_field                                                       #
+    # Purpose:  Quotes a text value for CSV when it needs it                    #
+    #############################################################################
+    if any(c in value for c in ',"\n'):
+        return '"' + value.replace('"', '""') + '"'
+    return value
+
+
+def new_chunk(columns):
+    #############################################################################
+    # Function: new_chunk                                                       #
+    # Purpose:  Empty typed columns for the next chunk                          #
+    #############################################################################
+    chunk = {'ts': array('q')}
+    for key, kind in columns.items():
+        chunk[key] = array('d') if kind == 'f64' else []
+    return chunk
+
+
+def export_device(authkey, files, args):
+    #############################################################################
+    # Function: export_device                                                   #
+    # Purpose:  Writes the table of one device, args.chunk rows at a time       #
+    # @param    authkey    device the files belong to                           #
+    # @param    files      cache files of the device, oldest first              #
+    # @param    args       command line arguments                               #
+    #                                                                           #
+    # @return   number of rows written                                          #
+    #############################################################################
+    if args.keys:
+        columns = dict((key, 'txt' if key in args.text else 'f64') for key in args.keys)
+    else:
+        columns = find_columns(files)
+    writer = Writer(args.out, authkey, columns, args.format)
+    nan = float('nan')
+    for key in args.convert:
+        if columns.get(key) != 'f64':
+            print('Not converting ' + key + ' for ' + authkey + ': ' + ('it holds no numbers' if key in columns else 'no such column'))
+
+    def flush(chunk):
+        for key, conversion in args.convert.items():
+            if columns.get(key) == 'f64':
+                chunk[key] = com.convert_column(chunk[key], conversion)
+        writer.write(chunk)
+
+    chunk = new_chunk(columns)
+    for ts, values in read_records(files):
+        chunk['ts'].append(ts)
+        for key, kind in columns.items():
+            value = values.get(key)
+            if kind == 'txt':
+                chunk[key].append('' if value is None else str(value))
+            elif isinstance(value, (int, float)) and not isinstance(value, bool):
+                chunk[key].append(value)
+            else:
+                chunk[key].append(nan)
+        if len(chunk['ts']) >= args.chunk:
+            flush(chunk)
+            chunk = new_chunk(columns)
+    if len(chunk['ts']) > 0:
+        flush(chunk)
+    writer.close()
+    return writer.rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Export cache files as CSV or binary column tables')
+    parser.add_argument('paths', nargs='+', help='cache files or directories to export')
+    parser.add_argument('--out', default='export', help='output directory')
+    parser.add_argument('--format', choices=['csv', 'bin'], default='csv')
+    parser.add_argument('--chunk', type=int, default=65536, help='rows held in memory before writing')
+    parser.add_argument('--keys', nargs='*', help='columns to export, default every key found')
+    parser.add_argument('--text', nargs='*', default=[], help='columns given with --keys that hold text')
+    parser.add_argument('--convert', nargs='*', default=[], metavar='KEY=CONVERSION',
+                        help='convert a column, e.g. tempA=f2c (one of ' + ', '.join(sorted(com.conversions)) + ')')
+    args = parser.parse_args()
+
+    convert = {}
+    for option in args.convert:
+        key, sep, conversion = option.partition('=')
+        if conversion not in com.conversions:
+            parser.error('unknown conversion in ' + option)
+        convert[key] = conversion
+    args.convert = convert
+
+    devices = find_cache_files(args.paths)
+    if not devices:
+        print('No cache files found in ' + ', '.join(args.paths))
+        return 1
+    if not os.path.exists(args.out):
+        os.makedirs(args.out)
+    for authkey, files in sorted(devices.items()):
+        rows = export_device(authkey, files, args)
+        print('Exported ' + str(rows) + ' rows from ' + str(len(files)) + ' files for ' + authkey)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
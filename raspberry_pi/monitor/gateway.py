@@ -0,0 +1,193 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import json                         # used for processing data
+import time
+import threading
+import logging
+import config as cfg                # Bring in shared configuration file
+import encode                       # Readings arrive already encoded
+try:
+    import paho.mqtt.client as mqtt # Used for the MQTT gateway connection
+except ImportError:
+    mqtt = None
+
+'''
+========================================================================================================
+SYNOPSIS
+    'gateway.py' publishes the readings of every device on this host through a single MQTT connection,
+        using the Thingsboard gateway API.  Used by 'common.py' when conn['method'] is 'gateway'.
+
+DESCRIPTION
+    Instead of one HTTP request per device (each with its own authkey), the host connects once as a
+        Thingsboard gateway device using conn['gateway_token'] (one connection per destination, when
+        conn['destinations'] lists more than one server).  Devices are announced on
+        'v1/gateway/connect' the first time they are seen, and the readings of all devices in a batch
+        are packed into a single message on 'v1/gateway/telemetry' and one on 'v1/gateway/attributes',
+        keyed by device name.  The device name is settings['gw_device'] from the sensor definition,
+        or its 'name' attribute when not set.  Thingsboard creates the devices under the gateway.
+
+    To try it out against a local broker instead of a Thingsboard server:
+        mosquitto -p 1883
+        mosquitto_sub -h localhost -t 'v1/gateway/#' -v
+    and set conn['server'] to 'localhost' and conn['method'] to 'gateway' in config.py.
+
+REQUIRES
+    The following requirements must be met
+        paho-mqtt               pip install paho-mqtt (1.x or 2.x)
+        Thingsboard Gateway     A device in Thingsboard flagged "Is gateway", whose access
+                                token is set as conn['gateway_token'] in config.py
+
+AUTHOR
+    Bob Perciaccante - Bob@perciaccante.net
+
+========================================================================================================
+'''
+
+sessions = {}                 # destination name -> {'client', 'connected', 'announced'}, see session()
+names = {}                    # authkey -> device name for devices not in cfg.sensors (see 'bridge.py')
+lock = threading.Lock()       # protects sessions and the announced sets
+
+def session(_name):
+    #############################################################################
+    # Function: session                                                         #
+    # Purpose:  State of the gateway connection to one destination: the paho    #
+    #           client (created on first use by connect()), an event set while  #
+    #           the broker connection is up, and the device names already sent  #
+    #           on v1/gateway/connect since (re)connecting                      #
+    #############################################################################
+    with lock:
+        return sessions.setdefault(_name, {'client': None, 'connected': threading.Event(), 'announced': set()})
+
+def on_connect(_client, _userdata, _flags, _rc):
+    #############################################################################
+    # Function: on_connect                                                      #
+    # Purpose:  paho callback, marks the connection up so devices are announced #
+    #           again on the new session.  _userdata is the destination name    #
+    #############################################################################
+    state = session(_userdata)
+    if _rc == 0:
+        logging.info('Connected to gateway broker for destination ' + _userdata)
+        with lock:
+            state['announced'].clear()
+        state['connected'].set()
+    else:
+        logging.warning('Gateway broker for destination ' + _userdata + ' refused connection, return code ' + str(_rc))
+
+def on_disconnect(_client, _userdata, _rc):
+    #############################################################################
+    # Function: on_disconnect                                                   #
+    # Purpose:  paho callback, paho reconnects by itself in its network thread  #
+    #############################################################################
+    session(_userdata)['connected'].clear()
+    if _rc != 0:
+        logging.warning('Lost connection to gateway broker for destination ' + _userdata + ', return code ' + str(_rc))
+
+def connect(_dest):
+    #############################################################################
+    # Function: connect                                                         #
+    # Purpose:  Starts the gateway connection to a destination the first time   #
+    #           it is needed, and waits up to its 'timeout_connect' seconds for #
+    #           it to come up                                                   #
+    # @param    _dest      destination, see common.destinations()               #
+    #                                                                           #
+    # @return   True if the connection is up                                    #
+    #############################################################################
+    if mqtt is None:
+        logging.error('Gateway mode needs the paho-mqtt library - pip install paho-mqtt')
+        return False
+    state = session(_dest['name'])
+    with lock:
+        if state['client'] is None:
+            try:
+                client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION1, userdata=_dest['name'])
+            except AttributeError:
+                client = mqtt.Client(userdata=_dest['name'])           # paho-mqtt 1.x
+            client.username_pw_set(_dest['gateway_token'])
+            client.on_connect = on_connect
+            client.on_disconnect = on_disconnect
+            client.reconnect_delay_set(1, cfg.breaker['backoff_max'])
+            client.connect_async(_dest['server'], _dest['port'])
+            client.loop_start()
+            state['client'] = client
+    return state['connected'].wait(_dest['timeout_connect'])
+
+def device_name(_authkey):
+    #############################################################################
+    # Function: device_name                                                     #
+    # Purpose:  Finds the gateway device name for an authkey from the sensor    #
+    #           definitions - settings['gw_device'], else the 'name' attribute  #
+    #           - or from the names registered by the bridge                    #
+    # @param    _authkey   authkey of the sensor definition                     #
+    #                                                                           #
+    # @return   device name                                                     #
+    #############################################################################
+    for item in cfg.sensors:
+        if item['authkey'] == _authkey:
+            return item['settings'].get('gw_device', item['attr'].get('name', _authkey))
+    return names.get(_authkey, _authkey)
+
+def publish(_groups, _dest):
+    #############################################################################
+    # Function: publish                                                         #
+    # Purpose:  Sends the readings of several devices in one telemetry message  #
+    #           and one attribute message (if any attributes are given),        #
+    #           announcing new devices first                                    #
+    # @param    _groups    list of (attributes, encoded readings, authkey), see #
+    #                      encode.record()                                      #
+    # @param    _dest      destination, see common.destinations()               #
+    #                                                                           #
+    # @return   True if the broker acknowledged every message                   #
+    #############################################################################
+    if not connect(_dest):
+        return False
+    state = session(_dest['name'])
+    client = state['client']
+
+    tele = {}
+    attr = {}
+    announce = []
+    for _attr, _lines, _authkey in _groups:
+        name = device_name(_authkey)
+        with lock:
+            new = name not in state['announced']
+        if new and name not in [n for n, info in announce]:
+            announce.append((name, client.publish('v1/gateway/connect', json.dumps({'device': name}), qos=1)))
+        tele.setdefault(name, []).extend(_lines)
+        if _attr:
+            attr.setdefault(name, {}).update(_attr)
+
+    # the readings are already encoded, only the device names around them are added
+    body = '{' + ','.join(json.dumps(name) + ':' + encode.array(lines) for name, lines in tele.items()) + '}'
+    sent = [client.publish('v1/gateway/telemetry', body, qos=1)]
+    if attr:                          # devices whose attributes the server already has are left out
+        sent.append(client.publish('v1/gateway/attributes', json.dumps(attr), qos=1))
+    # a device only counts as announced once the broker has the connect message, so a failed one is resent
+    for name, info in announce:
+        if published(info, _dest['timeout_read']):
+            with lock:
+                state['announced'].add(name)
+    for info in sent:
+        if not published(info, _dest['timeout_read']):
+            return False
+    logging.debug('Published ' + str(len(tele)) + ' devices through the gateway to destination ' + _dest['name'])
+    return True
+
+def published(_info, _timeout):
+    #############################################################################
+    # Function: published                                                       #
+    # Purpose:  Waits up to _timeout seconds for the broker to acknowledge a    #
+    #           QoS 1 message.  Polls is_published() rather than calling        #
+    #           wait_for_publish(timeout), which needs paho-mqtt 1.6 or later   #
+    # @param    _info      MQTTMessageInfo returned by client.publish()         #
+    # @param    _timeout   seconds                                              #
+    #                                                                           #
+    # @return   True if the message was acknowledged                            #
+    #############################################################################
+    if _info.rc != 0:
+        return False
+    deadline = time.time() + _timeout
+    while not _info.is_published():
+        if time.time() >= deadline:
+            return False
+        time.sleep(0.01)
+    return True
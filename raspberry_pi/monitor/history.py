@@ -0,0 +1,247 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import os
+import sys
+import json                         # used for processing data
+import time
+import queue
+import sqlite3                      # Used for the local history database
+import argparse
+import threading
+import logging
+import config as cfg                # Bring in shared configuration file
+
+'''
+========================================================================================================
+SYNOPSIS
+    'history.py' keeps the last history['days'] days of published readings in a local SQLite database,
+        for troubleshooting on site and local dashboards without a round trip to the server.  Used by
+        'monitor.py' when history['enabled'] is set in 'config.py', and as a command line tool.
+
+DESCRIPTION
+    Every numeric value published by the monitor is stored as (key, ts, value), where key is a small
+        number standing for a sensor id and telemetry key pair.  Rows are kept in a table without
+        rowids, clustered on (key, ts), so a range query on one key reads consecutive pages.  Writes
+        are queued and committed by a background thread every history['flush'] seconds, so the SD card
+        sees one transaction per flush rather than one per reading.  Rows older than history['days']
+        are deleted once an hour.
+
+    Queries can return the readings as they are, or downsampled into 'step' second buckets with the
+        average, min, max and count of each bucket:
+
+        history.py keys
+        history.py range 1 temp --hours 24 --step 600
+        history.py range 1 temp --from 2018-03-01 --to 2018-03-02 --csv
+
+    The same queries are available over HTTP from the snapshot service (see 'snapshot.py'):
+
+        GET /history                              sensor ids and keys held
+        GET /history/<sensor id>/<key>?from=<ms>&to=<ms>&step=<seconds>
+
+AUTHOR
+    Bob Perciaccante - Bob@perciaccante.net
+
+========================================================================================================
+'''
+
+pending = queue.Queue(cfg.history['queue_max'])  # (sensor id, key, ts, value) waiting for the writer thread
+dropped = [0]                       # values dropped because pending was full, since the last flush
+key_ids = {}                        # (sensor id, key) -> key number in the database, used by the writer
+
+def connect():
+    #############################################################################
+    # Function: connect                                                         #
+    # Purpose:  Opens the history database, creating the tables if needed.      #
+    #           WAL mode lets queries run while the writer is committing        #
+    # @param    none                                                            #
+    #                                                                           #
+    # @return   sqlite3 connection                                              #
+    #############################################################################
+    db = sqlite3.connect(cfg.history['dbfile'], timeout=30)
+    db.execute('PRAGMA journal_mode=WAL')
+    db.execute('PRAGMA synchronous=NORMAL')
+    db.execute('CREATE TABLE IF NOT EXISTS keys (id INTEGER PRIMARY KEY, sensor TEXT, key TEXT, UNIQUE (sensor, key))')
+    db.execute('CREATE TABLE IF NOT EXISTS readings (key INTEGER, ts INTEGER, value REAL, PRIMARY KEY (key, ts)) WITHOUT ROWID')
+    return db
+
+def record(_item, _message, _ts):
+    #############################################################################
+    # Function: record                                                          #
+    # Purpose:  Queues the numeric values of a reading for the history          #
+    # @param    _item      sensor definition from config.py                     #
+    # @param    _message   telemetry published for the sensor                   #
+    # @param    _ts        time the reading was taken, in ms                    #
+    #                                                                           #
+    # @return   none                                                            #
+    #############################################################################
+    for key, value in _message.items():
+        if isinstance(value, bool) or not isinstance(value, (int, float)):
+            continue
+        try:
+            pending.put_nowait((str(_item['id']), key, int(_ts), value))
+        except queue.Full:
+            dropped[0] = dropped[0] + 1   # the database is not keeping up (or cannot be opened)
+
+def writer():
+    #############################################################################
+    # Function: writer                                                          #
+    # Purpose:  Background thread - writes the queued readings in one           #
+    #           transaction every history['flush'] seconds and deletes rows     #
+    #           older than history['days'] once an hour.  If the database       #
+    #           cannot be opened it is tried again every flush, while readings  #
+    #           beyond history['queue_max'] are dropped                         #
+    # @param    none                                                            #
+    #                                                                           #
+    # @return   none (runs forever)                                             #
+    #############################################################################
+    db = None
+    expired = 0
+    while True:
+        time.sleep(cfg.history['flush'])
+        if dropped[0] > 0:
+            logging.warning('History queue full, dropped ' + str(dropped[0]) + ' values')
+            dropped[0] = 0
+        if db is None:
+            try:
+                db = connect()
+                key_ids.clear()
+                for id, sensor, key in db.execute('SELECT id, sensor, key FROM keys'):
+                    key_ids[(sensor, key)] = id
+            except sqlite3.Error as e:
+                logging.error('Unable to open history database ' + cfg.history['dbfile'] + ', retrying: ' + str(e))
+                if db is not None:
+                    db.close()
+                db = None
+                continue
+        rows = []
+        while True:
+            try:
+                rows.append(pending.get_nowait())
+            except queue.Empty:
+                break
+        try:
+            with db:
+                for sensor, key, ts, value in rows:
+                    if (sensor, key) not in key_ids:
+                        key_ids[(sensor, key)] = db.execute('INSERT INTO keys (sensor, key) VALUES (?, ?)', (sensor, key)).lastrowid
+                db.executemany('INSERT OR REPLACE INTO readings VALUES (?, ?, ?)',
+                               [(key_ids[(sensor, key)], ts, value) for sensor, key, ts, value in rows])
+                if time.time() - expired > 3600:
+                    deleted = db.execute('DELETE FROM readings WHERE ts < ?', (int((time.time() - cfg.history['days'] * 86400) * 1000),)).rowcount
+                    expired = time.time()
+                    logging.debug('Deleted ' + str(deleted) + ' readings from history older than ' + str(cfg.history['days']) + ' days')
+        except sqlite3.Error as e:
+            logging.error('Unable to write ' + str(len(rows)) + ' readings to history: ' + str(e))
+            # keys added in the failed transaction were rolled back, reopen and reload them next flush
+            db.close()
+            db = None
+
+def start():
+    #############################################################################
+    # Function: start                                                           #
+    # Purpose:  Starts the history writer thread                                #
+    # @param    none                                                            #
+    #                                                                           #
+    # @return   none                                                            #
+    #############################################################################
+    threading.Thread(target=writer, name='history', daemon=True).start()
+    logging.info('Keeping ' + str(cfg.history['days']) + ' days of history in ' + cfg.history['dbfile'])
+
+def keys():
+    #############################################################################
+    # Function: keys                                                            #
+    # Purpose:  Lists the sensor ids and telemetry keys held in the history     #
+    # @param    none                                                            #
+    #                                                                           #
+    # @return   dict of sensor id -> list of keys                               #
+    #############################################################################
+    db = connect()
+    try:
+        found = {}
+        for sensor, key in db.execute('SELECT sensor, key FROM keys ORDER BY sensor, key'):
+            found.setdefault(sensor, []).append(key)
+        return found
+    finally:
+        db.close()
+
+def query(_sensor, _key, _start, _end, _step=0):
+    #############################################################################
+    # Function: query                                                           #
+    # Purpose:  Reads the history of one key between two times, as it is or     #
+    #           downsampled into _step second buckets                           #
+    # @param    _sensor    sensor id                                            #
+    # @param    _key       telemetry key                                        #
+    # @param    _start     start of the range, in ms                            #
+    # @param    _end       end of the range, in ms                              #
+    # @param    _step      bucket length in seconds, 0 for every reading        #
+    #                                                                           #
+    # @return   list of [ts, value] or [ts, avg, min, max, count]               #
+    #############################################################################
+    db = connect()
+    try:
+        found = db.execute('SELECT id FROM keys WHERE sensor = ? AND key = ?', (str(_sensor), _key)).fetchone()
+        if found is None:
+            return []
+        if _step > 0:
+            step = int(_step * 1000)
+            rows = db.execute('SELECT ts / ? * ?, AVG(value), MIN(value), MAX(value), COUNT(*) FROM readings '
+                              'WHERE key = ? AND ts >= ? AND ts < ? GROUP BY ts / ? ORDER BY 1',
+                              (step, step, found[0], int(_start), int(_end), step))
+            return [[ts, round(avg, 2), low, high, n] for ts, avg, low, high, n in rows]
+        rows = db.execute('SELECT ts, value FROM readings WHERE key = ? AND ts >= ? AND ts < ? ORDER BY ts',
+                          (found[0], int(_start), int(_end)))
+        return [list(row) for row in rows]
+    finally:
+        db.close()
+
+def parse_time(_value):
+    #############################################################################
+    # Function: parse_time                                                      #
+    # Purpose:  Reads a command line time, 'YYYY-MM-DD', 'YYYY-MM-DD HH:MM' or  #
+    #           ms since the epoch                                              #
+    #############################################################################
+    for format in ('%Y-%m-%d %H:%M', '%Y-%m-%d'):
+        try:
+            return time.mktime(time.strptime(_value, format)) * 1000
+        except ValueError:
+            continue
+    return float(_value)
+
+def main():
+    parser = argparse.ArgumentParser(description='Query the local history of published readings')
+    parser.add_argument('--db', default=cfg.history['dbfile'], help='history database file')
+    commands = parser.add_subparsers(dest='command')
+    commands.add_parser('keys', help='list the sensor ids and keys held')
+    ranged = commands.add_parser('range', help='readings of one key over a time range')
+    ranged.add_argument('sensor', help='sensor id')
+    ranged.add_argument('key', help='telemetry key, e.g. temp')
+    ranged.add_argument('--from', dest='start', type=parse_time, help='start time, default --hours ago')
+    ranged.add_argument('--to', dest='end', type=parse_time, help='end time, default now')
+    ranged.add_argument('--hours', type=float, default=24, help='length of the range when --from is not given')
+    ranged.add_argument('--step', type=float, default=0, help='downsample into buckets of this many seconds')
+    ranged.add_argument('--csv', action='store_true', help='print CSV instead of JSON')
+    args = parser.parse_args()
+    cfg.history['dbfile'] = args.db
+    if not os.path.exists(args.db):
+        print('No history database at ' + args.db)
+        return 1
+
+    if args.command == 'keys':
+        print(json.dumps(keys(), indent=1))
+        return 0
+    if args.command != 'range':
+        parser.print_help()
+        return 1
+    end = args.end if args.end is not None else time.time() * 1000
+    start = args.start if args.start is not None else end - args.hours * 3600000
+    rows = query(args.sensor, args.key, start, end, args.step)
+    if args.csv:
+        print('ts,avg,min,max,count' if args.step > 0 else 'ts,value')
+        for row in rows:
+            print(','.join(str(value) for value in row))
+    else:
+        print(json.dumps(rows))
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,272 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import os
+import re
+import sys
+import json                  # Used for data manipulation
+import time                  # Usef for timestamps, etc
+import argparse
+import threading
+import logging
+from concurrent.futures import ThreadPoolExecutor
+import config as cfg         # Bring in config.py configuration file
+import common as com         # Bring in common.py shared functions
+
+'''
+========================================================================================================
+SYNOPSIS
+    'import_cache.py' uploads cache directories collected from devices with no connectivity to the
+        Thingsboard server configured in 'config.py'.
+
+DESCRIPTION
+    The given files and directories are searched for cache files, which are grouped by the authkey in
+        their name (<authkey>_<date>.cache, or <authkey>-<date>.cache as written by the generator).
+        Devices are uploaded concurrently, each one's files oldest first, with records sent in batches
+        as JSON arrays through the same HTTP transport as 'monitor.py' (proxy, timeouts, compression).
+
+    Every accepted batch is recorded in a journal file as the byte offset reached in its cache file.
+        Running the same command again after an interruption skips whatever the journal shows as
+        already sent, so an import can be stopped and resumed at any point.
+
+        import_cache.py /mnt/usb/site1/cache /mnt/usb/site2/cache --workers 8 --batch 500
+
+        --workers   devices uploaded at the same time (default 4)
+        --batch     records per request (default 500)
+        --journal   journal file (default import.journal)
+        --retries   attempts per batch before a device is given up on (default 5)
+
+REQUIRES
+    The following requirements must be met
+        Thingsboard Server      As configured in config.py, it is the destination
+                                to which information is sent.
+        Thingsboard Device      Each authkey found must be a device on the server
+
+AUTHOR
+    Bob Perciaccante - Bob@perciaccante.net
+
+========================================================================================================
+'''
+
+progress = {
+    'bytes_total': 0,
+    'bytes_done': 0,
+    'bytes_resumed': 0,                           # part of bytes_done sent by earlier runs, see the journal
+    'records': 0,
+    'devices_done': 0,
+    'devices_failed': 0
+    }
+journal = {}                  # cache file -> byte offset already uploaded
+lock = threading.Lock()       # protects progress, journal and the journal file
+
+
+def find_cache_files(paths):
+    #############################################################################
+    # Function: find_cache_files                                                #
+    # Purpose:  Walks the given files and directories for cache files and       #
+    #           groups them by the authkey in the file name                     #
+    # @param    paths      list of files and/or directories                     #
+    #                                                                           #
+    # @return   dict of authkey -> list of cache files, oldest first            #
+    #############################################################################
+    found = []
+    for path in paths:
+        if os.path.isdir(path):
+            for root, dirs, files in os.walk(path):
+                found.extend(os.path.join(root, name) for name in files)
+        else:
+            found.append(path)
+    devices = {}
+    for path in found:
+        match = re.match(r'^(.+)[_-](\d{4}-\d{2}-\d{2})\.cache$', os.path.basename(path))
+        if match:
+            devices.setdefault(match.group(1), []).append((match.group(2), os.path.abspath(path)))
+    return dict((authkey, [p for d, p in sorted(files)]) for authkey, files in devices.items())
+
+
+def load_journal(path):
+    #############################################################################
+    # Function: load_journal                                                    #
+    # Purpose:  Reads the offsets reached by earlier runs of the import         #
+    # @param    path       journal file                                         #
+    #                                                                           #
+    # @return   none                                                            #
+    #############################################################################
+    if not os.path.exists(path):
+        return
+    with open(path) as f:
+        for line in f:
+            try:
+                entry = json.loads(line)
+                journal[entry['file']] = max(journal.get(entry['file'], 0), entry['offset'])
+            except (ValueError, KeyError):
+                continue              # a line cut short when the last run was interrupted
+
+
+def mark(journal_file, path, offset, records, nbytes):
+    #############################################################################
+    # Function: mark                                                            #
+    # Purpose:  Records an accepted batch in the journal and the progress       #
+    # @param    journal_file  journal file to append to                         #
+    # @param    path       cache file the batch came from                       #
+    # @param    offset     byte offset in the file after the batch              #
+    # @param    records    records in the batch                                 #
+    # @param    nbytes     bytes of the file covered by the batch               #
+    #                                                                           #
+    # @return   none                                                            #
+    #############################################################################
+    with lock:
+        journal[path] = offset
+        with open(journal_file, 'a') as f:
+            f.write(json.dumps({'file': path, 'offset': offset}) + '\n')
+        progress['records'] = progress['records'] + records
+        progress['bytes_done'] = progress['bytes_done'] + nbytes
+
+
+def send_batch(url, lines, retries):
+    #############################################################################
+    # Function: send_batch                                                      #
+    # Purpose:  Posts one batch, retrying with backoff on connection errors     #
+    #           and server errors                                               #
+    # @param    url        telemetry URL of the device                          #
+    # @param    lines      cached records, one JSON object each                 #
+    # @param    retries    attempts before giving up                            #
+    #                                                                           #
+    # @return   HTTP status code of the last attempt, or None if unreachable    #
+    #############################################################################
+    status = None
+    for attempt in range(retries):
+        try:
+            status = com.http_post(url, '[' + ','.join(lines) + ']').status_code
+            if status < 500:
+                return status
+        except Exception as e:
+            logging.warning('Upload to ' + url + ' failed: ' + str(e))
+        if attempt < retries - 1:
+            time.sleep(min(2 ** attempt, 60))
+    return status
+
+
+def import_device(authkey, files, args):
+    #############################################################################
+    # Function: import_device                                                   #
+    # Purpose:  Uploads the cache files of one device in order, starting each   #
+    #           file from the offset in the journal                             #
+    # @param    authkey    device the files belong to                           #
+    # @param    files      cache files of the device, oldest first              #
+    # @param    args       command line arguments (batch, retries, journal)     #
+    #                                                                           #
+    # @return   True if every file was uploaded                                 #
+    #############################################################################
+    url = cfg.conn['method'] + '://' + cfg.conn['server'] + '/api/v1/' + authkey + '/telemetry'
+    for path in files:
+        offset = journal.get(path, 0)
+        with open(path, 'rb') as f:
+            f.seek(offset)
+            batch = []
+            start = offset
+            for raw in f:
+                offset = offset + len(raw)
+                line = raw.decode('utf-8', 'replace').strip()
+                if line:
+                    batch.append(line)
+                if len(batch) < args.batch:
+                    continue
+                status = send_batch(url, batch, args.retries)
+                if status != 200:
+                    return give_up(authkey, path, status)
+                mark(args.journal, path, offset, len(batch), offset - start)
+                batch = []
+                start = offset
+            if batch:
+                status = send_batch(url, batch, args.retries)
+                if status != 200:
+                    return give_up(authkey, path, status)
+            if offset > start or batch:
+                mark(args.journal, path, offset, len(batch), offset - start)
+    with lock:
+        progress['devices_done'] = progress['devices_done'] + 1
+    return True
+
+
+def give_up(authkey, path, status):
+    #############################################################################
+    # Function: give_up                                                         #
+    # Purpose:  Logs a device that could not be uploaded.  It resumes from the  #
+    #           journal on the next run                                         #
+    # @param    authkey    device being uploaded                                #
+    # @param    path       cache file it stopped in                             #
+    # @param    status     last HTTP status code, None if unreachable           #
+    #                                                                           #
+    # @return   False                                                           #
+    #############################################################################
+    logging.error('Giving up on device ' + authkey + ' at ' + path + ', last status ' + str(status))
+    with lock:
+        progress['devices_failed'] = progress['devices_failed'] + 1
+    return False
+
+
+def report(start, devices):
+    #############################################################################
+    # Function: report                                                          #
+    # Purpose:  Prints a one line progress and throughput report, the rates     #
+    #           counting only what this run has sent                            #
+    # @param    start      time the upload started                              #
+    # @param    devices    number of devices being uploaded                     #
+    #                                                                           #
+    # @return   none                                                            #
+    #############################################################################
+    with lock:
+        elapsed = max(time.time() - start, 0.001)
+        percent = 100.0 * progress['bytes_done'] / max(progress['bytes_total'], 1)
+        print('%5.1f%%  %d records  %d rec/s  %.2f MB/s  devices: %d done, %d failed, %d total' % \
+            (percent,
+             progress['records'],
+             progress['records'] / elapsed,
+             (progress['bytes_done'] - progress['bytes_resumed']) / elapsed / 2**20,
+             progress['devices_done'],
+             progress['devices_failed'],
+             devices))
+    sys.stdout.flush()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Upload collected cache directories to the Thingsboard server')
+    parser.add_argument('paths', nargs='+', help='cache files or directories to import')
+    parser.add_argument('--workers', type=int, default=4, help='devices uploaded at the same time')
+    parser.add_argument('--batch', type=int, default=500, help='records per request')
+    parser.add_argument('--journal', default='import.journal', help='journal file used to resume an import')
+    parser.add_argument('--retries', type=int, default=5, help='attempts per batch before giving up on a device')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO,
+                        format="%(asctime)s - [%(levelname)s] [%(threadName)s] (%(module)s:%(lineno)d) %(message)s")
+    devices = find_cache_files(args.paths)
+    if not devices:
+        print('No cache files found in ' + ', '.join(args.paths))
+        return 1
+    load_journal(args.journal)
+
+    for files in devices.values():
+        for path in files:
+            size = os.path.getsize(path)
+            progress['bytes_total'] = progress['bytes_total'] + size
+            progress['bytes_resumed'] = progress['bytes_resumed'] + min(journal.get(path, 0), size)
+    progress['bytes_done'] = progress['bytes_resumed']
+    print('Found ' + str(sum(len(f) for f in devices.values())) + ' cache files for ' + str(len(devices)) + ' devices')
+
+    start = time.time()
+    with ThreadPoolExecutor(max_workers=args.workers) as pool:
+        jobs = [pool.submit(import_device, authkey, files, args) for authkey, files in devices.items()]
+        while not all(job.done() for job in jobs):
+            time.sleep(5)
+            report(start, len(devices))
+    for job in jobs:
+        if job.exception() is not None:
+            logging.error('Unexpected error in import: ' + str(job.exception()))
+            progress['devices_failed'] = progress['devices_failed'] + 1
+    report(start, len(devices))
+    return 0 if progress['devices_failed'] == 0 else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,11 +1,19 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 import os
+import copy
+import types
 import json                  # Used for data manipulation
 import time                  # Usef for timestamps, etc
 import requests              # Used to generate HTTP GET and POST actions
 import config as cfg         # Bring in config.py configuration file
 import common as com         # Bring in common.py shared functions
+import encode                # Integer millisecond timestamps
+import aggregate             # Windowed statistics for sensors sampled between polls
+import adaptive              # Poll intervals for sensors with the 'adaptive' setting
+import snapshot              # Latest readings served to other local processes
+import history               # Local history database of published readings
+import warmstart             # Runtime state kept across restarts
 import logging
 
 '''
@@ -49,25 +57,414 @@ me = {
     }
 
 
-def main():
-    # Set basic logging configuration
-    if cfg.settings['debug'] == 1:
-        logging.basicConfig(level=logging.DEBUG,
-                        format="%(asctime)s - [%(levelname)s] [%(threadName)s] (%(module)s:%(lineno)d) %(message)s",
-                        filename=cfg.logfile)
-    elif cfg.settings['debug'] == 0:
-        logging.basicConfig(level=logging.INFO,
-                        format="%(asctime)s - [%(levelname)s] [%(threadName)s] (%(module)s:%(lineno)d) %(message)s",
-                        filename=cfg.logfile)
+fast_due = {}                # next fast sample time per sensor id (sampling or in alarm), see nap()
+poll_due = {}                # next poll time per sensor id, for sensors with the 'adaptive' setting (or resumed, see resume())
+polled = {}                  # last poll time per sensor id
+
+# Hot reload of config.py, see reload_config().  Sections in 'reloaded' are updated in place, changes to those
+#    in 'restart' are only logged, since they set up connections, threads and files at startup
+reloaded = ('settings', 'breaker', 'pipeline', 'compression', 'http_headers', 'aggregation', 'adaptive',
+            'read_timeouts', 'owm_settings', 'wund_settings', 'owm_url', 'owm_group_url', 'wund_url')
+restart = ('conn', 'proxies', 'logs', 'supervisor', 'snapshot', 'history', 'bridge', 'warmstart')
+config_seen = {'mtime': None, 'values': None}   # config.py as last loaded
+sensor_filter = None         # if set, only sensors it returns True for are kept on reload (see supervisor.py)
+
+
+def read_reading(item, fast=False):
+    #############################################################################
+    # Function: read_reading                                                    #
+    # Purpose:  Reads one configured sensor (plus system information if set)    #
+    #           and merges the result into one telemetry message                #
+    # @param    item       sensor definition from config.py                     #
+    # @param    fast       if True, only the quick system counters are read -   #
+    #                      used for the extra samples taken between polls       #
+    #                                                                           #
+    # @return   (message, ts)  telemetry and the time it was taken, in ms       #
+    #############################################################################
+    message = {}
+    set = item['settings']
+    attr = item['attr']
+    tele = item['tele']
+
+    # Get system information (CPU, Ram, etc) if configured
+    if set['sys_info'] == 1 and not fast:
+        sys_info = com.read_sys_stats()
+        for key, value in sys_info['attr'].items():
+            attr[key] = value
+        for key, value in sys_info['tele'].items():
+            message[key] = value
+    elif set['sys_info'] == 1 and set.get('sample', 0) > 0:
+        message.update(com.read_sys_sample())
+
+    # Gather sensor data and add to the telemetry data, timestamped when it was taken
+    conditions = com.read_sensor(tele['device'],tele['type'],tele['label'])
+    ts = encode.now_ms()
+
+    # Since not all sensors will not add attributes, if there are none returned, then continue
+    try:
+        for key, value in conditions['attr'].items():
+            attr[key] = value
+    except:
+        None
+    for key, value in conditions['tele'].items():
+        message[key] = value
+
+    # Every reading taken, including samples between polls, is the latest one for local clients
+    if cfg.snapshot['enabled'] == 1:
+        snapshot.update(item, message, ts)
+
+    # Keep the high rate samples for the windowed min/max/avg (a stale reading is only a repeat)
+    if set.get('sample', 0) > 0 and message.get('stale' + tele['label']) != 1:
+        aggregate.add(item['id'], message, ts, set.get('window', 60))
+    return (message, ts)
+
+
+def send_reading(item, message, ts, priority):
+    #############################################################################
+    # Function: send_reading                                                    #
+    # Purpose:  Publishes a reading, through the publisher queue when the       #
+    #           pipeline is enabled so a slow server never holds up sampling,   #
+    #           and keeps it in the local history                               #
+    # @param    item       sensor definition from config.py                     #
+    # @param    message    telemetry to publish                                 #
+    # @param    ts         time the reading was taken, in ms                    #
+    # @param    priority   0 for alarms, 1 for routine readings                 #
+    #                                                                           #
+    # @return   none                                                            #
+    #############################################################################
+    set = item['settings']
+    if cfg.history['enabled'] == 1:
+        history.record(item, message, ts)
+    if cfg.pipeline['enabled'] == 1:
+        com.enqueue({'ts': ts,
+                     'authkey': item['authkey'],
+                     'attr': dict(item['attr']),
+                     'tele': message,
+                     'cache_on_err': set['cache_on_err'],
+                     'localonly': set['localonly']}, priority)
     else:
-        logging.basicConfig(level=logging.DEBUG,
-                    format="%(asctime)s - [%(levelname)s] (%(module)s:%(lineno)d) %(message)s")
+        pub_status = com.publish(item['attr'],message,item['authkey'],set['cache_on_err'],set['localonly'],ts)
+
+
+def poll_sensor(item):
+    #############################################################################
+    # Function: poll_sensor                                                     #
+    # Purpose:  Reads one configured sensor, checks its alarm thresholds and    #
+    #           publishes the result.  Sensors that are sampled between polls   #
+    #           publish the min/max/avg/count of their window along with it     #
+    # @param    item       sensor definition from config.py                     #
+    #                                                                           #
+    # @return   none                                                            #
+    #############################################################################
+    set = item['settings']
+    message, ts = read_reading(item)
+
+    # Evaluate the alarm thresholds locally, so an excursion is published now rather than after the
+    #    next poll and a round trip through the server rule chain
+    priority = 1
+    if set.get('alarm', 0) == 1:
+        state, changed = com.check_thresholds(item, message)
+        message['alarm' + item['tele']['label']] = state
+        if state != 'normal' or changed:
+            priority = 0
+
+    if set.get('sample', 0) > 0:
+        message.update(aggregate.summary(item['id'], ts, set.get('window', 60)))
+
+    # Adaptive sensors are polled again sooner when their readings are changing quickly
+    if set.get('adaptive', 0) == 1:
+        interval = adaptive.update(item, message, ts)
+        poll_due[item['id']] = ts / 1000.0 + interval
+        message['interval' + item['tele']['label']] = interval
+    else:
+        poll_due.pop(item['id'], None)    # back in the normal poll cycle after a resumed start
+
+    polled[item['id']] = ts / 1000.0
+    send_reading(item, message, ts, priority)
+
+
+def sample_sensor(item):
+    #############################################################################
+    # Function: sample_sensor                                                   #
+    # Purpose:  Extra reading taken between polls, for sensors with 'sample'    #
+    #           set or in alarm.  The reading goes into the sensor's window and #
+    #           is only published on its own while the sensor is in alarm, or   #
+    #           when its alarm state changes                                    #
+    # @param    item       sensor definition from config.py                     #
+    #                                                                           #
+    # @return   none                                                            #
+    #############################################################################
+    message, ts = read_reading(item, fast=True)
+    if item['settings'].get('alarm', 0) == 1:
+        state, changed = com.check_thresholds(item, message)
+        message['alarm' + item['tele']['label']] = state
+        if state != 'normal' or changed:
+            send_reading(item, message, ts, 0)
+
+
+def fast_interval(item):
+    #############################################################################
+    # Function: fast_interval                                                   #
+    # Purpose:  Works out how often a sensor is sampled between polls: every    #
+    #           'sample' seconds, or every 'alarm_wait' seconds while in alarm  #
+    # @param    item       sensor definition from config.py                     #
+    #                                                                           #
+    # @return   seconds between samples, or None if it is only read on polls    #
+    #############################################################################
+    set = item['settings']
+    waits = []
+    if set.get('sample', 0) > 0:
+        waits.append(set['sample'])
+    if set.get('alarm_wait', 0) > 0 and com.alarms.get(item['id'], 'normal') != 'normal':
+        waits.append(set['alarm_wait'])
+    if set['active'] != 1 or not waits:
+        return None
+    return min(waits)
+
+
+def nap(seconds):
+    #############################################################################
+    # Function: nap                                                             #
+    # Purpose:  Waits between polls, while taking the extra samples of sensors  #
+    #           that are sampled at a high rate or are in alarm, and polling    #
+    #           adaptive sensors whose interval is up                           #
+    # @param    seconds    how long to wait                                     #
+    #                                                                           #
+    # @return   none                                                            #
+    #############################################################################
+    until = time.time() + seconds
+    while True:
+        now = time.time()
+        for item in cfg.sensors:
+            interval = fast_interval(item)
+            if interval is None:
+                fast_due.pop(item['id'], None)
+                continue
+            due = fast_due.setdefault(item['id'], now + interval)
+            if due <= now:
+                fast_due[item['id']] = max(due + interval, now)
+                sample_sensor(item)
+        for item in cfg.sensors:
+            if item['settings']['active'] == 1 and poll_due.get(item['id'], float('inf')) <= time.time():
+                poll_sensor(item)
+        if time.time() >= until:
+            return
+        wake = min([until] + list(fast_due.values()) + list(poll_due.values()))
+        time.sleep(max(0, min(1, wake - time.time())))
+
+
+def load_config():
+    #############################################################################
+    # Function: load_config                                                     #
+    # Purpose:  Runs config.py into a fresh namespace, without touching the     #
+    #           configuration in use                                            #
+    # @param    none                                                            #
+    #                                                                           #
+    # @return   dict of the settings in config.py, leaving out the modules it   #
+    #           imports and the names Python adds                               #
+    #############################################################################
+    path = os.path.splitext(cfg.__file__)[0] + '.py'
+    values = {'__file__': path, '__name__': 'config'}
+    with open(path) as f:
+        exec(compile(f.read(), path, 'exec'), values)
+    return dict((name, value) for name, value in values.items()
+                if not name.startswith('__') and not isinstance(value, types.ModuleType))
+
+
+def validate_sensors(sensors):
+    #############################################################################
+    # Function: validate_sensors                                                #
+    # Purpose:  Checks a sensor list has everything the polling loop uses       #
+    # @param    sensors    sensor list from config.py                           #
+    #                                                                           #
+    # @return   None if it is valid, else a description of the first problem    #
+    #############################################################################
+    if not isinstance(sensors, list):
+        return 'sensors is not a list'
+    ids = set()
+    for item in sensors:
+        try:
+            if item['id'] in ids:
+                return 'sensor id ' + str(item['id']) + ' is used twice'
+            ids.add(item['id'])
+            if not isinstance(item['authkey'], str) or not isinstance(item['attr'], dict):
+                return 'sensor ' + str(item['id']) + ' needs an authkey string and an attr dict'
+            for key in ('active', 'sys_info', 'cache_on_err', 'clearcache', 'localonly'):
+                if item['settings'][key] not in (0, 1):
+                    return 'sensor ' + str(item['id']) + ' setting ' + key + ' must be 0 or 1'
+            for key in ('type', 'device', 'label'):
+                if key not in item['tele']:
+                    return 'sensor ' + str(item['id']) + ' tele needs ' + key
+        except (KeyError, TypeError) as e:
+            return 'sensor ' + str(item.get('id') if isinstance(item, dict) else item) + ' is missing ' + str(e)
+    return None
+
+
+def validate_adaptive(adaptive, sensors):
+    #############################################################################
+    # Function: validate_adaptive                                               #
+    # Purpose:  Checks the 'poll_change' of the adaptive section, and of the    #
+    #           sensors overriding it, is above 0, as intervals are divided by  #
+    #           it (see adaptive.py)                                            #
+    # @param    adaptive   adaptive section from config.py                      #
+    # @param    sensors    sensor list from config.py                           #
+    #                                                                           #
+    # @return   None if it is valid, else a description of the first problem    #
+    #############################################################################
+    found = [('adaptive', adaptive.get('poll_change'))]
+    found.extend(('sensor ' + str(item['id']), item['settings']['poll_change'])
+                 for item in sensors if 'poll_change' in item['settings'])
+    for name, change in found:
+        if isinstance(change, bool) or not isinstance(change, (int, float)) or change <= 0:
+            return name + ' poll_change must be a number above 0, not ' + str(change)
+    return None
+
+
+def reload_config():
+    #############################################################################
+    # Function: reload_config                                                   #
+    # Purpose:  Checks if config.py has changed since it was last loaded and,   #
+    #           if the new file is valid, applies only what changed: sensors    #
+    #           are added, removed or retuned by id, keeping the state of the   #
+    #           ones left alone (alarms, windows, schedules, cache, connections)#
+    #           and the sections in 'reloaded' are updated in place             #
+    # @param    none                                                            #
+    #                                                                           #
+    # @return   none                                                            #
+    #############################################################################
+    path = os.path.splitext(cfg.__file__)[0] + '.py'
+    try:
+        mtime = os.path.getmtime(path)
+    except OSError:
+        return
+    if mtime == config_seen['mtime']:
+        return
+    first = config_seen['mtime'] is None
+    config_seen['mtime'] = mtime
+    try:
+        new = load_config()
+    except Exception as e:
+        logging.error('Not reloading config.py, it does not load: ' + str(e))
+        return
+    if first:
+        # the file as started with, later changes are compared to this.  A copy, as the
+        # sensors in cfg.sensors gather attributes while running
+        config_seen['values'] = copy.deepcopy(new)
+        return
+    problem = validate_sensors(new.get('sensors'))
+    if problem is None:
+        problem = validate_adaptive(new.get('adaptive', {}), new['sensors'])
+    if problem is not None:
+        logging.error('Not reloading config.py: ' + problem)
+        return
+    old = config_seen['values']
+    config_seen['values'] = copy.deepcopy(new)
+
+    for name in restart:
+        if new.get(name) != old.get(name):
+            logging.warning('config.py: changes to ' + name + ' take effect when the monitor is restarted')
+    for name in reloaded:
+        if name not in new or new[name] == old.get(name):
+            continue
+        if isinstance(getattr(cfg, name, None), dict):
+            getattr(cfg, name).clear()
+            getattr(cfg, name).update(copy.deepcopy(new[name]))
+        else:
+            setattr(cfg, name, new[name])
+        logging.info('config.py: reloaded ' + name)
+        if name == 'settings' and new[name].get('debug') != old[name].get('debug'):
+            com.setup_logging()
+    com.load_destinations()                         # built once here rather than on every publish
+
+    sensors = [item for item in new['sensors'] if sensor_filter is None or sensor_filter(item)]
+    before = dict((item['id'], item) for item in old['sensors'])
+    current = dict((item['id'], item) for item in cfg.sensors)
+    applied = []
+    added = removed = changed = 0
+    for item in sensors:
+        if item['id'] in current and before.get(item['id']) == item:
+            applied.append(current[item['id']])     # unchanged, keeps the attributes gathered so far
+            continue
+        if item['id'] not in current:
+            added = added + 1
+        else:
+            changed = changed + 1
+            if before.get(item['id'], current[item['id']])['tele'] != item['tele']:
+                forget_sensor(item['id'])           # a different source, nothing learnt so far applies
+            else:
+                poll_due.pop(item['id'], None)      # retuned, schedule it afresh
+                fast_due.pop(item['id'], None)
+        applied.append(item)
+    kept = set(item['id'] for item in applied)
+    for id in current:
+        if id not in kept:
+            removed = removed + 1
+            forget_sensor(id)
+    cfg.sensors = applied
+    logging.info('config.py reloaded: ' + str(added) + ' sensors added, ' + str(removed) + ' removed, ' + str(changed) + ' changed, ' + str(len(applied) - added - changed) + ' unchanged')
+
+
+def forget_sensor(id):
+    #############################################################################
+    # Function: forget_sensor                                                   #
+    # Purpose:  Drops what the monitor keeps about a sensor between readings    #
+    # @param    id         sensor id                                            #
+    #                                                                           #
+    # @return   none                                                            #
+    #############################################################################
+    for state in (poll_due, polled, fast_due, com.alarms, adaptive.estimates):
+        state.pop(id, None)
+    with aggregate.lock:
+        aggregate.windows.pop(id, None)
+    with snapshot.changed:
+        snapshot.latest.pop(str(id), None)
+
+
+def scheduler():
+    #############################################################################
+    # Function: scheduler                                                       #
+    # Purpose:  Poll times saved by warmstart.py                                #
+    #############################################################################
+    return {'poll_due': poll_due, 'polled': polled}
+
+
+def resume(restored):
+    #############################################################################
+    # Function: resume                                                          #
+    # Purpose:  Carries on the poll cycle from before a restart: sensors polled #
+    #           less than a cycle ago wait until a cycle after that poll, so a  #
+    #           restart does not read and publish every sensor at once          #
+    # @param    restored   'poll_due' and 'polled' from warmstart.restore()     #
+    #                                                                           #
+    # @return   none                                                            #
+    #############################################################################
+    now = time.time()
+    active = [item for item in cfg.sensors if item['settings']['active'] == 1]
+    cycle = me['wait'] + me['sleep_poll'] * len(active)
+    polled.update(restored['polled'])
+    for item in active:
+        if item['settings'].get('adaptive', 0) == 1:
+            due = restored['poll_due'].get(item['id'], 0)
+        else:
+            due = restored['polled'].get(item['id'], 0) + cycle
+        if due > now:
+            poll_due[item['id']] = min(due, now + cycle + cfg.adaptive['poll_max'])
+    logging.info('Resuming the poll cycle, ' + str(len(poll_due)) + ' of ' + str(len(active)) + ' active sensors not due yet')
+
+
+def main():
+    # Set logging configuration - records are written by a background thread, see common.setup_logging
+    com.setup_logging()
     
     # Before starting everything, make sure that the cache and log directories are available
     #     since these are critical to operation
     if os.path.exists(cfg.logs['logdir']) != True or os.path.exists(cfg.logs['cachedir']) != True:
         logging.warn('unable to write to logfile')
         return
+    problem = validate_adaptive(cfg.adaptive, cfg.sensors)
+    if problem is not None:
+        logging.error('config.py: ' + problem)
+        return
 
     # Send initial information to the logfile to facilitate 
     logging.info('=================================================================')
@@ -101,13 +498,49 @@ def main():
         
     logging.info('Total Sensors Configured: ' + str(sensors['total']) + ', Active: '+str(sensors['active']))
 
+    # Pick up where the last run left off before anything is published
+    if cfg.warmstart['enabled'] == 1:
+        resume(warmstart.restore())
+        warmstart.start(scheduler)
+
+    if cfg.pipeline['enabled'] == 1:
+        com.start_publishers()
+    if cfg.snapshot['enabled'] == 1:
+        snapshot.start()
+    if cfg.history['enabled'] == 1:
+        history.start()
+    reload_config()              # remember config.py as started with, to spot later changes
+    if cfg.warmstart['enabled'] == 1:
+        warmstart.jitter()
+
+    try:
+        poll_loop()
+    finally:
+        com.spill_outbox()
+        if cfg.warmstart['enabled'] == 1:
+            warmstart.save(scheduler())
+
+
+def poll_loop():
+    #############################################################################
+    # Function: poll_loop                                                       #
+    # Purpose:  Polls every active sensor in turn, then waits for the next run  #
+    # @param    none                                                            #
+    #                                                                           #
+    # @return   none (runs forever)                                             #
+    #############################################################################
     # Run through the sensor information, and process where configured as "active'
     while True:
         logging.debug('Running sensor poll')
+        reload_config()
         com.chk_cache()
         logging.debug('Checking cache status')
+        com.trim_cache()
+
+        # Fetch all the OpenWeatherMaps locations for this poll up front, in as few requests as possible
+        com.fetch_owm([item['tele']['device'] for item in cfg.sensors
+                       if item['settings']['active'] == 1 and item['tele']['type'] == 'owm'])
         for item in cfg.sensors:
-            message = {}
             set = item['settings']
 
             # If the sensor is configured to clear exsiting cache, check and run
@@ -115,36 +548,16 @@ def main():
                 logging.debug('Preparing to clear cache files')
                 com.clear_cache(item['authkey'])
 
-            # Check to see if the device is configured to be active - if not, then skip
-            if set['active'] == 1:
-                attr = item['attr']
-                tele = item['tele']
-                
-                # Get system information (CPU, Ram, etc) if configured
-                if set['sys_info'] == 1:
-                    sys_info = com.read_sys_stats()
-                    for key, value in sys_info['attr'].items():
-                        attr[key] = value
-                    for key, value in sys_info['tele'].items():
-                        message[key] = value
-
-                # Gather sensor data and add to the telemetry data
-                conditions = com.read_sensor(tele['device'],tele['type'],tele['label'])
-
-                # Since not all sensors will not add attributes, if there are none returned, then continue
-                try:
-                    for key, value in conditions['attr'].items():
-                        attr[key] = value
-                except:
-                    None
-                for key, value in conditions['tele'].items():
-                    message[key] = value
-
-                pub_status = com.publish(attr,message,item['authkey'],set['cache_on_err'],set['localonly'])
-                time.sleep(me['sleep_poll'])
-
-        logging.debug('Completed sensor poll')            
-        time.sleep(me['wait'])
+            # Check to see if the device is configured to be active - if not, then skip.  Adaptive sensors
+            #    are polled when their own interval is up, here or while napping
+            if set['active'] == 1 and poll_due.get(item['id'], 0) <= time.time():
+                poll_sensor(item)
+                nap(me['sleep_poll'])
+        com.clear_owm()
+
+        logging.debug('Completed sensor poll')
+        logging.debug('Counters: ' + str(com.stats))
+        nap(me['wait'])
 
 if __name__ == '__main__':
     main()
\ No newline at end of file
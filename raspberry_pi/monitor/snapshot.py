@@ -0,0 +1,194 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import os
+import json                         # used for processing data
+import time
+import socket
+import socketserver
+import threading
+import logging
+from http.server import BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+import config as cfg                # Bring in shared configuration file
+import history                      # Local history database, served under /history
+
+'''
+========================================================================================================
+SYNOPSIS
+    'snapshot.py' keeps the latest reading of every sensor in memory and serves it to other processes
+        on the same host, so a display or relay controller never has to read the sensors itself.
+        Started by 'monitor.py' when snapshot['enabled'] is set in 'config.py'.
+
+DESCRIPTION
+    Every reading taken by the monitor (polls and the extra samples between them) updates the snapshot:
+        for each sensor, the latest value of every telemetry key with the time it was taken.  The
+        snapshot has a version number that goes up whenever a value changes, so a client can wait for
+        the next change instead of polling.
+
+    The snapshot is served over HTTP on snapshot['host']:snapshot['port'] (localhost by default) and,
+        if snapshot['socket'] is set, on that Unix socket as well:
+
+        GET /latest                         every sensor
+        GET /latest/<sensor id>             one sensor
+        GET /latest?since=<version>&wait=30 waits up to 30 seconds for a version newer than 'since'
+
+        curl http://127.0.0.1:8181/latest
+        curl --unix-socket /run/monitor.sock http://localhost/latest/1
+
+    Each answer is a JSON object with the snapshot 'version' and 'sensors', sensor id -> {'name',
+        'version', 'values': {key: [value, ts]}} with ts in ms.  A sensor's 'version' is the snapshot
+        version when one of its values last changed.
+
+    With history['enabled'] set, the local history is served as well, see 'history.py':
+
+        GET /history                                    sensor ids and keys held
+        GET /history/<sensor id>/<key>?from=&to=&step=  range query, times in ms, step in seconds
+
+AUTHOR
+    Bob Perciaccante - Bob@perciaccante.net
+
+========================================================================================================
+'''
+
+latest = {}                         # sensor id -> {'name', 'version', 'values': {key: [value, ts]}}
+version = 0                         # goes up by one whenever a value in the snapshot changes
+changed = threading.Condition()     # protects latest and version, notified on every change
+servers = []                        # running servers, see start()
+
+def update(_item, _message, _ts):
+    #############################################################################
+    # Function: update                                                          #
+    # Purpose:  Stores a reading in the snapshot and wakes up waiting clients   #
+    #           if any value changed                                            #
+    # @param    _item      sensor definition from config.py                     #
+    # @param    _message   telemetry gathered for the sensor                    #
+    # @param    _ts        time the reading was taken, in ms                    #
+    #                                                                           #
+    # @return   none                                                            #
+    #############################################################################
+    global version
+    ts = int(_ts)
+    with changed:
+        sensor = latest.setdefault(str(_item['id']), {'name': _item['attr'].get('name'), 'version': 0, 'values': {}})
+        new = False
+        for key, value in _message.items():
+            old = sensor['values'].get(key)
+            if old is None or old[0] != value:
+                new = True
+            sensor['values'][key] = [value, ts]
+        if new:
+            version = version + 1
+            sensor['version'] = version
+            changed.notify_all()
+
+def query(_id=None, _since=None, _wait=0):
+    #############################################################################
+    # Function: query                                                           #
+    # Purpose:  Copies the snapshot, first waiting up to _wait seconds for a    #
+    #           version newer than _since                                       #
+    # @param    _id        sensor id, None for every sensor                     #
+    # @param    _since     version the client already has, None not to wait     #
+    # @param    _wait      longest wait in seconds                              #
+    #                                                                           #
+    # @return   dict with 'version' and 'sensors', None for an unknown id       #
+    #############################################################################
+    with changed:
+        if _since is not None:
+            changed.wait_for(lambda: version > _since, min(_wait, cfg.snapshot['wait_max']))
+        if _id is None:
+            sensors = dict((key, copy(sensor)) for key, sensor in latest.items())
+        elif _id in latest:
+            sensors = {_id: copy(latest[_id])}
+        else:
+            return None
+        return {'version': version, 'sensors': sensors}
+
+def copy(_sensor):
+    #############################################################################
+    # Function: copy                                                            #
+    # Purpose:  Copies one sensor's snapshot so it can be sent unlocked         #
+    #############################################################################
+    return {'name': _sensor['name'],
+            'version': _sensor['version'],
+            'values': dict((key, list(value)) for key, value in _sensor['values'].items())}
+
+class Handler(BaseHTTPRequestHandler):
+    #############################################################################
+    # Class:    Handler                                                         #
+    # Purpose:  Answers GET /latest, /latest/<sensor id> and /history requests  #
+    #############################################################################
+    def do_GET(self):
+        url = urlparse(self.path)
+        params = parse_qs(url.query)
+        parts = [part for part in url.path.split('/') if part]
+        if parts and parts[0] == 'history' and cfg.history['enabled'] == 1:
+            return self.do_history(parts, params)
+        if not parts or parts[0] != 'latest' or len(parts) > 2:
+            return self.answer(404, {'error': 'not found'})
+        try:
+            since = int(params['since'][0]) if 'since' in params else None
+            wait = float(params.get('wait', [cfg.snapshot['wait_max']])[0])
+        except ValueError:
+            return self.answer(400, {'error': 'since and wait must be numbers'})
+        result = query(parts[1] if len(parts) == 2 else None, since, wait)
+        if result is None:
+            return self.answer(404, {'error': 'unknown sensor ' + parts[1]})
+        self.answer(200, result)
+
+    def do_history(self, _parts, _params):
+        if len(_parts) == 1:
+            return self.answer(200, history.keys())
+        if len(_parts) != 3:
+            return self.answer(404, {'error': 'not found'})
+        try:
+            end = float(_params.get('to', [time.time() * 1000])[0])
+            start = float(_params.get('from', [end - 86400000])[0])
+            step = float(_params.get('step', [0])[0])
+        except ValueError:
+            return self.answer(400, {'error': 'from, to and step must be numbers'})
+        self.answer(200, history.query(_parts[1], _parts[2], start, end, step))
+
+    def answer(self, _status, _data):
+        body = json.dumps(_data).encode('utf-8')
+        self.send_response(_status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def address_string(self):
+        if isinstance(self.client_address, tuple):
+            return self.client_address[0]
+        return 'unix socket'
+
+    def log_message(self, _format, *_args):
+        logging.debug('Snapshot request from ' + self.address_string() + ': ' + (_format % _args))
+
+class TCPServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+class UnixServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+def start():
+    #############################################################################
+    # Function: start                                                           #
+    # Purpose:  Starts serving the snapshot over HTTP and, if configured, the   #
+    #           Unix socket, each in its own thread                             #
+    # @param    none                                                            #
+    #                                                                           #
+    # @return   none                                                            #
+    #############################################################################
+    try:
+        if cfg.snapshot['port'] > 0:
+            servers.append(TCPServer((cfg.snapshot['host'], cfg.snapshot['port']), Handler))
+        if cfg.snapshot['socket'] and hasattr(socket, 'AF_UNIX'):
+            if os.path.exists(cfg.snapshot['socket']):
+                os.remove(cfg.snapshot['socket'])         # left behind by an earlier run
+            servers.append(UnixServer(cfg.snapshot['socket'], Handler))
+    except (OSError, socket.error) as e:
+        logging.error('Unable to start the snapshot service: ' + str(e))
+    for server in servers:
+        threading.Thread(target=server.serve_forever, name='snapshot', daemon=True).start()
+        logging.info('Serving latest readings on ' + str(server.server_address))
@@ -0,0 +1,216 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import os
+import sys
+import json                  # Used for data manipulation
+import time                  # Usef for timestamps, etc
+import zlib                  # Used for a stable hash of the shard key
+import signal
+import argparse
+import threading
+import logging
+import multiprocessing
+import queue
+import config as cfg         # Bring in config.py configuration file
+import common as com         # Bring in common.py shared functions
+
+'''
+========================================================================================================
+SYNOPSIS
+    'supervisor.py' runs 'monitor.py' as several worker processes, each polling a shard of the sensors
+        in 'config.py', so hosts with hundreds of sensors can use every core.
+
+DESCRIPTION
+    The sensor list is split into shards by a hash of each sensor's authkey (all sensors of a device stay
+        in the same worker) or of its sensor type.  Every worker runs the normal monitor polling loop on
+        its shard, with its own cache directory (cachedir/shard<N>/), its own share of the cache budget
+        and its own log file, so workers never touch each other's files.
+
+    The supervisor restarts workers that exit, waiting longer after each crash of the same worker, and
+        collects the stats counters each worker reports every supervisor['report'] seconds.  The totals
+        and the state of each shard are logged and written to logs/health.json.
+
+        supervisor.py [--workers N] [--shard-by authkey|type]
+
+    Cache files written by a single monitor.py before switching to the supervisor stay in cachedir/,
+        move them into the matching shard directory (or use 'import_cache.py') to have them cleared.
+
+AUTHOR
+    Bob Perciaccante - Bob@perciaccante.net
+
+========================================================================================================
+'''
+
+
+def shard_of(item, shards):
+    #############################################################################
+    # Function: shard_of                                                        #
+    # Purpose:  Picks the shard for a sensor - a stable hash (crc32, the same   #
+    #           on every run) of its authkey or type                            #
+    # @param    item       sensor definition from config.py                     #
+    # @param    shards     number of shards                                     #
+    #                                                                           #
+    # @return   shard number                                                    #
+    #############################################################################
+    if cfg.supervisor['shard_by'] == 'type':
+        key = item['tele']['type']
+    else:
+        key = item['authkey']
+    return zlib.crc32(key.encode('utf-8')) % shards
+
+
+def run_shard(index, shards, reports):
+    #############################################################################
+    # Function: run_shard                                                       #
+    # Purpose:  Worker process - keeps only its shard of the sensors, moves     #
+    #           its cache, log, history and warm start files and snapshot       #
+    #           service aside and runs the monitor loop, reporting its stats    #
+    #           counters to the supervisor                                      #
+    # @param    index      shard number of this worker                          #
+    # @param    shards     number of shards                                     #
+    # @param    reports    queue the stats counters are sent on                 #
+    #                                                                           #
+    # @return   none                                                            #
+    #############################################################################
+    cfg.sensors = [item for item in cfg.sensors if shard_of(item, shards) == index]
+    cfg.logs['cachedir'] = cfg.logs['cachedir'] + 'shard' + str(index) + '/'
+    cfg.logs['cache_max_mb'] = float(cfg.logs['cache_max_mb']) / shards
+    cfg.logfile = cfg.logs['logdir'] + 'shard' + str(index) + '_' + cfg.logs['logfile']
+    cfg.history['dbfile'] = os.path.join(os.path.dirname(cfg.history['dbfile']), 'shard' + str(index) + '_' + os.path.basename(cfg.history['dbfile']))
+    cfg.warmstart['file'] = os.path.join(os.path.dirname(cfg.warmstart['file']), 'shard' + str(index) + '_' + os.path.basename(cfg.warmstart['file']))
+    if cfg.snapshot['port'] > 0:
+        cfg.snapshot['port'] = cfg.snapshot['port'] + 1 + index
+    if cfg.snapshot['socket']:
+        cfg.snapshot['socket'] = cfg.snapshot['socket'] + '.shard' + str(index)
+    if not os.path.exists(cfg.logs['cachedir']):
+        os.makedirs(cfg.logs['cachedir'])
+    com.load_destinations()      # destination cache directories move with the shard
+
+    # a terminate() from the supervisor should still write the queued readings to cache
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+    # the supervisor's log queue came through fork without its writer thread, monitor.main() sets up the
+    #    shard's own logging
+    for handler in logging.root.handlers[:]:
+        logging.root.removeHandler(handler)
+    com.log_listener = None
+
+    import monitor
+    monitor.sensor_filter = lambda item: shard_of(item, shards) == index   # config reloads keep to the shard
+
+    def reporter():
+        while True:
+            with com.lock:
+                stats = dict(com.stats)
+            reports.put((index, time.time(), len(cfg.sensors), stats))
+            time.sleep(cfg.supervisor['report'])
+
+    threading.Thread(target=reporter, name='reporter', daemon=True).start()
+    try:
+        monitor.main()
+    finally:
+        com.stop_logging()       # worker processes skip atexit, write out the queued log records here
+
+
+def write_health(workers, health):
+    #############################################################################
+    # Function: write_health                                                    #
+    # Purpose:  Logs the combined counters of all shards and writes the state   #
+    #           of each shard to logs/health.json                               #
+    # @param    workers    shard number -> worker state                         #
+    # @param    health     shard number -> last report from the worker          #
+    #                                                                           #
+    # @return   none                                                            #
+    #############################################################################
+    totals = {}
+    shards = {}
+    for index, worker in workers.items():
+        report = health.get(index, {})
+        for key, value in report.get('stats', {}).items():
+            totals[key] = totals.get(key, 0) + value
+        shards[str(index)] = {
+            'alive': worker['process'].is_alive(),
+            'pid': worker['process'].pid,
+            'restarts': worker['restarts'],
+            'sensors': report.get('sensors'),
+            'last_report': report.get('time'),
+            'stats': report.get('stats', {})
+            }
+    logging.info('Shards alive: ' + str(sum(1 for s in shards.values() if s['alive'])) + '/' + str(len(shards)) + ', counters: ' + str(totals))
+    try:
+        with open(cfg.logs['logdir'] + 'health.json', 'w') as f:
+            json.dump({'time': time.time(), 'totals': totals, 'shards': shards}, f, indent=1)
+    except IOError as e:
+        logging.warning('Unable to write health file: ' + str(e))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run the monitor as several sharded worker processes')
+    parser.add_argument('--workers', type=int, default=cfg.supervisor['workers'], help='worker processes, 0 for one per core')
+    parser.add_argument('--shard-by', choices=['authkey', 'type'], default=cfg.supervisor['shard_by'])
+    args = parser.parse_args()
+    cfg.supervisor['shard_by'] = args.shard_by
+    shards = args.workers or multiprocessing.cpu_count()
+
+    com.setup_logging("%(asctime)s - [%(levelname)s] [supervisor] (%(module)s:%(lineno)d) %(message)s")
+    if os.path.exists(cfg.logs['logdir']) != True or os.path.exists(cfg.logs['cachedir']) != True:
+        logging.warning('unable to write to logfile')
+        return
+
+    counts = [0] * shards
+    for item in cfg.sensors:
+        counts[shard_of(item, shards)] = counts[shard_of(item, shards)] + 1
+    logging.info('Starting ' + str(shards) + ' workers, sensors per shard by ' + args.shard_by + ': ' + str(counts))
+
+    reports = multiprocessing.Queue()
+    workers = {}
+    health = {}
+    for index in range(shards):
+        workers[index] = {'process': None, 'restarts': 0, 'start_at': 0, 'restart_at': None, 'wait': cfg.supervisor['restart_wait']}
+
+    try:
+        last_health = 0
+        while True:
+            now = time.time()
+            for index, worker in workers.items():
+                process = worker['process']
+                if process is not None and process.is_alive():
+                    # a worker that stayed up a while is healthy again, reset its crash backoff
+                    if now - worker['start_at'] > cfg.supervisor['restart_wait_max']:
+                        worker['wait'] = cfg.supervisor['restart_wait']
+                    continue
+                if process is not None and worker['restart_at'] is None:
+                    logging.warning('Shard ' + str(index) + ' (pid ' + str(process.pid) + ') exited with code ' + str(process.exitcode) + ', restarting in ' + str(worker['wait']) + ' seconds')
+                    worker['restart_at'] = now + worker['wait']
+                    worker['wait'] = min(worker['wait'] * 2, cfg.supervisor['restart_wait_max'])
+                if process is None or now >= worker['restart_at']:
+                    if process is not None:
+                        worker['restarts'] = worker['restarts'] + 1
+                    worker['process'] = multiprocessing.Process(target=run_shard, args=(index, shards, reports), name='shard' + str(index))
+                    worker['process'].start()
+                    worker['start_at'] = now
+                    worker['restart_at'] = None
+
+            while True:
+                try:
+                    index, when, sensors, stats = reports.get_nowait()
+                except queue.Empty:
+                    break
+                health[index] = {'time': when, 'sensors': sensors, 'stats': stats}
+            if now - last_health >= cfg.supervisor['report']:
+                write_health(workers, health)
+                last_health = now
+            time.sleep(1)
+    except KeyboardInterrupt:
+        logging.info('Stopping workers')
+    finally:
+        for worker in workers.values():
+            if worker['process'] is not None and worker['process'].is_alive():
+                worker['process'].terminate()
+        for worker in workers.values():
+            if worker['process'] is not None:
+                worker['process'].join(10)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,149 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import os
+import json                         # used for processing data
+import time
+import random
+import threading
+import logging
+import config as cfg                # Bring in shared configuration file
+import common as com                # Bring in common.py shared functions
+import adaptive                     # Rate of change estimates of adaptive sensors
+import snapshot                     # Latest readings served to other local processes
+
+'''
+========================================================================================================
+SYNOPSIS
+    'warmstart.py' saves what the monitor has learnt while running to a small file, and restores it
+        when the monitor starts again, used by 'monitor.py' when warmstart['enabled'] is set in
+        'config.py'.
+
+DESCRIPTION
+    After a power cut every monitor on a site starts at the same moment.  Starting cold, each one would
+        send every device's attributes again, replay its cache from the first record, poll every sensor
+        at once and lose its alarm states, so the server sees all of that from every host together.
+        The file written every warmstart['checkpoint'] seconds, and on shutdown, holds:
+
+        alarms          alarm state of each sensor, so a sensor in alarm is not reported as new
+        last_read       last good reading per source, returned if the first read after a start hangs
+        adaptive        rate of change estimates, so adaptive sensors keep their interval
+        snapshot        latest values served to local clients, available before the first poll
+        attr_sent       which attributes each server already has, so they are not sent again
+        replayed        how far each cache file has been replayed, so accepted records are skipped;
+                        a cursor is dropped if its file's inode or size no longer match
+        poll_due/polled when each sensor is next due and was last polled, so the poll cycle carries on
+                        where it was rather than polling everything at once
+
+    A file older than warmstart['max_age'] seconds is ignored.  The file is written to a temporary
+        name and renamed, so a power cut while saving leaves the previous checkpoint in place.
+
+AUTHOR
+    Bob Perciaccante - Bob@perciaccante.net
+
+========================================================================================================
+'''
+
+def save(_scheduler):
+    #############################################################################
+    # Function: save                                                            #
+    # Purpose:  Writes the checkpoint file                                      #
+    # @param    _scheduler dict of 'poll_due' and 'polled', sensor id -> time   #
+    #                                                                           #
+    # @return   none                                                            #
+    #############################################################################
+    with com.lock:
+        last_read = [list(key) + [value] for key, value in com.last_read.items()]
+    with adaptive.lock:
+        estimates = [[id, list(value)] for id, value in adaptive.estimates.items()]
+    with snapshot.changed:
+        latest = json.loads(json.dumps(snapshot.latest))
+        version = snapshot.version
+    state = {
+        'saved': time.time(),
+        'alarms': [[id, value] for id, value in list(com.alarms.items())],
+        'last_read': last_read,
+        'adaptive': estimates,
+        'snapshot': {'version': version, 'latest': latest},
+        'attr_sent': [list(key) + value for key, value in list(com.attr_sent.items())],
+        'replayed': dict((path, cursor) for path, cursor in list(com.replayed.items()) if com.replay_cursor(path, cursor)),
+        'poll_due': [[id, value] for id, value in list(_scheduler['poll_due'].items())],
+        'polled': [[id, value] for id, value in list(_scheduler['polled'].items())]
+        }
+    try:
+        with open(cfg.warmstart['file'] + '.tmp', 'w') as f:
+            json.dump(state, f)
+        os.replace(cfg.warmstart['file'] + '.tmp', cfg.warmstart['file'])
+    except (OSError, TypeError, ValueError) as e:
+        logging.warning('Unable to write warm start checkpoint ' + cfg.warmstart['file'] + ': ' + str(e))
+
+def restore():
+    #############################################################################
+    # Function: restore                                                         #
+    # Purpose:  Loads the checkpoint file, if there is a recent one, back into  #
+    #           the monitor's state.  Entries for sensors no longer configured  #
+    #           are left out                                                    #
+    # @param    none                                                            #
+    #                                                                           #
+    # @return   dict of 'poll_due' and 'polled', sensor id -> time, for the     #
+    #           monitor's scheduler (empty if nothing was restored)             #
+    #############################################################################
+    scheduler = {'poll_due': {}, 'polled': {}}
+    try:
+        with open(cfg.warmstart['file']) as f:
+            state = json.load(f)
+        age = time.time() - state['saved']
+    except (OSError, ValueError, KeyError, TypeError) as e:
+        logging.info('No warm start checkpoint restored (' + str(e) + '), starting cold')
+        return scheduler
+    if age > cfg.warmstart['max_age'] or age < 0:
+        logging.info('Warm start checkpoint is ' + str(int(age)) + ' seconds old, starting cold')
+        return scheduler
+
+    ids = set(item['id'] for item in cfg.sensors)
+    try:
+        com.alarms.update((id, value) for id, value in state['alarms'] if id in ids)
+        with com.lock:
+            com.last_read.update((tuple(entry[:3]), entry[3]) for entry in state['last_read'])
+        with adaptive.lock:
+            adaptive.estimates.update((id, value) for id, value in state['adaptive'] if id in ids)
+        with snapshot.changed:
+            snapshot.latest.update((id, value) for id, value in state['snapshot']['latest'].items() if id in set(str(i) for i in ids))
+            snapshot.version = max(snapshot.version, state['snapshot']['version'])
+        com.attr_sent.update(((entry[0], entry[1]), entry[2:]) for entry in state['attr_sent'])
+        com.replayed.update((path, cursor) for path, cursor in state['replayed'].items() if com.replay_cursor(path, cursor))
+        for name in scheduler:
+            scheduler[name] = dict((id, value) for id, value in state[name] if id in ids)
+    except (KeyError, TypeError, ValueError, IndexError) as e:
+        logging.warning('Warm start checkpoint ' + cfg.warmstart['file'] + ' is unreadable, starting cold: ' + str(e))
+        return {'poll_due': {}, 'polled': {}}
+    logging.info('Restored warm start checkpoint from ' + str(int(age)) + ' seconds ago: ' + str(len(com.alarms)) + ' alarm states, ' + str(len(com.attr_sent)) + ' attribute sets, ' + str(len(com.replayed)) + ' cache cursors')
+    return scheduler
+
+def start(_scheduler):
+    #############################################################################
+    # Function: start                                                           #
+    # Purpose:  Starts the thread saving a checkpoint every                     #
+    #           warmstart['checkpoint'] seconds                                 #
+    # @param    _scheduler function returning the monitor's scheduler state,    #
+    #                      as passed to save()                                  #
+    #                                                                           #
+    # @return   none                                                            #
+    #############################################################################
+    def checkpoints():
+        while True:
+            time.sleep(cfg.warmstart['checkpoint'])
+            save(_scheduler())
+
+    threading.Thread(target=checkpoints, name='warmstart', daemon=True).start()
+    logging.info('Saving warm start checkpoints to ' + cfg.warmstart['file'] + ' every ' + str(cfg.warmstart['checkpoint']) + ' seconds')
+
+def jitter():
+    #############################################################################
+    # Function: jitter                                                          #
+    # Purpose:  Waits a random time of up to warmstart['jitter'] seconds before #
+    #           the first poll, so the hosts of a site start apart              #
+    #############################################################################
+    wait = random.uniform(0, cfg.warmstart['jitter'])
+    if wait > 0:
+        logging.info('Waiting ' + str(round(wait, 1)) + ' seconds before the first poll')
+        time.sleep(wait)